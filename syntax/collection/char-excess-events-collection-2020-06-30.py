@@ -20,8 +20,14 @@
 from datetime import datetime as dt
 from bs4 import BeautifulSoup as soup
 from time import sleep
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import threading
+import queue
+import time
 import requests
-import zipfile, io
+import zipfile
+import codecs
+import io
 import os
 import argparse
 import json
@@ -29,6 +35,15 @@ import random
 import csv
 import re
 import pandas as pd
+from fdownload import download, previous_downloads
+from fpages import ni_removed_text, parse_removed_dates, index_page, page_index, PageArchive
+import fdownload
+import fstore
+import fevents
+import fxlsx
+import firs
+import fmetrics
+from fjournal import Journal
 
 
 # TO DO #
@@ -61,12 +76,15 @@ def test():
         f.write("Successfully executed script")
 
 
-def prelim():
+def prelim(ddate=None):
     """
         Get the current date and create a folder to store the download.
+
+        Takes one optional argument:
+            - Date of an earlier run to resume; default is today [optional]
     """
 
-    ddate = dt.now().strftime("%Y-%m-%d")
+    ddate = ddate or dt.now().strftime("%Y-%m-%d")
     download = "data/" + ddate
     log = "data/" + ddate + "/log"
     print(download)
@@ -89,8 +107,38 @@ def prelim():
     return download, log, ddate
 
 
+def xlsx_to_columnar(xlsxfile, outfile, columns=None, types=None, jurisdiction=None):
+    """
+        Converts a register downloaded as an xlsx file to a typed Parquet file (see fxlsx.py), which
+        loads in seconds rather than minutes. The xlsx file is kept as it is.
+
+        Takes two mandatory and three optional arguments:
+            - Path of the xlsx file and of the Parquet file [mandatory]
+            - Columns to keep (default: all) and their types (see fxlsx.to_columnar) [optional]
+            - Key of the jurisdiction, for the metrics of the run [optional]
+
+        Dependencies:
+            - pyarrow
+
+        Issues:
+            - A conversion that fails (e.g., a column has been renamed) is reported; the xlsx file
+              can still be used.
+    """
+
+    try:
+        with fmetrics.stage("xlsx_to_columnar", jurisdiction=jurisdiction) as m:
+            m["bytes"] = os.path.getsize(xlsxfile)
+            m["rows"] = fxlsx.to_columnar(xlsxfile, outfile, columns, types)
+        print("Columnar copy of the register ({:,} rows): '{}'".format(m["rows"], outfile))
+    except (ImportError, KeyError, zipfile.BadZipFile, fxlsx.ET.ParseError) as e:
+        print("Could not convert {} to a columnar file: {}".format(xlsxfile, e))
+
+
 # Australia
 
+aus_columns = ["ABN", "Charity_Legal_Name", "Registration_Date", "Date_Organisation_Established"] # as kept by the do-files
+aus_types = {"Registration_Date": "date", "Date_Organisation_Established": "date"}
+
 def aus_download(basefolder, logfolder, ddate):
     """
         Downloads latest copy of the Register of Charities.
@@ -123,7 +171,9 @@ def aus_download(basefolder, logfolder, ddate):
     # Request file
     
     webadd = "https://data.gov.au/data/dataset/b050b242-4487-4306-abf5-07ca073e5594/resource/eb1e6be4-5b13-4feb-b28e-388bf7c26f93/download/datadotgov_main.xlsx"
-    response = requests.get(webadd)
+    previous = previous_downloads(logfolder, "aus-roc-metadata", ddate)
+    downloads = {}
+    response, checksum, nbytes = download(webadd, outfile, overwrite=False, previous=previous, downloads=downloads)
     print(response.status_code, response.headers)
 
     # Write metadata to file
@@ -131,6 +181,8 @@ def aus_download(basefolder, logfolder, ddate):
     mdata = dict(response.headers)
     mdata["file"] = "Register of Charities"
     mdata["url"] = str(webadd)
+    mdata["sha256"] = checksum
+    mdata["downloads"] = downloads
 
     with open(mfile, "w") as f:
         json.dump(mdata, f)
@@ -138,20 +190,14 @@ def aus_download(basefolder, logfolder, ddate):
 
     # Save files (data and metadata)
 
-    if response.status_code==200: # if the file was successfully requested
+    if response.status_code in (200, 304): # if the file was successfully requested (or has not changed)
 
-        # Data
-
-        if os.path.isfile(outfile): # do not overwrite existing file
-            print("File already exists, no need to overwrite")
-        else: # file does not currently exist, therefore create
-            with open(outfile, "wb") as f:
-                f.write(response.content)
-        
         print("\r")    
         print("Successfully downloaded Charity Register")
         print("Check log file for metadata about the download: {}".format(mfile))
 
+        xlsx_to_columnar(outfile, dfolder + "/aus-roc-" + ddate + ".parquet", aus_columns, aus_types, "aus")
+
     else: # file was not successfully requested
         print("\r")    
         print("Unable to download Charity Register")
@@ -200,7 +246,9 @@ def nz_download(basefolder, logfolder, ddate):
     # Request file
     
     webadd = "http://www.odata.charities.govt.nz/vOrganisations?$returnall=true&$format=csv"
-    response = requests.get(webadd)
+    previous = previous_downloads(logfolder, "nz-roc-metadata", ddate)
+    downloads = {}
+    response, checksum, nbytes = download(webadd, outfile, overwrite=False, previous=previous, downloads=downloads)
     print(response.status_code, response.headers)
 
     # Write metadata to file
@@ -208,6 +256,8 @@ def nz_download(basefolder, logfolder, ddate):
     mdata = dict(response.headers)
     mdata["file"] = "Register of Charities"
     mdata["url"] = str(webadd)
+    mdata["sha256"] = checksum
+    mdata["downloads"] = downloads
 
     with open(mfile, "w") as f:
         json.dump(mdata, f)
@@ -215,16 +265,8 @@ def nz_download(basefolder, logfolder, ddate):
 
     # Save files (data and metadata)
 
-    if response.status_code==200: # if the file was successfully requested
+    if response.status_code in (200, 304): # if the file was successfully requested (or has not changed)
 
-        # Data
-
-        if os.path.isfile(outfile): # do not overwrite existing file
-            print("File already exists, no need to overwrite")
-        else: # file does not currently exist, therefore create
-            with open(outfile, "wb") as f:
-                f.write(response.content)
-        
         print("\r")    
         print("Successfully downloaded Charity Register")
         print("Check log file for metadata about the download: {}".format(mfile))
@@ -283,44 +325,40 @@ def usa_download(basefolder, logfolder, ddate):
     # Download data #
 
     files = [busfile1, busfile2, busfile3, busfile4]
-    item = 1
+    outfiles = [dfolder + "/irs_businessfile_" + str(item) + ".csv" for item in range(1, len(files) + 1)]
 
-    for file in files:
+    previous = previous_downloads(logfolder, "usa-exempt-metadata", ddate)
+    downloads = {}
 
-        response = requests.get(file, allow_redirects=True)
-
-        outfile = dfolder + "/irs_businessfile_" + str(item) + ".csv"
-        with open(outfile, 'w') as f:
-            f.write(response.text)
-        item +=1
-
-    # Append files together to form one dataset #
-
-    masterfile = dfolder + "/irs_businessfile_master_" + ddate + ".csv"
-    file1 = dfolder + "/irs_businessfile_1.csv"
-    file2 = dfolder + "/irs_businessfile_2.csv"
-    file3 = dfolder + "/irs_businessfile_3.csv"
-    file4 = dfolder + "/irs_businessfile_4.csv"
+    # The files are downloaded at the same time; each is kept so it can be reused by the next
+    # snapshot if the IRS has not changed it
 
-    afiles = [file2, file3, file4]
+    with ThreadPoolExecutor(max_workers=len(files)) as executor:
+        results = list(executor.map(lambda file, outfile: download(file, outfile, previous=previous, downloads=downloads,
+            allow_redirects=True), files, outfiles))
 
+    checksums = [checksum for response, checksum, nbytes in results]
+    response = results[-1][0]
+    for file, (r, checksum, nbytes) in zip(files, results):
+        if r.status_code not in (200, 304):
+            raise RuntimeError("Unable to download {} (status code {})".format(file, r.status_code))
 
-    # Append all of these files together #
 
-    fout=open(masterfile, 'a')
+    # Append files together to form one dataset, keeping the header of the first file only #
 
-    # Open the first file and write the contents to the output file:
-    for line in open(file1):
-        fout.write(line)
+    masterfile = dfolder + "/irs_businessfile_master_" + ddate + ".csv"
 
-    # Now the remaining files:
-    for file in afiles:
-        f = open(file)
-        next(f) # skip the first row
-        for line in f:
-             fout.write(line)
-        f.close() # not really needed
-    fout.close()
+    with open(masterfile, "wb") as fout: # truncate, so that reruns do not duplicate rows
+        for item, outfile in enumerate(outfiles):
+            with open(outfile, "rb") as f:
+                if item > 0:
+                    f.readline() # skip the first row
+                last = b"\n"
+                for block in iter(lambda: f.read(fdownload.chunksize), b""):
+                    fout.write(block)
+                    last = block[-1:]
+                if last != b"\n": # make sure the next file starts on a new line
+                    fout.write(b"\n")
 
 
     # Write metadata to file
@@ -328,6 +366,8 @@ def usa_download(basefolder, logfolder, ddate):
     mdata = dict(response.headers)
     mdata["file"] = "Exempt Organisations - Business Files"
     mdata["data_link"] = files
+    mdata["sha256"] = checksums
+    mdata["downloads"] = downloads
 
     with open(exefile, "w") as f:
         json.dump(mdata, f)
@@ -339,24 +379,23 @@ def usa_download(basefolder, logfolder, ddate):
 
     # Download data #
 
-    response = requests.get(revexemp, allow_redirects=True)
-    z = zipfile.ZipFile(io.BytesIO(response.content))
-    z.extractall(dfolder)
+    revzip = dfolder + "/data-download-revocation.zip"
+    previous = previous_downloads(logfolder, "usa-revoked-metadata", ddate)
+    downloads = {}
+    response, checksum, nbytes = download(revexemp, revzip, previous=previous, downloads=downloads, allow_redirects=True)
 
-    # Load in .txt file and write to csv #
+    # Stream the .txt file from the zip file to a typed Parquet file with an EIN index, and to the
+    # csv file imported by the do-files, in one pass #
 
-    inputfile = dfolder + "/data-download-revocation.txt"
     outputfile = dfolder + "/irs_revoked_exemp_orgs_" + ddate + ".csv"
-    
-    with open(outputfile, 'w', newline='') as outcsv:
-        varnames = ["EIN", "Legal_Name", "Doing_Business_As_Name", "Organization_Address", "City", "State", "ZIP_Code", "Country", "Exemption_Type", "Revocation_Date", "Revocation_Posting_Date", "Exemption_Reinstatement_Date"]
-        writer = csv.writer(outcsv, varnames)
-        writer.writerow(varnames)
+    parquetfile = dfolder + "/irs_revoked_exemp_orgs_" + ddate + ".parquet"
 
-        with open(inputfile, 'r') as infile:
-            reader = csv.reader(infile, delimiter='|')
-            for row in reader:
-                writer.writerow(row)
+    with fmetrics.stage("usa_revoked", jurisdiction="usa") as m:
+        m["bytes"] = os.path.getsize(revzip)
+        if firs.pa is not None:
+            m["rows"] = firs.revocations_to_columnar(revzip, parquetfile, outputfile)
+        else: # pyarrow is not installed: the csv file only
+            m["rows"] = firs.revocations_to_csv(revzip, outputfile)
 
 
     # Write metadata to file
@@ -364,11 +403,183 @@ def usa_download(basefolder, logfolder, ddate):
     mdata = dict(response.headers)
     mdata["file"] = "Revoked Organisations"
     mdata["data_link"] = revexemp
+    mdata["sha256"] = checksum
+    mdata["downloads"] = downloads
 
     with open(revfile, "w") as f:
         json.dump(mdata, f)            
 
 
+    # Index the NTEE code, major group and ruling date of each EIN, so that the statistics by NTEE
+    # major group look EINs up in the index rather than reading the master file again. The index
+    # is optional: if it cannot be built (e.g., a business file has no NTEE_CD column) the
+    # statistics build it from the master file later #
+
+    if firs.pa is not None:
+        try:
+            with fmetrics.stage("usa_ntee_index", jurisdiction="usa") as m:
+                m["bytes"] = sum(os.path.getsize(outfile) for outfile in outfiles)
+                m["rows"] = len(firs.ntee_index(outfiles, firs.ntee_path(basefolder, ddate)))
+        except (KeyError, ValueError, OSError) as e: # Arrow's errors derive from these
+            print("Could not build the NTEE index of the business files: {}".format(e))
+
+
+#############################################################################################################
+
+#############################################################################################################
+
+
+# Canada
+
+# Link to the CRA's download of the search results for all charities (every status), as used by the
+# "Download results" button of the List of charities advanced search
+can_url = "https://apps.cra-arc.gc.ca/ebci/hacc/srch/pub/dwnldSrchRslts?request_locale=en&q.stts=0000"
+
+
+def can_date(value):
+    """
+        Converts a date from the CRA list of charities to YYYY-MM-DD, returning it unchanged if it is
+        not in a recognised format.
+    """
+
+    value = value.strip()
+    for fmt in ("%Y-%m-%d", "%Y/%m/%d", "%Y%m%d", "%d/%m/%Y", "%b %d, %Y", "%B %d, %Y", "%d-%b-%Y"):
+        try:
+            return dt.strptime(value, fmt).strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+    return value
+
+
+def can_normalise(blocks, counts=None):
+    """
+        Converts the CRA list of charities as it is downloaded: takes the chunks of the response and
+        yields the file a chunk at a time, with the effective date of status converted to YYYY-MM-DD
+        and the spaces removed from the registration number (e.g., "10000 1234 RR0001" becomes
+        "100001234RR0001"). The delimiter and column names are kept, so the cleaning do-file reads
+        the file as before. The number of rows written is kept in counts["rows"].
+    """
+
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="surrogateescape")
+
+    def lines(): # split on \n only, so that other line breaks within a field are kept
+        pending = ""
+        for block in blocks:
+            pending += decoder.decode(block)
+            *complete, pending = pending.split("\n")
+            for line in complete:
+                yield line + "\n"
+        pending += decoder.decode(b"", final=True)
+        if pending:
+            yield pending
+
+    source = lines()
+    header = next(source, "")
+    if not header:
+        return
+    delimiter = "\t" if header.count("\t") >= header.count(",") else ","
+    names = next(csv.reader([header], delimiter=delimiter))
+    keys = [re.sub(r"[^a-z0-9]", "", name.lower()) for name in names] # as Stata names the columns
+    bn = keys.index("bnregistrationnumber") if "bnregistrationnumber" in keys else None
+    status = keys.index("effectivedateofstatus") if "effectivedateofstatus" in keys else None
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=delimiter, lineterminator="\n")
+    writer.writerow(names)
+    rows = 0
+    for row in csv.reader(source, delimiter=delimiter):
+        if not row:
+            continue
+        if bn is not None and bn < len(row):
+            row[bn] = re.sub(r"\s+", "", row[bn]).upper()
+        if status is not None and status < len(row):
+            row[status] = can_date(row[status])
+        writer.writerow(row)
+        rows += 1
+        if buffer.tell() >= fdownload.chunksize:
+            yield buffer.getvalue().encode("utf-8", "surrogateescape")
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode("utf-8", "surrogateescape")
+
+    if counts is not None:
+        counts["rows"] = rows
+
+
+def can_download(basefolder, logfolder, ddate, url=None):
+    """
+        Downloads latest copy of the list of charities from the Canada Revenue Agency (CRA), with
+        charities of every status (registered, revoked, annulled etc.).
+
+        Takes three mandatory and one optional argument:
+            - Download folder, log folder and date returned by prelim() [mandatory]
+            - Link to the CRA's download of the list of charities; default is can_url [optional]
+
+        The list is written to Charities_results_<date>.txt as it is downloaded, a row at a time,
+        with the effective date of status and the registration number normalised (see
+        can_normalise).
+
+        Dependencies:
+            - NONE
+
+        Issues:
+            - The CRA's search application may change the link to its download; pass the current
+              link as url if the download fails.
+    """
+
+    print("Downloading Canada List of Charities")
+    print("\r")
+
+
+    # Create data folder
+
+    dfolder = basefolder + "/can"
+    if not os.path.isdir(dfolder):
+        os.mkdir(dfolder)
+    else:
+        print("{} already exists".format(dfolder))
+
+
+    # Define output files
+
+    mfile = logfolder + "/can-roc-metadata-" + ddate + ".json"
+    outfile = dfolder + "/Charities_results_" + ddate + ".txt" # List of Charities
+
+
+    # Request file
+
+    webadd = url or can_url
+    previous = previous_downloads(logfolder, "can-roc-metadata", ddate)
+    downloads = {}
+    counts = {}
+    response, checksum, nbytes = download(webadd, outfile, previous=previous, downloads=downloads, allow_redirects=True,
+        transform=lambda blocks: can_normalise(blocks, counts))
+    print(response.status_code, response.headers)
+
+    if response.status_code not in (200, 304):
+        raise RuntimeError("Unable to download {} (status code {})".format(webadd, response.status_code))
+    rows = counts.get("rows") # not counted if the file has not changed since the earlier snapshot
+
+
+    # Write metadata to file
+
+    mdata = dict(response.headers)
+    mdata["file"] = "List of Charities"
+    mdata["url"] = str(webadd)
+    mdata["sha256"] = checksum
+    mdata["rows"] = rows
+    mdata["downloads"] = downloads
+
+    with open(mfile, "w") as f:
+        json.dump(mdata, f)
+
+    print("\r")
+    print("Successfully downloaded List of Charities{}".format("" if rows is None else " ({:,} rows)".format(rows)))
+    print("Check log file for metadata about the download: {}".format(mfile))
+    print("List of Charities: '{}'".format(outfile))
+
+
+
 #############################################################################################################
 
 #############################################################################################################
@@ -409,39 +620,56 @@ def ew_download(basefolder, logfolder, ddate):
     "charity_other_regulators", "charity_policy", "charity_published_report", "charity_trustee"]
     webadd = "https://ccewuksprdoneregsadata1.blob.core.windows.net/data/txt/publicextract.{}.zip" # txt download (json also available)
     
+    checksums = {}
+    previous = previous_downloads(logfolder, "ew-download-metadata", ddate)
+    downloads = {}
+    response = None
+
     for table in tables:
-        response = requests.get(webadd.format(table))
+        if "ew" in timed_out: # over budget: reported as failed, so stop writing to the snapshot
+            return
+        outfile = dfolder + "/" + table + "-" + ddate + ".zip"
+        if journal is not None and journal.done("ew/table/" + table):
+            print("Already downloaded in this run: {}".format(outfile))
+            checksums[table] = journal.steps["ew/table/" + table]["files"][outfile][1]
+            continue
+
+        response, checksum, nbytes = download(webadd.format(table), outfile, overwrite=False, previous=previous, downloads=downloads)
         print(response.status_code, response.headers)
 
-        if response.status_code==200:
+        if response.status_code in (200, 304):
 
-            outfile = dfolder + "/" + table + "-" + ddate + ".zip"
             print(outfile)
-            if os.path.isfile(outfile): # do not overwrite existing file
-                print("File already exists, no need to overwrite")
-            else: # file does not currently exist, therefore create
-                with open(outfile, "wb") as f:
-                    f.write(response.content)
+            checksums[table] = checksum
 
             # Unzip files
 
             with zipfile.ZipFile(outfile, 'r') as zip_ref:
             	zip_ref.extractall(dfolder)
 
+            if journal is not None:
+                journal.record("ew/table/" + table, "done", paths=[outfile])
+
         else:
             print("Unable to download data extract from link {}".format(webadd))
             print("Status code {}".format(response.status_code))
+            if journal is not None:
+                journal.record("ew/table/" + table, "failed", status_code=response.status_code)
 
 
-    # Write metadata to file
+    # Write metadata to file (unless every table was downloaded earlier in a resumed run, whose
+    # metadata file is kept)
 
-    mdata = dict(response.headers)
-    mdata["file"] = table
-    mdata["file_link"] = str(webadd)
-    mdata["data_extract_last_modified"] = response.headers["Last-Modified"]
+    if response is not None:
+        mdata = dict(response.headers)
+        mdata["file"] = table
+        mdata["file_link"] = str(webadd)
+        mdata["data_extract_last_modified"] = response.headers.get("Last-Modified")
+        mdata["sha256"] = checksums
+        mdata["downloads"] = downloads
 
-    with open(mfile, "w") as f:
-        json.dump(mdata, f)
+        with open(mfile, "w") as f:
+            json.dump(mdata, f)
     
 
     print("\r")    
@@ -489,7 +717,9 @@ def ni_roc(basefolder, logfolder, ddate):
     # Request file from API
     
     webadd = "https://www.charitycommissionni.org.uk/umbraco/api/charityApi/ExportSearchResultsToCsv/?include=Removed"
-    response = requests.get(webadd)
+    previous = previous_downloads(logfolder, "ni-roc-metadata", ddate)
+    downloads = {}
+    response, checksum, nbytes = download(webadd, outfile, overwrite=False, previous=previous, downloads=downloads)
     print(response.status_code, response.headers)
 
 
@@ -498,6 +728,8 @@ def ni_roc(basefolder, logfolder, ddate):
     mdata = dict(response.headers)
     mdata["file"] = "Register of Charities"
     mdata["url"] = str(webadd)
+    mdata["sha256"] = checksum
+    mdata["downloads"] = downloads
 
     with open(mfile, "w") as f:
         json.dump(mdata, f)
@@ -505,14 +737,8 @@ def ni_roc(basefolder, logfolder, ddate):
 
     # Save data file
 
-    if response.status_code==200: # if the web page was successfully requested
+    if response.status_code in (200, 304): # if the file was successfully requested (or has not changed)
 
-        if os.path.isfile(outfile): # do not overwrite existing file
-            print("File already exists, no need to overwrite")
-        else: # file does not currently exist, therefore create
-            with open(outfile, "wb") as f:
-                f.write(response.content)
-        
         print("\r")    
         print("Successfully downloaded Charity Register")
         print("Check log file for metadata about the download: {}".format(mfile))
@@ -529,12 +755,69 @@ def ni_roc(basefolder, logfolder, ddate):
     return outfile, dfolder
 
 
-def ni_webpage(regid, webpagefolder, logfolder, ddate):
+class TokenBucket:
+    """
+        Token bucket rate limiter shared by the threads of a crawl: each request takes one token,
+        and tokens are replenished at a fixed rate up to a maximum burst size.
+
+        Takes one mandatory and one optional argument:
+            - Number of requests per second [mandatory]
+            - Maximum number of requests that can be made in a burst; default is 1 [optional]
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = max(1, int(burst))
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_for = (1 - self.tokens) / self.rate
+            sleep(wait_for)
+
+
+def ni_session(concurrency=8):
+    """
+        Creates a requests session with a keep-alive connection pool large enough for the number of
+        threads that will share it.
+
+        Dependencies:
+            - NONE
+
+        Issues:
+    """
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def ni_webpage(regid, webpagefolder, logfolder, ddate, session=None, bucket=None, retries=4, backoff=1.0, archive=None):
     """
         Downloads a charity's web page from the CCNI website, which can be parsed at a later date.
 
-        Takes one mandatory argumnent:
-            - Registered Charity Number of a charity
+        Takes four mandatory and five optional arguments:
+            - Registered Charity Number of a charity, output folders and date [mandatory]
+            - Session to make the request with; default is a new session [optional]
+            - TokenBucket used to limit the rate of requests; default is no limit [optional]
+            - Number of times to retry a request that fails with 429 or 5xx; default is 4 [optional]
+            - Initial delay (seconds) between retries, doubled after each retry; default is 1 [optional]
+            - PageArchive to add the page and its metadata to; default is to write a .txt file and a
+              metadata file [optional]
+
+        Returns True if the web page was saved (with archive: the offset and length of the page in
+        the archive, or False).
 
         Dependencies:
             - roc_download (for source of charity numbers)
@@ -545,10 +828,43 @@ def ni_webpage(regid, webpagefolder, logfolder, ddate):
     
     # Request web page
 
-    session = requests.Session()
+    if session is None:
+        session = requests.Session()
 
     webadd = "https://www.charitycommissionni.org.uk/charity-details/?regId=" + str(regid) + "&subId=0"
-    response = session.get(webadd)
+
+    with fmetrics.stage("ni_webpage", jurisdiction="ni", regid=str(regid)) as m:
+        for attempt in range(retries + 1):
+            if bucket is not None:
+                bucket.acquire()
+            try:
+                response = session.get(webadd, timeout=60)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                response = None
+
+            if response is not None and response.status_code != 429 and response.status_code < 500:
+                break
+            if attempt == retries:
+                break
+
+            # Back off before retrying, honouring the Retry-After header if the server sends one
+
+            delay = backoff * 2 ** attempt + random.uniform(0, backoff)
+            if response is not None and str(response.headers.get("Retry-After", "")).isdigit():
+                delay = max(delay, int(response.headers["Retry-After"]))
+            sleep(delay)
+
+        m["retries"] = attempt
+        m["success"] = response is not None and response.status_code == 200
+        if response is not None:
+            m["bytes"] = len(response.content)
+            m["rows"] = 1 if m["success"] else 0
+            m["status_code"] = response.status_code
+
+    if response is None:
+        print("\r")
+        print("Could not download web page of charity: {}".format(regid))
+        return False
 
     
     # Capture metadata
@@ -558,13 +874,20 @@ def ni_webpage(regid, webpagefolder, logfolder, ddate):
     mdata["url"] = str(webadd)
     mfile = logfolder + "/ni-webpages-metadata-" + str(regid) + "-" + ddate + ".json"
 
-    with open(mfile, "w") as f:
-        json.dump(mdata, f)
+    if archive is None: # the archive stores the metadata with the page
+        with open(mfile, "w") as f:
+            json.dump(mdata, f)
     
     
     # Save web page
 
-    if response.status_code==200:
+    if response.status_code==200 and archive is not None:
+
+        offset, length = archive.append(regid, mdata, response.text)
+        print("Downloaded web page of charity: {}".format(regid))
+        return offset, length
+
+    elif response.status_code==200:
 
         outfile = webpagefolder + "/ni-charity-" + str(regid)  + "-" + ddate + ".txt"
 
@@ -574,24 +897,32 @@ def ni_webpage(regid, webpagefolder, logfolder, ddate):
         print("Downloaded web page of charity: {}".format(regid))    
         print("\r")
         print("Web page file is here: '{}'".format(outfile))
+        return True
 
     else:
         print("\r")
         print("Could not download web page of charity: {}".format(regid))
+        return False
 
 
 
-def ni_webpage_from_file(infile, dfolder, logfolder, ddate):
+def ni_webpage_from_file(infile, dfolder, logfolder, ddate, concurrency=8, rate=5.0, regids=None, pack=True):
     """
         Takes a file containing Registered Charity Numbers (RCN) for Northern Irish charities and
-        downloads a charity's web page from the regulator's website.
+        downloads each charity's web page from the regulator's website.
 
-        Takes one mandatory and one optional argument:
-            - CSV file containing a list of rcns for Northern Irish charities [mandatory]
-            - Proportion of charities to download details for; default is all (1.0) [optional]
+        Takes four mandatory and four optional arguments:
+            - CSV file containing a list of rcns for Northern Irish charities, output folders and date [mandatory]
+            - Number of web pages to download at the same time; default is 8 [optional]
+            - Maximum number of requests per second across all threads; default is 5 [optional]
+            - Set of rcns to download; default is every charity in the file [optional]
+            - Whether to add the web pages to one compressed page archive (see fpages.PageArchive)
+              rather than writing a .txt file and a metadata file for each; default is True [optional]
+
+        The threads share one keep-alive connection pool and one rate limiter.
 
         Dependencies:
-            - webpage_download
+            - ni_webpage
 
         Issues:
             - 
@@ -610,29 +941,79 @@ def ni_webpage_from_file(infile, dfolder, logfolder, ddate):
 
     df = pd.read_csv(infile, encoding="ISO-8859-1", index_col=False) # import file
     regid_list = df["Reg charity number"].tolist()
+    if regids is not None:
+        regid_list = [regid for regid in regid_list if regid in regids]
+    if journal is not None: # skip web pages saved earlier in this run (and, if packed, in the page index)
+        indexed = page_index(webpagefolder) if pack else None
+        saved = set(regid for regid in regid_list if journal.done("ni/page/" + str(regid)) and (indexed is None or int(regid) in indexed))
+        regid_list = [regid for regid in regid_list if regid not in saved]
+        if saved:
+            print("Skipping {} web pages already downloaded in this run".format(len(saved)))
+
 
     # Request web pages
 
-    for regid in regid_list:
-        ni_webpage(regid, webpagefolder, logfolder, ddate)
+    session = ni_session(concurrency)
+    bucket = TokenBucket(rate, burst=concurrency)
+    archive = PageArchive(webpagefolder, ddate) if pack else None
+    lock = threading.Lock()
+    progress = {"done": 0, "failed": 0}
+    total = len(regid_list)
+
+    def fetch(regid):
+        if "ni" in timed_out: # over budget: reported as failed, so stop writing to the snapshot
+            return
+        ok = ni_webpage(regid, webpagefolder, logfolder, ddate, session=session, bucket=bucket, archive=archive)
+        page = webpagefolder + "/ni-charity-" + str(regid) + "-" + ddate + ".txt"
+        if ok and archive is None: # pages in the archive are indexed when they are added
+            index_page(webpagefolder, regid, os.path.basename(page), ddate)
+        if journal is not None and not ok:
+            journal.record("ni/page/" + str(regid), "failed")
+        elif journal is not None and archive is None:
+            journal.record("ni/page/" + str(regid), "done", paths=[page])
+        elif journal is not None: # the page's part of the archive, which grows as other pages are added
+            journal.record("ni/page/" + str(regid), "done", ranges=[(archive.path,) + ok])
+        with lock:
+            progress["done"] += 1
+            if not ok:
+                progress["failed"] += 1
+            if progress["done"] % 100 == 0 or progress["done"] == total:
+                print("Progress: {} of {} web pages requested ({} failed)".format(progress["done"], total, progress["failed"]))
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        list(executor.map(fetch, regid_list))
+
+    session.close()
 
     print("\r")
     print("Finished downloading web pages for charities in file: {}".format(infile))
+    print("Could not download {} of {} web pages".format(progress["failed"], total))
     print("Check log files for metadata about the download")
 
     return webpagefolder
 
 
-def ni_removed(register, dfolder, webpagefolder, ddate):
+def ni_removed(register, dfolder, webpagefolder, ddate, previous=None, processes=1):
     """
-        Takes a charity's webpage (.txt file) downloaded from the CCNI website and
-        extracts the removal date of deregistered organisations.
+        Takes a charity's webpage (a .txt file or a page in the page archive) downloaded from the
+        CCNI website and extracts the removal date of deregistered organisations.
+
+        Only the web pages of charities that are removed from the register are read; they are found
+        through the folder's page index (see fpages.page_index), which the crawler adds each page to.
+        The removals file has one row per removed charity with a web page.
+
+        Takes four mandatory and two optional arguments:
+            - Register of Charities, output folder, a directory with .txt files containing HTML code of a
+              charity's CCNI web page, and date [mandatory]
+            - Removals file from an earlier snapshot; rows for charities without a web page in this
+              snapshot are carried forward [optional]
+            - Number of processes used to parse web pages; default is 1 [optional]
 
-        Takes one mandatory argument:
-            - A directory with .txt files containing HTML code of a charity's CCNI web page
+        Returns the number of rows written to the removals file.
 
         Dependencies:
             - webpage_download | webpage_download_from_file 
+            - ni_removed_text, parse_removed_dates, page_index
 
         Issues:       
     """    
@@ -640,78 +1021,191 @@ def ni_removed(register, dfolder, webpagefolder, ddate):
     # Define output file
 
     rfile = dfolder + "/ni-removals-" + ddate + ".csv"    
+    rejectsfile = dfolder + "/ni-removals-rejects-" + ddate + ".csv"
     rvarnames = ["regid", "removed", "removed_date"]
 
-
-    # Write headers to the output files
-
-    with open(rfile, "w", newline="") as f:
-        writer = csv.writer(f, rvarnames)
-        writer.writerow(rvarnames)
-
     
     # Get list of removed organisations
 
     roc = pd.read_csv(register, encoding = "ISO-8859-1", index_col=False)
     removed = roc.loc[roc["Status"]=="Removed"]
-    removed_set = set(removed["Reg charity number"])
+    removed_list = sorted(set(removed["Reg charity number"].astype(int)))
 
 
-    # Read data
+    # Look up the web pages of removed charities in the page index kept by the crawler
 
-    for file in os.listdir(webpagefolder):
-        if file.endswith(".txt"):
-            regid = file[11:17]
-            if int(regid) in removed_set:
-                f = os.path.join(webpagefolder, file)
-                print(regid, f)
-                with open(f, "r", encoding = "ISO-8859-1") as f:
-                    data = f.read()
-                    soup_org = soup(data, "html.parser") # Parse the text as a BS object.
-            
-                # Locate and extract annual report information
-                
-                removed = 1
-                removed_date_sentence = soup_org.find("div", class_="pcg-charity-details__purpose pcg-charity-details__purpose--removed pcg-contrast__color-main").text
-                removed_date_str = removed_date_sentence.replace(" ", "")[-10:].strip()
-                #if removed_date_str[0].isalpha():
-                #    removed_date_str = "0" + removed_date_str[1:]
-                try:
-                    removed_date = dt.strptime(removed_date_str, "%d%b%Y").date()
-                except:
-                    removed_date = ""
-                row = regid, removed, removed_date
-                with open(rfile, "a", newline="") as f:
-                    writer = csv.writer(f)
-                    writer.writerow(row)
-                
-
-            else: # charity is not removed from register
-                removed = 0
-                removed_date = ""
-                row = regid, removed, removed_date
-                with open(rfile, "a", newline="") as f:
-                    writer = csv.writer(f)
-                    writer.writerow(row)    
+    index = page_index(webpagefolder)
+    rows = []
+    paths = []
+    for regid in removed_list:
+        if regid in index and os.path.isfile(index[regid]["path"]): # pages may have been deleted by file_delete
+            paths.append((len(rows), index[regid]))
+            rows.append([str(regid), 1, ""])
+    paths.sort(key=lambda page: (page[1]["file"], int(page[1].get("offset") or 0))) # read archives in order
+
+
+    # Extract removal sentences, then parse the dates in one pass
+
+    if processes == 1:
+        sentences = [ni_removed_text(page) for row, page in paths]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            sentences = list(executor.map(ni_removed_text, [page for row, page in paths], chunksize=64))
+
+    dates = parse_removed_dates(sentences)
+    rejects = []
+    for (row, page), sentence, removed_date in zip(paths, sentences, dates):
+        if pd.isna(removed_date):
+            rows[row][2] = ""
+            rejects.append([rows[row][0], page["path"], "no removal sentence" if sentence is None else "date not recognised", sentence or ""])
+        else:
+            rows[row][2] = removed_date.strftime("%Y-%m-%d")
+    print("Extracted removal dates from {} web pages".format(len(paths) - len(rejects)))
+
+
+    # Write web pages whose removal date could not be extracted to a rejects file
+
+    with open(rejectsfile, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["regid", "file", "reason", "sentence"])
+        writer.writerows(rejects)
+    if rejects:
+        print("Could not extract the removal date from {} web pages: see {}".format(len(rejects), rejectsfile))
+
+
+    # Write rows to the output file
+
+    with open(rfile, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(rvarnames)
+        writer.writerows(rows)
+
+
+    # Carry forward rows from the earlier snapshot for charities whose web page was not downloaded
+
+    if previous is not None:
+        fetched = set(str(regid) for regid in index)
+        current = set(str(regid) for regid in removed_list)
+
+        prev = pd.read_csv(previous, dtype=str, keep_default_na=False)
+        prev["regid"] = prev["regid"].astype(int).astype(str)
+        prev = prev.loc[(prev["removed"] == "1") & prev["regid"].isin(current) & ~prev["regid"].isin(fetched)]
+        prev[rvarnames].to_csv(rfile, mode="a", header=False, index=False)
+        print("Carried forward {} rows from: {}".format(len(prev), previous))
+        rows.extend(prev[rvarnames].values.tolist())
 
     print("/r")
     print("Finished extracting removal data from charity web pages found in: {}".format(webpagefolder))
 
+    return len(rows)
+
+
+def ni_previous(basefolder, ddate):
+    """
+        Finds the most recent earlier snapshot of the Northern Ireland data in the parent of the
+        download folder (e.g., data/2020-09-03 when run on 2020-10-07).
+
+        Returns the paths of the earlier Register of Charities and removals file, or (None, None) if
+        there is no earlier snapshot containing both.
+
+        Dependencies:
+            - prelim
+
+        Issues:
+    """
+
+    root = os.path.dirname(basefolder) or "."
+    dates = sorted([d for d in os.listdir(root) if re.fullmatch(r"\d{4}-\d{2}-\d{2}", d) and d < ddate], reverse=True)
+
+    for d in dates:
+        register = root + "/" + d + "/ni/ni-roc-" + d + ".csv"
+        removals = root + "/" + d + "/ni/ni-removals-" + d + ".csv"
+        if os.path.isfile(register) and os.path.isfile(removals):
+            return register, removals
+
+    return None, None
+
+
+def ni_changed(register, previous):
+    """
+        Compares two snapshots of the Register of Charities and returns the set of charity numbers
+        that are new, or whose details (including status) have changed, since the earlier snapshot.
+
+        Takes two mandatory arguments:
+            - Register of Charities for this snapshot
+            - Register of Charities for the earlier snapshot
+
+        Dependencies:
+            - ni_roc
+
+        Issues:
+            - Only columns present in both snapshots are compared.
+    """
+
+    key = "Reg charity number"
+    new = pd.read_csv(register, encoding="ISO-8859-1", index_col=False, dtype=str, keep_default_na=False)
+    old = pd.read_csv(previous, encoding="ISO-8859-1", index_col=False, dtype=str, keep_default_na=False)
+
+    columns = [c for c in new.columns if c in old.columns]
+    new = new.set_index(key)[[c for c in columns if c != key]]
+    old = old.set_index(key)[[c for c in columns if c != key]]
+    old = old.loc[~old.index.duplicated()]
+
+    new_hash = pd.util.hash_pandas_object(new, index=False)
+    old_hash = pd.util.hash_pandas_object(old, index=False).reindex(new_hash.index)
+    changed = new_hash.index[new_hash.ne(old_hash)]
+
+    return set(int(regid) for regid in changed)
+
+
+def ni_download(basefolder, logfolder, ddate, incremental=False, processes=1):
+    """
+        Downloads the Register of Charities and charity web pages, and extracts removal dates.
+
+        Takes three mandatory and two optional arguments:
+            - Download folder, log folder and date returned by prelim() [mandatory]
+            - Whether to only download web pages for charities that are new or have changed since
+              the most recent earlier snapshot; default is False (download every web page) [optional]
+            - Number of processes used to parse web pages; default is 1 [optional]
+
+        Dependencies:
+            - ni_roc
+            - ni_webpage_from_file
+            - ni_removed
+
+        Issues:
+    """
 
-def ni_download(basefolder, logfolder, ddate):
     register, dfolder = ni_roc(basefolder, logfolder, ddate)
     print("Finished downloading Register of Charities")
 
-    webpagefolder = ni_webpage_from_file(register, dfolder, logfolder, ddate)
+    regids, previous = None, None
+    if incremental:
+        prevregister, previous = ni_previous(basefolder, ddate)
+        if prevregister is None:
+            print("No earlier snapshot found, downloading all web pages")
+        else:
+            regids = ni_changed(register, prevregister)
+            print("{} charities are new or have changed since: {}".format(len(regids), prevregister))
+
+    with fmetrics.stage("ni_webpages", jurisdiction="ni") as m:
+        webpagefolder = ni_webpage_from_file(register, dfolder, logfolder, ddate, regids=regids)
     print("Finished downloading webpages")
+    if "ni" in timed_out:
+        return
 
-    ni_removed(register, dfolder, webpagefolder, ddate)
+    with fmetrics.stage("ni_removed", jurisdiction="ni") as m:
+        m["rows"] = ni_removed(register, dfolder, webpagefolder, ddate, previous=previous, processes=processes)
     print("Finished extracting information for removed charities")
 
 
 
 # Republic of Ireland
 
+def roi_types(column):
+    return "date" if "date" in column.lower() else None # every column is kept; dates are typed
+
+
 def roi_download(basefolder, logfolder, ddate):
     """
         Downloads latest copy of the Register of Charities and Annual Returns
@@ -771,24 +1265,26 @@ def roi_download(basefolder, logfolder, ddate):
         file_webadd = base_url + file_url # Build full link to file
         file_webadd.replace(" ", "%20")
 
-        # Request file
-
-        response_file = requests.get(file_webadd)
-
-        # Save files (data and metadata)
+        # Request file and save data
 
-        # Data
+        previous = previous_downloads(logfolder, "roi-roc-metadata", ddate)
+        downloads = {}
+        response_file, checksum, nbytes = download(file_webadd, outfile, overwrite=False, previous=previous, downloads=downloads)
+        mdata["file_url"] = file_webadd
+        mdata["file_status_code"] = response_file.status_code
+        mdata["sha256"] = checksum
+        mdata["downloads"] = downloads
 
-        if os.path.isfile(outfile): # do not overwrite existing file
-            print("File already exists, no need to overwrite")
-        else: # file does not currently exist, therefore create
-            with open(outfile, "wb") as f:
-                f.write(response_file.content)
+        with open(mfile, "w") as f:
+            json.dump(mdata, f)
         
         print("\r")    
         print("Successfully downloaded Charity Register")
         print("Check log file for metadata about the download: {}".format(mfile))
 
+        if response_file.status_code in (200, 304):
+            xlsx_to_columnar(outfile, dfolder + "/roi-roc-" + ddate + ".parquet", types=roi_types, jurisdiction="roi")
+
     else: # file was not successfully requested
         print("\r")    
         print("Unable to download Charity Register")
@@ -837,7 +1333,9 @@ def sco_download(basefolder, logfolder, ddate):
     # Download Charity Register
     
     reglink = "https://www.oscr.org.uk/umbraco/Surface/FormsSurface/CharityRegDownload"
-    response = requests.get(reglink)
+    previous = previous_downloads(logfolder, "sco-roc-metadata", ddate)
+    downloads = {}
+    response, checksum, nbytes = download(reglink, regfile, previous=previous, downloads=downloads)
 
     
     # Write metadata to file
@@ -845,12 +1343,11 @@ def sco_download(basefolder, logfolder, ddate):
     regmdata = dict(response.headers)
     regmdata["file"] = "Register of Charities"
     regmdata["url"] = str(reglink)
+    regmdata["sha256"] = checksum
+    regmdata["downloads"] = downloads
 
     with open(regmfile, "w") as f:
         json.dump(regmdata, f)
-
-    with open(regfile, "wb") as f:
-        f.write(response.content)
         
     print("\r")    
     print("Successfully downloaded Charity Register")
@@ -860,7 +1357,9 @@ def sco_download(basefolder, logfolder, ddate):
     # Download Removed Organisations
     
     remlink = "https://www.oscr.org.uk/umbraco/Surface/FormsSurface/CharityFormerRegDownload"
-    response = requests.get(remlink)
+    previous = previous_downloads(logfolder, "sco-rem-metadata", ddate)
+    downloads = {}
+    response, checksum, nbytes = download(remlink, remfile, previous=previous, downloads=downloads)
 
     
     # Write metadata to file
@@ -868,12 +1367,11 @@ def sco_download(basefolder, logfolder, ddate):
     remmdata = dict(response.headers)
     remmdata["file"] = "Removed Organisations"
     remmdata["url"] = str(remlink)
+    remmdata["sha256"] = checksum
+    remmdata["downloads"] = downloads
 
     with open(remmfile, "w") as f:
         json.dump(remmdata, f)
-
-    with open(remfile, "wb") as f:
-        f.write(response.content)
         
     print("\r")    
     print("Successfully downloaded Charity Register")
@@ -912,60 +1410,263 @@ def file_delete(source, ext):
 
 
 
+# Scheduler #
+
+journal = None # Journal of the steps finished in this run (see fjournal.py); set by main()
+
+# Jurisdictions that exceeded their budget in this run. Their threads cannot be stopped, so the long
+# loops of the download functions check this set and stop writing to the snapshot, and nothing is
+# journaled for them once they have been reported as failed.
+timed_out = set()
+
+# Each jurisdiction is described by a label (for printing), the download function and the
+# sub-folder of the prelim() download folder that the function writes its files to.
+
+jurisdictions = {
+    "sco": ["Scotland", sco_download, "sco"],
+    "aus": ["Australia", aus_download, "aus"],
+    "ew": ["England and Wales", ew_download, "ew"],
+    "roi": ["Rep. of Ireland", roi_download, "roi"],
+    "ni": ["Northern Ireland", ni_download, "ni"],
+    "usa": ["USA", usa_download, "usa"],
+    "can": ["Canada", can_download, "can"],
+    "nz": ["New Zealand", nz_download, "nz"],
+}
+
+
+def folder_size(folder):
+    """
+        Returns the total size (in bytes) of all files in a folder and its sub-folders; 0 if the folder
+        does not exist.
+
+        Dependencies:
+            - NONE
+
+        Issues:
+    """
+
+    total = 0
+    for root, dirs, files in os.walk(folder):
+        for file in files:
+            try:
+                total += os.path.getsize(os.path.join(root, file))
+            except OSError: # file removed while walking the folder
+                pass
+    return total
+
+
+def run_jurisdiction(name, basefolder, logfolder, ddate, started, options=None):
+    """
+        Executes the download function for one jurisdiction and returns a structured result:
+        success, bytes written to the jurisdiction's folder, duration (seconds) and any error.
+
+        Takes five mandatory and one optional argument:
+            - Key of the jurisdiction in the jurisdictions dict (e.g., "ni") [mandatory]
+            - Download folder, log folder and date returned by prelim() [mandatory]
+            - Dict shared with the scheduler, used to record when the download started [mandatory]
+            - Dict of keyword arguments passed to the download function [optional]
+
+        Dependencies:
+            - prelim
+
+        Issues:
+    """
+
+    label, func, subfolder = jurisdictions[name]
+    dfolder = basefolder + "/" + subfolder
+
+    result = {"jurisdiction": name, "label": label, "success": False, "bytes": 0,
+        "duration": None, "error": None, "timed_out": False}
+
+    if journal is not None and journal.done("jurisdiction/" + name):
+        print("{} already downloaded in this run".format(label))
+        started[name] = time.monotonic()
+        result.update({"success": True, "duration": 0.0, "bytes": folder_size(dfolder), "resumed": True})
+        return result
+
+    print("Beginning {} download".format(label))
+    start = time.monotonic()
+    started[name] = start
+    before = folder_size(dfolder)
+    try:
+        with fmetrics.stage("download", jurisdiction=name) as m:
+            try:
+                func(basefolder, logfolder, ddate, **(options or {}))
+            finally:
+                m["bytes"] = folder_size(dfolder) - before
+
+        # Download functions record the tables or pages they could not download and carry on; the
+        # jurisdiction is not done until they have been downloaded, so that --resume retries them
+        failed = journal.failed(name + "/") if journal is not None else []
+        if failed:
+            raise RuntimeError("{} steps failed: {}".format(len(failed), ", ".join(failed[:5]) + (", ..." if len(failed) > 5 else "")))
+        result["success"] = True
+    except Exception as e:
+        result["error"] = "{}: {}".format(type(e).__name__, e)
+        print("Could not execute {} download".format(label))
+
+    result["duration"] = round(time.monotonic() - start, 3)
+    result["bytes"] = folder_size(dfolder)
+
+    if name in timed_out: # already journaled as failed by run_all(); a late finish does not count
+        print("{} download finished after exceeding its budget; it is still recorded as failed".format(label))
+    elif journal is not None:
+        if result["success"]:
+            files = [dfolder + "/" + f for f in sorted(os.listdir(dfolder)) if os.path.isfile(dfolder + "/" + f)] if os.path.isdir(dfolder) else []
+            journal.record("jurisdiction/" + name, "done", paths=files, duration=result["duration"])
+        else:
+            journal.record("jurisdiction/" + name, "failed", error=result["error"])
+    return result
+
+
+def run_all(basefolder, logfolder, ddate, names=None, workers=4, budget=None, options=None):
+    """
+        Runs the download functions for a number of jurisdictions concurrently and writes a summary of
+        the run to the log folder.
+
+        Takes three mandatory and four optional arguments:
+            - Download folder, log folder and date returned by prelim() [mandatory]
+            - List of jurisdictions to download; default is all [optional]
+            - Number of jurisdictions to download at the same time; default is 4 [optional]
+            - Wall-clock budget (in seconds) for each jurisdiction; default is no limit [optional]
+            - Dict of keyword arguments for each jurisdiction's download function, keyed by
+              jurisdiction (e.g., {"ni": {"incremental": True}}) [optional]
+
+        A jurisdiction that exceeds its budget is reported as failed and the run moves on without
+        waiting for it. Its thread cannot be stopped: it is added to timed_out, so the EW and NI
+        downloads stop at their next table or web page and it is not journaled as done if it
+        finishes later, but files may continue to appear in its folder until then. A slow download frees its worker only when it finishes, so the
+        remaining jurisdictions share the other workers in the meantime.
+
+        Dependencies:
+            - prelim
+            - run_jurisdiction
+
+        Issues:
+    """
+
+    if names is None:
+        names = list(jurisdictions)
+    if options is None:
+        options = {}
+
+    rfile = logfolder + "/run-summary-" + ddate + ".json"
+    started = {}
+    results = {}
+    finished = queue.Queue()
+    todo = queue.Queue()
+    for name in names:
+        todo.put(name)
+
+
+    # Worker threads take jurisdictions from the queue until it is empty; they are daemon threads
+    # so that a download which exceeds its budget does not stop the script from exiting.
+
+    def worker():
+        while True:
+            try:
+                name = todo.get_nowait()
+            except queue.Empty:
+                return
+            finished.put(run_jurisdiction(name, basefolder, logfolder, ddate, started, options.get(name)))
+
+    for i in range(max(1, min(workers, len(names)))):
+        threading.Thread(target=worker, daemon=True).start()
+
+    while len(results) < len(names):
+        try:
+            r = finished.get(timeout=1)
+            if r["jurisdiction"] not in results: # ignore downloads that already exceeded their budget
+                results[r["jurisdiction"]] = r
+        except queue.Empty:
+            pass
+
+        if budget is not None: # check whether any running download has exceeded its budget
+            now = time.monotonic()
+            for name, start in list(started.items()):
+                if name not in results and now - start > budget:
+                    label = jurisdictions[name][0]
+                    print("{} download exceeded its budget of {} seconds".format(label, budget))
+                    timed_out.add(name)
+                    results[name] = {"jurisdiction": name, "label": label, "success": False,
+                        "bytes": folder_size(basefolder + "/" + jurisdictions[name][2]),
+                        "duration": round(now - start, 3),
+                        "error": "Exceeded budget of {} seconds".format(budget), "timed_out": True}
+                    if journal is not None:
+                        journal.record("jurisdiction/" + name, "failed", error=results[name]["error"])
+
+    summary = [results[name] for name in names]
+    with open(rfile, "w") as f:
+        json.dump(summary, f, indent=2)
+
+    print("\r")
+    for r in summary:
+        print("{:<20} {:<8} {:>14,} bytes {:>10} s {}".format(r["label"], "OK" if r["success"] else "FAILED",
+            r["bytes"], r["duration"], r["error"] or ""))
+    print("Check log file for a summary of the run: {}".format(rfile))
+
+    return summary
+
+
 # Define main() function for executing other functions when script is exectuted
 #
-# Add a logfile to capture which functions were not executed.
+# Jurisdictions are downloaded concurrently; a summary of each download is written to the log folder.
 #
 
 def main():
 
+    parser = argparse.ArgumentParser(description="Download charity registers for each jurisdiction.")
+    parser.add_argument("--jurisdictions", nargs="+", choices=list(jurisdictions), default=list(jurisdictions),
+        help="jurisdictions to download (default: all)")
+    parser.add_argument("--workers", type=int, default=4, help="number of jurisdictions to download at the same time")
+    parser.add_argument("--budget", type=float, default=None, help="wall-clock budget (seconds) for each jurisdiction")
+    parser.add_argument("--ni-incremental", action="store_true",
+        help="only download NI web pages for charities that are new or have changed since the last snapshot")
+    parser.add_argument("--no-cache", action="store_true",
+        help="download every file again, even if it has not changed since the last snapshot")
+    parser.add_argument("--resume", default=None, metavar="DATE",
+        help="resume the run of an earlier date (e.g., 2021-01-28), skipping the steps that finished")
+    parser.add_argument("--archive", default=None,
+        help="add the snapshot to this deduplicated store once downloaded (see fstore.py), e.g. data/store")
+    parser.add_argument("--events", default=None,
+        help="add the events in the snapshot to this event table (see fevents.py), e.g. data/events")
+    args = parser.parse_args()
+
+    options = {"ni": {"incremental": args.ni_incremental}}
+    fdownload.conditional = not args.no_cache
+
     print("Executing data download")
     
-    download, log, ddate = prelim()
-    
-    try:
-        print("Beginning Scotland download")
-        sco_download(download, log, ddate)
-    except:
-        print("Could not execute Scotland download")
-    
-    try:
-        print("Beginning Australia download")
-        aus_download(download, log, ddate)
-    except:
-        print("Could not execute Australia download")
-    
-    try:
-        print("Beginning England and Wales download")
-        ew_download(download, log, ddate)
-    except:
-        print("Could not execute England and Wales download")
-    
-    try:
-        print("Beginning Rep. of Ireland download")
-        roi_download(download, log, ddate)
-    except:
-        print("Could not execute Republic of Ireland download")
-    
-    try:
-        print("Beginning Northern Ireland download")
-        ni_download(download, log, ddate)
-    except:
-        print("Could not execute Northern Ireland download")
-    
-    try:
-        print("Beginning USA download")
-        usa_download(download, log, ddate)
-    except:
-        print("Could not execute USA download")
+    global journal
+    download, log, ddate = prelim(args.resume)
+    journal = Journal(log + "/run-journal-" + ddate + ".jsonl")
+    fmetrics.start(log + "/metrics-" + ddate + ".jsonl")
+    if args.resume:
+        failed = journal.failed()
+        print("Resuming run of {}: {} steps finished, {} to retry".format(ddate, len(journal.steps) - len(failed), len(failed)))
+
+    results = run_all(download, log, ddate, names=args.jurisdictions, workers=args.workers, budget=args.budget, options=options)
+
+    # A jurisdiction that failed or exceeded its budget may still be writing to its folder, so it is
+    # left out of the event table and the archive
+    incomplete = [r["jurisdiction"] for r in results if not r["success"]]
+    if incomplete and (args.events or args.archive):
+        print("Leaving out of the event table and archive: {}".format(", ".join(jurisdictions[name][0] for name in incomplete)))
 
-    try:
-        print("Beginning New Zealand download")
-        nz_download(download, log, ddate)
-    except:
-        print("Could not execute New Zealand download")
+    print("\r")
+    fmetrics.print_summary(fmetrics.path)
+    print("Check log file for metrics about each stage of the run: {}".format(fmetrics.path))
+
+    if args.events:
+        summary = fevents.build(args.events, download, ddate, countries=[c for c in args.jurisdictions if c in fevents.fstats.loaders and c not in incomplete])
+        print("Added {:,} events to '{}'".format(sum(summary.values()), args.events))
+
+    if args.archive:
+        summary = fstore.add(args.archive, download, ddate, exclude=[jurisdictions[name][2] for name in incomplete])
+        print("Archived {files} files ({bytes:,} bytes), {new_bytes:,} bytes added to '{store}'".format(store=args.archive, **summary))
 
 
 # Main program #
 
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
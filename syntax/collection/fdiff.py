@@ -0,0 +1,194 @@
+import tempfile
+import argparse
+import zlib
+import glob
+import csv
+import sys
+import os
+import re
+
+#######Program#######
+
+# Compares two snapshots of a register by key and writes the organisations that have been added,
+# removed or changed. Both files are first split into partitions by a hash of the key, so only one
+# partition of the earlier file is held in memory at a time.
+
+csv.field_size_limit(min(sys.maxsize, 2**31 - 1))
+
+partitions = 64 # number of partitions; memory use is roughly the size of the earlier file divided by this
+
+# Key column of each register, by the start of its file name
+keys = {
+    "nz-roc": "OrganisationId",
+    "ni-roc": "Reg charity number",
+    "irs_businessfile_master": "EIN",
+    "irs_revoked_exemp_orgs": "EIN",
+    "Charities_results": "BN/Registration Number",
+    "CharityExport": "Charity Number",
+    "aus-removals": "abn",
+    "extract_charity": "regno",
+    "extract_registration": "regno",
+}
+
+
+def register_key(path):
+    """
+        Returns the key column for a register file (e.g., EIN for irs_businessfile_master_<date>.csv).
+    """
+
+    name = os.path.basename(path)
+    for prefix in sorted(keys, key=len, reverse=True):
+        if name.startswith(prefix):
+            return keys[prefix]
+    raise ValueError("No key known for {}; use --key".format(name))
+
+
+def open_csv(path, mode, encoding):
+    # surrogateescape keeps bytes that are not valid in `encoding`, so rows are written back unchanged
+    return open(path, mode, newline="", encoding=encoding, errors="surrogateescape")
+
+
+def partition(path, key, folder, name, n, encoding="utf-8", delimiter=","):
+    """
+        Splits a csv file into `n` files in `folder` by a hash of the key column, keeping the order of
+        rows within each partition. Returns the header and the number of rows.
+    """
+
+    with open_csv(path, "r", encoding) as f:
+        reader = csv.reader(f, delimiter=delimiter)
+        header = next(reader)
+        header[0] = header[0].lstrip("\ufeff")
+        if key not in header:
+            raise KeyError("Key column '{}' not found in {}".format(key, path))
+        k = header.index(key)
+
+        outputs = [open_csv(folder + "/" + name + "-" + str(i) + ".csv", "w", encoding) for i in range(n)]
+        try:
+            writers = [csv.writer(o) for o in outputs]
+            rows = 0
+            for row in reader:
+                if not row:
+                    continue
+                value = row[k].strip() if k < len(row) else ""
+                writers[zlib.crc32(value.encode("utf-8", "surrogateescape")) % n].writerow(row)
+                rows += 1
+        finally:
+            for o in outputs:
+                o.close()
+
+    return header, rows
+
+
+def diff(old, new, outfile, key=None, n=None, encoding="utf-8", delimiter=",", tmpdir=None):
+    """
+        Compares two snapshots of a register, e.g. nz-roc-2020-09-03.csv and nz-roc-2020-10-07.csv,
+        and writes a csv file with one row per organisation that has been added, removed or changed.
+
+        Each row gives the type of change, the key, the columns that changed (separated by "|"),
+        then the organisation's values in the later snapshot (the earlier snapshot for removals).
+        Columns are compared by name, so registers that gain or lose columns can still be compared;
+        a key that appears more than once is matched by the order in which it appears.
+
+        Returns a dict with the number of rows in each snapshot and of each type of change.
+    """
+
+    key = key or register_key(new)
+    n = n or partitions
+    summary = {"old_rows": 0, "new_rows": 0, "added": 0, "removed": 0, "changed": 0}
+
+    with tempfile.TemporaryDirectory(dir=tmpdir) as folder:
+        old_header, summary["old_rows"] = partition(old, key, folder, "old", n, encoding, delimiter)
+        new_header, summary["new_rows"] = partition(new, key, folder, "new", n, encoding, delimiter)
+        columns = new_header + [c for c in old_header if c not in new_header]
+        common = [c for c in new_header if c in old_header]
+        ok = old_header.index(key)
+        nk = new_header.index(key)
+
+        with open_csv(outfile, "w", encoding) as out:
+            writer = csv.writer(out)
+            writer.writerow(["change", key, "changed_columns"] + columns)
+
+            for i in range(n):
+
+                # Earlier snapshot: load the partition, keyed by (key, occurrence)
+
+                earlier = {}
+                seen = {}
+                with open_csv(folder + "/old-" + str(i) + ".csv", "r", encoding) as f:
+                    for row in csv.reader(f):
+                        value = row[ok].strip() if ok < len(row) else ""
+                        seen[value] = seen.get(value, 0) + 1
+                        earlier[(value, seen[value])] = dict(zip(old_header, row))
+
+
+                # Later snapshot: stream the partition and match each row
+
+                seen = {}
+                with open_csv(folder + "/new-" + str(i) + ".csv", "r", encoding) as f:
+                    for row in csv.reader(f):
+                        value = row[nk].strip() if nk < len(row) else ""
+                        seen[value] = seen.get(value, 0) + 1
+                        record = dict(zip(new_header, row))
+                        before = earlier.pop((value, seen[value]), None)
+                        if before is None:
+                            writer.writerow(["added", value, ""] + [record.get(c, "") for c in columns])
+                            summary["added"] += 1
+                        else:
+                            changed = [c for c in common if record.get(c, "") != before.get(c, "")]
+                            if changed:
+                                writer.writerow(["changed", value, "|".join(changed)] + [record.get(c, before.get(c, "")) for c in columns])
+                                summary["changed"] += 1
+
+                for (value, occurrence), before in earlier.items():
+                    writer.writerow(["removed", value, ""] + [before.get(c, "") for c in columns])
+                    summary["removed"] += 1
+
+                os.remove(folder + "/old-" + str(i) + ".csv")
+                os.remove(folder + "/new-" + str(i) + ".csv")
+
+    return summary
+
+
+def snapshot_file(basefolder, ddate, pattern):
+    """
+        Finds a register in a snapshot folder, e.g. snapshot_file("data", "2020-09-03", "nz/nz-roc")
+        returns data/2020-09-03/nz/nz-roc-2020-09-03.csv.
+    """
+
+    matches = sorted(glob.glob(basefolder + "/" + ddate + "/" + pattern + "*"))
+    matches = [m for m in matches if m.endswith((".csv", ".txt"))]
+    if not matches:
+        raise FileNotFoundError("No file matching {} in {}/{}".format(pattern, basefolder, ddate))
+    return matches[0]
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Compare two snapshots of a register by key.")
+    parser.add_argument("old", help="earlier register, or a snapshot date with --register")
+    parser.add_argument("new", help="later register, or a snapshot date with --register")
+    parser.add_argument("--register", default=None, help="register within the data folder when comparing dates, e.g. nz/nz-roc")
+    parser.add_argument("--data", default="data", help="folder containing the dated snapshots")
+    parser.add_argument("--key", default=None, help="key column (default: based on the file name)")
+    parser.add_argument("--out", default=None, help="output file (default: <register>-diff-<old>-<new>.csv)")
+    parser.add_argument("--partitions", type=int, default=partitions)
+    parser.add_argument("--encoding", default="utf-8")
+    parser.add_argument("--delimiter", default=",")
+    args = parser.parse_args()
+
+    if args.register:
+        old = snapshot_file(args.data, args.old, args.register)
+        new = snapshot_file(args.data, args.new, args.register)
+        outfile = args.out or args.data + "/" + args.new + "/" + os.path.basename(args.register) + "-diff-" + args.old + "-" + args.new + ".csv"
+    else:
+        old, new = args.old, args.new
+        name = re.sub(r"[-_]?\d{4}-\d{2}-\d{2}$", "", os.path.splitext(os.path.basename(new))[0])
+        outfile = args.out or os.path.join(os.path.dirname(new) or ".", name + "-diff.csv")
+
+    summary = diff(old, new, outfile, key=args.key, n=args.partitions, encoding=args.encoding, delimiter=args.delimiter)
+    print("{old_rows:,} rows before, {new_rows:,} after: {added:,} added, {removed:,} removed, {changed:,} changed".format(**summary))
+    print("Differences: '{}'".format(outfile))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+import hashlib
+import tempfile
+import shutil
+import json
+import os
+import re
+import requests
+import fmetrics
+
+#######Program#######
+
+chunksize = 1024 * 1024 # bytes written to disk at a time
+conditional = True # ask the server whether a file has changed since the previous snapshot
+
+
+def previous_downloads(logfolder, name, ddate):
+    """
+        Finds the most recent earlier metadata file called `<name>-<date>.json` (e.g.,
+        aus-roc-metadata-2020-09-03.json) in the log folders of earlier snapshots and returns the
+        record of its downloads, keyed by url. Returns an empty dict if there is no earlier record.
+    """
+
+    root = os.path.dirname(os.path.dirname(logfolder)) or "."
+    if not os.path.isdir(root):
+        return {}
+
+    dates = sorted([d for d in os.listdir(root) if re.fullmatch(r"\d{4}-\d{2}-\d{2}", d) and d < ddate], reverse=True)
+    for d in dates:
+        mfile = root + "/" + d + "/log/" + name + "-" + d + ".json"
+        if os.path.isfile(mfile):
+            with open(mfile, "r") as f:
+                mdata = json.load(f)
+            if "downloads" in mdata:
+                return mdata["downloads"]
+
+    return {}
+
+
+def link(source, outfile):
+    """
+        Hard links a file from an earlier snapshot into this snapshot, copying it if the file
+        system does not support hard links.
+    """
+
+    if os.path.isfile(outfile):
+        os.remove(outfile)
+    try:
+        os.link(source, outfile)
+    except OSError:
+        shutil.copy2(source, outfile)
+
+
+def fetch(url, outfile, overwrite=True, session=None, size=None, previous=None, downloads=None, transform=None, **kwargs):
+    """
+        Streams a file to disk a chunk at a time, so memory use is bounded by the chunk size rather
+        than the size of the file. The file is written to a temporary file in the same folder,
+        fsynced and then renamed, so `outfile` is either complete or absent. A sha256 checksum is
+        computed while downloading.
+
+        If the request is not successful, or `outfile` exists and overwrite=False, nothing is written.
+        Extra keyword arguments are passed to requests (e.g., allow_redirects, headers).
+
+        `transform` is a function that takes the chunks of the response and yields the chunks to
+        write instead, so a file can be converted as it is downloaded (e.g., can_normalise in the
+        collection script). The checksum is of the file written.
+
+        `previous` is the record of downloads from an earlier snapshot (see previous_downloads()).
+        If it contains `url`, the request is made with If-None-Match / If-Modified-Since, and if the
+        server replies 304 Not Modified the earlier file is hard linked to `outfile` instead of
+        being downloaded again. A record of this download is added to the `downloads` dict, which
+        should be saved in the metadata file as "downloads".
+
+        Returns the response (for its status code and headers), the checksum and the number of
+        bytes downloaded; the checksum is None if nothing was written.
+    """
+
+    size = size or chunksize
+    get = session.get if session is not None else requests.get
+
+
+    # Make the request conditional on the file having changed since the earlier snapshot
+
+    earlier = (previous or {}).get(url)
+    if not conditional or not earlier or not earlier.get("file") or not os.path.isfile(earlier["file"]):
+        earlier = None
+    if earlier is not None:
+        headers = dict(kwargs.pop("headers", None) or {})
+        if earlier.get("ETag"):
+            headers["If-None-Match"] = earlier["ETag"]
+        if earlier.get("Last-Modified"):
+            headers["If-Modified-Since"] = earlier["Last-Modified"]
+        kwargs["headers"] = headers
+
+    response = get(url, stream=True, **kwargs)
+    with response:
+        if response.status_code == 304 and earlier is not None:
+            if os.path.isfile(outfile) and not overwrite: # do not overwrite existing file
+                print("File already exists, no need to overwrite")
+            else:
+                link(earlier["file"], outfile)
+                print("Not modified since earlier snapshot: {}".format(earlier["file"]))
+            if downloads is not None:
+                downloads[url] = {"file": outfile, "sha256": earlier.get("sha256"),
+                    "ETag": response.headers.get("ETag", earlier.get("ETag")),
+                    "Last-Modified": response.headers.get("Last-Modified", earlier.get("Last-Modified")),
+                    "not_modified": True}
+            return response, earlier.get("sha256"), 0
+
+        if response.status_code != 200:
+            return response, None, 0
+
+        if os.path.isfile(outfile) and not overwrite: # do not overwrite existing file
+            print("File already exists, no need to overwrite")
+            if downloads is not None:
+                downloads[url] = {"file": outfile, "sha256": None, "ETag": response.headers.get("ETag"),
+                    "Last-Modified": response.headers.get("Last-Modified"), "not_modified": False}
+            return response, None, 0
+
+        checksum = hashlib.sha256()
+        folder = os.path.dirname(outfile) or "."
+        fd, tmpfile = tempfile.mkstemp(dir=folder, prefix=os.path.basename(outfile) + ".", suffix=".part")
+        try:
+            received = [0]
+            def chunks():
+                for block in response.iter_content(chunk_size=size):
+                    received[0] += len(block)
+                    yield block
+            with os.fdopen(fd, "wb") as f:
+                for block in (transform(chunks()) if transform else chunks()):
+                    f.write(block)
+                    checksum.update(block)
+                nbytes = received[0]
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmpfile, outfile)
+        except BaseException:
+            if os.path.isfile(tmpfile):
+                os.remove(tmpfile)
+            raise
+
+    if downloads is not None:
+        downloads[url] = {"file": outfile, "sha256": checksum.hexdigest(), "ETag": response.headers.get("ETag"),
+            "Last-Modified": response.headers.get("Last-Modified"), "not_modified": False}
+
+    return response, checksum.hexdigest(), nbytes
+
+
+def download(url, outfile, **kwargs):
+    """
+        Downloads a file with fetch() and records the time taken, bytes downloaded and status code
+        as a metric (see fmetrics.py). Takes the same arguments and returns the same values as fetch().
+    """
+
+    with fmetrics.stage("http", url=url, file=os.path.basename(outfile)) as m:
+        response, checksum, nbytes = fetch(url, outfile, **kwargs)
+        m["bytes"] = nbytes
+        m["status_code"] = response.status_code
+        m["success"] = response.status_code in (200, 304)
+    return response, checksum, nbytes
@@ -0,0 +1,228 @@
+import argparse
+import shutil
+import os
+import pandas as pd
+import fstats
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset
+    import pyarrow.parquet
+except ImportError: # needed to write and read the event table
+    pa = None
+
+#######Program#######
+
+# One event table for every jurisdiction and snapshot: a registration ("reg") or removal ("rem") of
+# an organisation, with its date and any attributes the register gives (e.g., the status of a
+# Canadian charity whose registration was revoked). Events are taken from each register by the
+# loaders in fstats.py, so the table holds the same events as the do-files count.
+#
+# The table is a Parquet dataset partitioned by country and snapshot date:
+#
+#   <folder>/country=ew/snapshot_date=2021-01-28/part-0.parquet
+#
+# so a snapshot can be added (or replaced) one country at a time, and monthly or yearly counts for
+# every country come from a single scan of the table.
+
+fields = ["org_id", "event_type", "event_date", "attributes"]
+partitions = ["country", "snapshot_date"]
+
+
+def schema():
+    return pa.schema([
+        pa.field("org_id", pa.string()),
+        pa.field("event_type", pa.string()),
+        pa.field("event_date", pa.date32()),
+        pa.field("attributes", pa.map_(pa.string(), pa.string())),
+    ])
+
+
+def partitioning():
+    return pa.dataset.partitioning(pa.schema([pa.field("country", pa.string()), pa.field("snapshot_date", pa.date32())]), flavor="hive")
+
+
+def event_frame(reg, rem):
+    """
+        Combines the registrations and removals returned by a loader in fstats.py into the rows of
+        the event table. Columns other than org_id and date become attributes; empty values are
+        left out.
+    """
+
+    frames = []
+    for event_type, df in (("reg", reg), ("rem", rem)):
+        if df is None:
+            continue
+        extra = [c for c in df.columns if c not in ("org_id", "date")]
+        if extra:
+            attributes = [[(k, v) for k, v in zip(extra, values) if v != ""] for values in df[extra].itertuples(index=False)]
+        else:
+            attributes = [[]] * len(df)
+        frames.append(pd.DataFrame({
+            "org_id": df["org_id"].values,
+            "event_type": event_type,
+            "event_date": pd.to_datetime(df["date"]).dt.date.values,
+            "attributes": attributes,
+        }))
+    if not frames:
+        return pd.DataFrame({c: pd.Series(dtype=object) for c in fields})
+    return pd.concat(frames, ignore_index=True)
+
+
+def partition_path(folder, country, ddate):
+    return folder + "/country=" + country + "/snapshot_date=" + ddate
+
+
+def add_country(eventsfolder, country, folder, ddate):
+    """
+        Loads the events of one country from the snapshot in `folder` (data/<date>) and writes them
+        to its partition of the event table, replacing any earlier version of the partition.
+
+        Returns the number of events written.
+    """
+
+    if pa is None:
+        raise ImportError("pyarrow is required to write the event table")
+
+    reg, rem = fstats.loaders[country](folder, ddate)
+    df = event_frame(reg, rem)
+    table = pa.Table.from_pandas(df, schema=schema(), preserve_index=False)
+
+    target = partition_path(eventsfolder, country, ddate)
+    if os.path.isdir(target):
+        shutil.rmtree(target)
+    os.makedirs(target)
+    pa.parquet.write_table(table, target + "/part-0.parquet.part", compression="zstd")
+    os.replace(target + "/part-0.parquet.part", target + "/part-0.parquet")
+    return table.num_rows
+
+
+def build(eventsfolder, folder, ddate=None, countries=None):
+    """
+        Adds the snapshot in `folder` to the event table, one country at a time. Countries whose
+        files are missing or cannot be read are reported and left out.
+
+        Returns the number of events written for each country.
+    """
+
+    if pa is None:
+        raise ImportError("pyarrow is required to write the event table")
+
+    folder = folder.rstrip("/\\")
+    ddate = ddate or os.path.basename(folder)
+    summary = {}
+    countries = countries or list(fstats.countries)
+    for country in countries:
+        try:
+            summary[country] = add_country(eventsfolder, country, folder, ddate)
+            print("{}: {:,} events".format(fstats.countries[country]["label"], summary[country]))
+        except (OSError, KeyError, ValueError, ImportError) as e: # e.g., no reader for xlsx files
+            print("Could not add events for {}: {}".format(fstats.countries[country]["label"], e))
+    skipped = [fstats.countries[c]["label"] for c in countries if c not in summary]
+    if skipped:
+        print("Skipped {} of {} jurisdictions: {}".format(len(skipped), len(countries), ", ".join(skipped)))
+    return summary
+
+
+def read(eventsfolder, countries=None, ddate=None, columns=None):
+    """
+        Reads the event table (or only some countries or one snapshot date) into a dataframe.
+    """
+
+    if pa is None:
+        raise ImportError("pyarrow is required to read the event table")
+
+    dataset = pa.dataset.dataset(eventsfolder, format="parquet", partitioning=partitioning())
+    condition = None
+    if countries:
+        condition = pa.dataset.field("country").isin(countries)
+    if ddate:
+        on_date = pa.dataset.field("snapshot_date") == pa.scalar(pd.Timestamp(ddate).date(), pa.date32())
+        condition = on_date if condition is None else condition & on_date
+    return dataset.to_table(columns=columns, filter=condition).to_pandas()
+
+
+def snapshots(eventsfolder):
+    """
+        Returns the snapshot dates in the event table for each country.
+    """
+
+    dates = {}
+    for part in sorted(os.listdir(eventsfolder)):
+        if part.startswith("country=") and os.path.isdir(eventsfolder + "/" + part):
+            dates[part[8:]] = sorted(d[14:] for d in os.listdir(eventsfolder + "/" + part) if d.startswith("snapshot_date="))
+    return dates
+
+
+def counts(eventsfolder, ddate, freq="M", countries=None):
+    """
+        Counts events by country, type and month ("M") or year ("Y") in one scan of a snapshot of
+        the event table. Returns a dataframe with columns country, event_type, period, count and
+        first (the earliest date in the period).
+    """
+
+    df = read(eventsfolder, countries, ddate, columns=["country", "event_type", "event_date"]).dropna(subset=["event_date"])
+    dates = pd.to_datetime(df["event_date"])
+    df = dates.groupby([df["country"].astype(str), df["event_type"], dates.dt.to_period(freq).rename("period")]).agg(["count", "min"])
+    df.columns = ["count", "first"]
+    return df.reset_index().sort_values(["country", "event_type", "period"])
+
+
+def country_statistics(eventsfolder, ddate, outfolder, countries=None):
+    """
+        Computes the monthly statistics for each country in a snapshot of the event table, as
+        fstats.country_statistics() does from the registers, and writes them to
+        `<outfolder>/<country>-monthly-statistics-<date>.csv`.
+    """
+
+    monthly = counts(eventsfolder, ddate, "M", countries)
+    outfiles = []
+    for country, df in monthly.groupby("country"):
+        months = {}
+        for event in ("reg", "rem"):
+            e = df.loc[df["event_type"] == event]
+            months[event] = pd.DataFrame({"count": e["count"].values, "first": e["first"].values},
+                index=pd.PeriodIndex(e["period"], freq="M", name="period")) if len(e) else None
+        outfile = outfolder + "/" + fstats.countries[country]["file"] + "-monthly-statistics-" + ddate + ".csv"
+        fstats.to_csv(fstats.statistics(country, months["reg"], months["rem"]), outfile)
+        print("Monthly statistics: '{}'".format(outfile))
+        outfiles.append(outfile)
+    return outfiles
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Keep one event table of registrations and removals for every jurisdiction.")
+    parser.add_argument("--events", default="data/events", help="folder of the event table")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("add", help="add snapshot folders to the event table")
+    p.add_argument("folders", nargs="+", help="e.g. data/2021-01-28")
+    p.add_argument("--countries", nargs="+", choices=list(fstats.countries), default=list(fstats.countries))
+
+    p = commands.add_parser("counts", help="write counts of events by country, type and period")
+    p.add_argument("date", help="snapshot date, e.g. 2021-01-28")
+    p.add_argument("--freq", choices=["M", "Y"], default="M", help="monthly (M) or yearly (Y) counts")
+    p.add_argument("--out", default=None, help="csv file for the counts (default: print them)")
+
+    p = commands.add_parser("statistics", help="compute monthly excess-events statistics from the event table")
+    p.add_argument("date", help="snapshot date, e.g. 2021-01-28")
+    p.add_argument("--out", default=".", help="folder for the statistics files")
+    p.add_argument("--countries", nargs="+", choices=list(fstats.countries), default=None)
+    args = parser.parse_args()
+
+    if args.command == "add":
+        for folder in args.folders:
+            build(args.events, folder, countries=args.countries)
+    elif args.command == "counts":
+        df = counts(args.events, args.date, args.freq)
+        if args.out:
+            df.to_csv(args.out, index=False)
+        else:
+            print(df.to_string(index=False))
+    else:
+        country_statistics(args.events, args.date, args.out, args.countries)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+# -*- coding: latin-1 -*-
+"""
+    Project: The impact of COVID-19 on the foundation and dissolution of charitable organisations
+
+    Website: https://diarmuidm.github.io/charity-covid-19/
+
+    Creator: Diarmuid McDonnell
+
+    Collaborators: Alasdair Rutherford
+
+    File: fimport-benchmark.py
+
+    Description: This file compares the in-memory and streaming .bcp to .csv converters in fimport.py
+                 on a synthetic Charity Commission data extract.
+"""
+
+# Import packages #
+
+import multiprocessing as mp
+import argparse
+import hashlib
+import zipfile
+import random
+import time
+import os
+import fimport
+
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+
+# Define functions #
+
+def make_extract(zip_file, size_mb, table="extract_charity"):
+    """
+        Creates a zip file containing one synthetic .bcp table of (roughly) the requested size.
+
+        Takes two mandatory and one optional argument:
+            - Path of the zip file to create [mandatory]
+            - Uncompressed size of the .bcp table in megabytes [mandatory]
+            - Name of the table, which determines the number of columns; default is extract_charity [optional]
+    """
+
+    ncols = len(fimport.cc_files[table])
+    target = size_mb * 1024 * 1024
+    written = 0
+    rows = 0
+    rng = random.Random(2020)
+    words = ["charity", "trust", "fund", "\"friends\"", "c:\\path", "\u00e9cole", "hall", "society", "relief", "1,000"]
+
+    with zipfile.ZipFile(zip_file, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as zf:
+        with zf.open(table + ".bcp", "w", force_zip64=True) as f:
+            while written < target:
+                lines = []
+                for i in range(1000):
+                    fields = [str(rows + i)] + [" ".join(rng.choice(words) for w in range(rng.randint(1, 6))) for c in range(ncols - 1)]
+                    lines.append("@**@".join(fields) + "*@@*")
+                block = "".join(lines).encode("utf-8")
+                f.write(block)
+                written += len(block)
+                rows += 1000
+
+    return rows, written
+
+
+def run_method(zip_file, dfolder, stream, size, processes, queue):
+    """
+        Converts the extract with one of the methods and reports time, peak memory and a digest of
+        the output. Executed in a fresh process so that peak memory is not shared between methods.
+    """
+
+    fimport.chunksize = size
+    start = time.perf_counter()
+    fimport.import_zip(zip_file, dfolder, stream=stream, processes=processes)
+    duration = time.perf_counter() - start
+
+    peak = None
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # ru_maxrss is in kilobytes on Linux
+
+    digest = hashlib.sha256()
+    nbytes = 0
+    for file in sorted(os.listdir(dfolder)):
+        with open(os.path.join(dfolder, file), "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+                nbytes += len(block)
+        os.remove(os.path.join(dfolder, file))
+
+    queue.put({"duration": duration, "peak_mb": peak, "digest": digest.hexdigest(), "bytes": nbytes})
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark the .bcp to .csv converters in fimport.py.")
+    parser.add_argument("--size-mb", type=int, default=2048, help="uncompressed size of the synthetic table")
+    parser.add_argument("--folder", default="fimport-benchmark", help="folder for the synthetic extract and output")
+    parser.add_argument("--chunksize", type=int, default=fimport.chunksize, help="characters read at a time by the streaming converter")
+    parser.add_argument("--processes", type=int, default=1, help="number of processes used to convert tables")
+    parser.add_argument("--methods", nargs="+", choices=["memory", "stream"], default=["memory", "stream"])
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.folder):
+        os.mkdir(args.folder)
+    zip_file = args.folder + "/extract-" + str(args.size_mb) + "mb.zip"
+    dfolder = args.folder + "/output"
+    if not os.path.isdir(dfolder):
+        os.mkdir(dfolder)
+
+    if os.path.isfile(zip_file):
+        print("Using existing synthetic extract: {}".format(zip_file))
+    else:
+        print("Creating synthetic extract: {}".format(zip_file))
+        rows, written = make_extract(zip_file, args.size_mb)
+        print("{:,} rows, {:,} bytes uncompressed".format(rows, written))
+
+
+    # Run each method in a fresh process
+
+    ctx = mp.get_context("spawn")
+    results = {}
+    for method in args.methods:
+        queue = ctx.Queue()
+        p = ctx.Process(target=run_method, args=(zip_file, dfolder, method == "stream", args.chunksize, args.processes, queue))
+        p.start()
+        results[method] = queue.get()
+        p.join()
+
+    print("\r")
+    print("{:<8} {:>12} {:>14} {:>16}".format("method", "seconds", "peak RSS (MB)", "output (bytes)"))
+    for method, r in results.items():
+        peak = "{:.0f}".format(r["peak_mb"]) if r["peak_mb"] is not None else "n/a"
+        print("{:<8} {:>12.1f} {:>14} {:>16,}".format(method, r["duration"], peak, r["bytes"]))
+
+    if len(set(r["digest"] for r in results.values())) == 1:
+        print("Outputs are identical")
+    else:
+        print("WARNING: outputs differ")
+
+
+# Main program #
+
+if __name__ == "__main__":
+    main()
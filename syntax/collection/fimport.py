@@ -1,7 +1,21 @@
 from datetime import datetime as dt
 import zipfile
-import sys
 import csv
+import os
+import codecs
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import pandas as pd
+import fmetrics
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError: # only needed for Parquet and Arrow output
+    pa = None
 
 #######Program#######
 
@@ -158,6 +172,30 @@ cc_files = {
 }
 
 
+# Columns converted to typed values when tables are written to Parquet or Arrow files
+
+cc_dates = ["submit_date", "fystart", "fyend", "incomedate", "regdate", "remdate"]
+
+cc_money = ["income", "expend", "inc_leg", "inc_end", "inc_vol", "inc_fr", "inc_char", "inc_invest",
+    "inc_other", "inc_total", "invest_gain", "asset_gain", "pension_gain", "exp_vol", "exp_trade",
+    "exp_invest", "exp_grant", "exp_charble", "exp_gov", "exp_other", "exp_total", "exp_support",
+    "exp_dep", "reserves", "asset_open", "asset_close", "fixed_assets", "open_assets", "invest_assets",
+    "cash_assets", "current_assets", "credit_1", "credit_long", "pension_assets", "total_assets",
+    "funds_end", "funds_restrict", "funds_unrestrict", "funds_total"]
+
+cc_counts = ["employees", "volunteers"]
+
+
+chunksize = 4 * 1024 * 1024 # characters read from each .bcp file at a time
+
+lineterminator='*@@*'
+delimiter='@**@'
+quote='"'
+newdelimiter=','
+escapechar='\\'
+newline='\n'
+
+
 def to_file(bcpdata, dfolder, csvfilename='converted.csv', col_headers=None):
 
     csvfilename_path = dfolder + "/" + csvfilename
@@ -170,31 +208,215 @@ def to_file(bcpdata, dfolder, csvfilename='converted.csv', col_headers=None):
         csvfile.write(bcpdata)
 
 
-def import_zip(zip_file, dfolder):
-    
-    zf = zipfile.ZipFile(zip_file, 'r')
+def bcp_to_csv(bcpdata):
+    """
+        Converts the whole of a decoded .bcp file to csv in memory.
+    """
+
+    bcpdata = bcpdata.replace(escapechar, escapechar + escapechar)
+    bcpdata = bcpdata.replace(quote, escapechar + quote)
+    bcpdata = bcpdata.replace(delimiter, quote + newdelimiter + quote)
+    bcpdata = bcpdata.replace(lineterminator, quote + newline + quote)
+    return quote + bcpdata + quote
+
+
+def safe_cut(text, old):
+    """
+        Returns the position up to which `text` can be passed to str.replace(old, ...) without
+        splitting an occurrence of `old`; the rest is carried over to the next chunk.
+    """
+
+    cut = len(text) - len(old) + 1
+    while cut > 0:
+        s = text.find(old, max(0, cut - len(old) + 1), cut + len(old) - 1)
+        if s == -1:
+            return cut
+        cut = s
+    return 0
+
+
+def stream_bcp_to_csv(bcpfile, csvfile, size=None):
+    """
+        Converts a .bcp file to csv a chunk at a time, so memory use does not depend on the size
+        of the file. Delimiters and line terminators that straddle two chunks are carried over to
+        the next chunk. The output is identical to bcp_to_csv().
+
+        Returns the number of line terminators converted (i.e., rows).
+    """
+
+    size = size or chunksize
+    decoder = codecs.getincrementaldecoder('utf-8')(errors="replace")
+    delimited = '' # text carried over from the delimiter pass
+    terminated = '' # text carried over from the line terminator pass
+    rows = 0
+
+    csvfile.write(quote)
+    while True:
+        data = bcpfile.read(size)
+        final = not data
+        text = decoder.decode(data, final=final)
+        text = text.replace(escapechar, escapechar + escapechar).replace(quote, escapechar + quote)
+
+        text = delimited + text
+        cut = len(text) if final else safe_cut(text, delimiter)
+        delimited = text[cut:]
+        text = terminated + text[:cut].replace(delimiter, quote + newdelimiter + quote)
+
+        cut = len(text) if final else safe_cut(text, lineterminator)
+        terminated = text[cut:]
+        text = text[:cut]
+        rows += text.count(lineterminator)
+        csvfile.write(text.replace(lineterminator, quote + newline + quote))
+
+        if final:
+            break
+    csvfile.write(quote)
+
+    return rows
+
+
+def cc_schema(filename):
+    """
+        Returns the Arrow schema of a table: dates as timestamps, money fields as floats, staff
+        and volunteer numbers as integers and everything else as strings.
+    """
+
+    fields = []
+    for c in cc_files[filename]:
+        if c in cc_dates:
+            fields.append(pa.field(c, pa.timestamp('s')))
+        elif c in cc_money:
+            fields.append(pa.field(c, pa.float64()))
+        elif c in cc_counts:
+            fields.append(pa.field(c, pa.int64()))
+        else:
+            fields.append(pa.field(c, pa.string()))
+    return pa.schema(fields)
 
-    for filename in cc_files:
+
+def csv_to_columnar(csvfilename_path, outfilename_path, filename, output='parquet'):
+    """
+        Converts a csv file created by stream_bcp_to_csv() to a typed, compressed Parquet or
+        Arrow IPC file, a block of rows at a time.
+
+        Returns the number of rows written.
+    """
+
+    if pa is None:
+        raise ImportError("pyarrow is required to write %s files" % output)
+
+    schema = cc_schema(filename)
+    skipped = []
+    read_options = pa.csv.ReadOptions(block_size=chunksize)
+    parse_options = pa.csv.ParseOptions(quote_char=quote, escape_char=escapechar, double_quote=False,
+        newlines_in_values=True, invalid_row_handler=lambda row: skipped.append(row.text) or 'skip')
+    convert_options = pa.csv.ConvertOptions(column_types={c: pa.string() for c in cc_files[filename]},
+        strings_can_be_null=False)
+    reader = pa.csv.open_csv(csvfilename_path, read_options=read_options, parse_options=parse_options,
+        convert_options=convert_options)
+
+    if output == 'parquet':
+        writer = pa.parquet.ParquetWriter(outfilename_path, schema, compression='zstd')
+    else:
+        writer = pa.ipc.new_file(outfilename_path, schema, options=pa.ipc.IpcWriteOptions(compression='zstd'))
+
+    rows = 0
+    with writer:
+        for batch in reader:
+            df = batch.to_pandas()
+            for c in df.columns:
+                if c in cc_dates:
+                    df[c] = pd.to_datetime(df[c], errors='coerce').astype('datetime64[s]')
+                elif c in cc_money:
+                    df[c] = pd.to_numeric(df[c], errors='coerce')
+                elif c in cc_counts:
+                    df[c] = pd.to_numeric(df[c], errors='coerce').round().astype('Int64')
+            table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+            writer.write_table(table)
+            rows += table.num_rows
+
+    # The converted csv always ends with an empty quoted line; anything else is worth reporting
+    skipped = [row for row in skipped if row.strip() != quote + quote]
+    if skipped:
+        print('WARNING: skipped %s malformed rows in %s' % (len(skipped), csvfilename_path))
+
+    return rows
+
+
+def convert_table(zip_file, dfolder, filename, stream=True, output='csv'):
+    """
+        Converts one table in the zip file to csv, or to Parquet or Arrow via a temporary csv file.
+        Opens the zip file itself so that tables can be converted in separate processes.
+
+        Returns a report of the conversion: table, whether it was found, rows and seconds taken.
+    """
+
+    bcp_filename = filename + '.bcp'
+    csv_filename = filename + '.csv'
+    report = {'table': filename, 'found': False, 'rows': 0, 'seconds': 0.0}
+    start = time.perf_counter()
+
+    with zipfile.ZipFile(zip_file, 'r') as zf:
       try:
-          bcp_filename = filename + '.bcp'
-          csv_filename = filename + '.csv'
-
-          bcpdata = zf.read(bcp_filename)
-          bcpdata = bcpdata.decode('utf-8', errors="replace")
-          lineterminator='*@@*'
-          delimiter='@**@'
-          quote='"'
-          newdelimiter=','
-          escapechar='\\'
-          newline='\n'
-          bcpdata = bcpdata.replace(escapechar, escapechar + escapechar)
-          bcpdata = bcpdata.replace(quote, escapechar + quote)
-          bcpdata = bcpdata.replace(delimiter, quote + newdelimiter + quote)
-          bcpdata = bcpdata.replace(lineterminator, quote + newline + quote)
-          bcpdata = quote + bcpdata + quote
-          
-          extractpath = to_file(bcpdata, dfolder, csvfilename=csv_filename, col_headers=cc_files[filename])
+          if stream: # convert a chunk at a time
+              with zf.open(bcp_filename) as bcpfile, open(dfolder + "/" + csv_filename, 'w', encoding='utf-8') as csvfile:
+                  writer = csv.writer(csvfile, lineterminator='\n')
+                  writer.writerow(cc_files[filename])
+                  report['rows'] = stream_bcp_to_csv(bcpfile, csvfile)
+          else: # read the whole file into memory
+              bcpdata = zf.read(bcp_filename)
+              bcpdata = bcpdata.decode('utf-8', errors="replace")
+              report['rows'] = bcpdata.count(lineterminator)
+              bcpdata = bcp_to_csv(bcpdata)
 
+              extractpath = to_file(bcpdata, dfolder, csvfilename=csv_filename, col_headers=cc_files[filename])
+
+          if output != 'csv':
+              csvfilename_path = dfolder + "/" + csv_filename
+              extension = '.parquet' if output == 'parquet' else '.arrow'
+              report['rows'] = csv_to_columnar(csvfilename_path, dfolder + "/" + filename + extension, filename, output)
+              os.remove(csvfilename_path)
+
+          report['found'] = True
           print('Converted: %s' % bcp_filename)
       except KeyError:
-          print('ERROR: Did not find %s in zip file' % bcp_filename)
\ No newline at end of file
+          print('ERROR: Did not find %s in zip file' % bcp_filename)
+
+    report['seconds'] = round(time.perf_counter() - start, 3)
+    return report
+
+
+def import_zip(zip_file, dfolder, stream=True, processes=1, output='csv'):
+    """
+        Converts each table in cc_files from the zip file to csv (output='csv'), or to typed
+        Parquet (output='parquet') or Arrow IPC (output='arrow') files. With processes > 1 the
+        tables are converted in a pool of processes, largest first; processes=None uses one per CPU.
+
+        Returns a list of conversion reports, one per table, in the order of cc_files.
+    """
+
+    with zipfile.ZipFile(zip_file, 'r') as zf:
+        sizes = {info.filename: info.file_size for info in zf.infolist()}
+    tables = sorted(cc_files, key=lambda filename: sizes.get(filename + '.bcp', 0), reverse=True)
+
+    if output not in ('csv', 'parquet', 'arrow'):
+        raise ValueError("output must be 'csv', 'parquet' or 'arrow'")
+
+    with fmetrics.stage('import_zip', jurisdiction='ew', output=output, processes=processes) as m:
+        if processes == 1:
+            reports = [convert_table(zip_file, dfolder, filename, stream, output) for filename in tables]
+        else:
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                reports = list(executor.map(convert_table, repeat(zip_file), repeat(dfolder), tables, repeat(stream), repeat(output)))
+        m['bytes'] = sum(sizes.get(report['table'] + '.bcp', 0) for report in reports if report['found'])
+        m['rows'] = sum(report['rows'] for report in reports if report['found'])
+
+    reports = sorted(reports, key=lambda report: list(cc_files).index(report['table']))
+
+    for report in reports:
+        if report['found']:
+            print('%-25s %12s rows %10.1f s' % (report['table'], format(report['rows'], ','), report['seconds']))
+            fmetrics.record({'stage': 'convert_table', 'jurisdiction': 'ew', 'table': report['table'], 'rows': report['rows'],
+                'bytes': sizes.get(report['table'] + '.bcp', 0), 'seconds': report['seconds'], 'success': True})
+
+    return reports
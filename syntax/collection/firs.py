@@ -0,0 +1,417 @@
+import argparse
+import zipfile
+import csv
+import io
+import re
+import os
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute
+    import pyarrow.csv
+    import pyarrow.parquet
+except ImportError: # only needed for Parquet output
+    pa = None
+
+#######Program#######
+
+# IRS files: the list of organisations whose exemption has been revoked, converted in one pass from
+# the downloaded zip file to a typed Parquet file (and the csv file the do-files import), and an
+# index of the rows of each EIN, so that a list of EINs can be matched with a binary search rather
+# than by sorting and merging the whole file.
+#
+# An EIN index is a numpy array of records sorted by EIN, saved as a .npy file so that it can be
+# memory-mapped (np.load(..., mmap_mode="r")) rather than read into memory.
+#
+# The NTEE index is built the same way from the business files of the exempt organisations master
+# file (eo1.csv to eo4.csv): one record per EIN with its NTEE code, NTEE major group, subsection and
+# ruling date, so that registrations and revocations can be split by NTEE major group without
+# reading the master file again.
+
+chunksize = 1 << 24 # bytes of the revocation list read at a time
+
+revoked_columns = ["EIN", "Legal_Name", "Doing_Business_As_Name", "Organization_Address", "City", "State", "ZIP_Code", "Country",
+    "Exemption_Type", "Revocation_Date", "Revocation_Posting_Date", "Exemption_Reinstatement_Date"]
+revoked_dates = ["Revocation_Date", "Revocation_Posting_Date", "Exemption_Reinstatement_Date"]
+date_formats = ["%d-%b-%Y", "%d/%m/%Y", "%Y-%m-%d"] # e.g. 15-MAY-2010
+
+business_columns = ["EIN", "SUBSECTION", "RULING", "NTEE_CD"]
+
+# NTEE major groups, as coded in the cleaning do-file: a code is given the group of the last of
+# these letters it contains (https://nccs.urban.org/project/national-taxonomy-exempt-entities-ntee-codes)
+ntee_groups = [("A", 1), ("B", 2), ("CD", 3), ("EFGH", 4), ("IJKLMNOP", 5), ("Q", 6), ("RSTUW", 7), ("X", 8), ("Y", 9), ("Z", 10)]
+ntee_labels = {1: "Arts, Culture, and Humanities", 2: "Education", 3: "Environment and Animals", 4: "Health", 5: "Human Services",
+    6: "International, Foreign Affairs", 7: "Public, Societal Benefit", 8: "Religion Related", 9: "Mutual/Membership Benefit",
+    10: "Unknown, Unclassified"}
+
+
+def parse_dates(column):
+    """
+        Converts an Arrow column of strings to timestamps, trying date_formats in turn. Values that
+        match none of them are left missing. Each distinct value is parsed once (a million
+        revocations have a few thousand distinct dates).
+    """
+
+    encoded = pa.compute.dictionary_encode(pa.compute.utf8_trim_whitespace(column))
+    uniques = pd.Series(encoded.dictionary.to_pylist(), dtype=object)
+    dates = pd.Series(pd.NaT, index=uniques.index, dtype="datetime64[s]")
+    for fmt in date_formats:
+        todo = dates.isna() & (uniques != "")
+        if not todo.any():
+            break
+        dates[todo] = pd.to_datetime(uniques[todo], format=fmt, errors="coerce")
+    return pa.array(dates, pa.timestamp("s"), from_pandas=True).take(encoded.indices)
+
+
+def ein_numbers(eins):
+    """
+        Returns EINs as integers (-1 where an EIN is not a number), so that they can be sorted and
+        searched as numbers whether or not they have leading zeros.
+    """
+
+    if pa is None:
+        return pd.to_numeric(pd.Series(eins, dtype=object), errors="coerce").fillna(-1).astype(np.int64).values
+    if not isinstance(eins, (pa.Array, pa.ChunkedArray)):
+        eins = pa.array(pd.Series(eins, dtype=object).astype(str), pa.string())
+    eins = pa.compute.utf8_trim_whitespace(eins)
+    valid = pa.compute.and_(pa.compute.utf8_is_digit(eins), pa.compute.less_equal(pa.compute.utf8_length(eins), 18))
+    return pa.compute.if_else(valid, eins, "-1").cast(pa.int64()).to_numpy()
+
+
+def ein_index(eins):
+    """
+        Returns an index of the rows of each EIN: an array of (ein, row) records sorted by EIN.
+    """
+
+    keys = ein_numbers(eins)
+    order = np.argsort(keys, kind="stable")
+    index = np.empty(len(keys), dtype=[("ein", np.int64), ("row", np.int64)])
+    index["ein"] = keys[order]
+    index["row"] = order
+    return index
+
+
+def write_index(path, index):
+    np.save(path + ".part.npy", index)
+    os.replace(path + ".part.npy", path)
+
+
+def open_index(path):
+    return np.load(path, mmap_mode="r")
+
+
+def lookup(index, eins):
+    """
+        Finds EINs in an index with a binary search. Returns the position in the index of the first
+        record of each EIN, or -1 for an EIN that is not in the index.
+    """
+
+    keys = ein_numbers(eins)
+    pos = np.searchsorted(index["ein"], keys)
+    found = pos < len(index)
+    found[found] = index["ein"][pos[found]] == keys[found]
+    return np.where(found, pos, -1)
+
+
+def ntee_major(code):
+    """
+        Returns the NTEE major group of an NTEE code, or 0 if it has none.
+    """
+
+    major = 0
+    for letters, group in ntee_groups:
+        if any(letter in code for letter in letters):
+            major = group
+    return major
+
+
+def ruling_months(column):
+    """
+        Converts an Arrow column of ruling dates (e.g. 200606 for June 2006) to months, leaving
+        values that are not a valid year and month missing.
+    """
+
+    values = pa.compute.utf8_trim_whitespace(column)
+    valid = pa.compute.and_(pa.compute.utf8_is_digit(values), pa.compute.equal(pa.compute.utf8_length(values), 6))
+    values = pa.compute.if_else(valid, values, "0").cast(pa.int64()).to_numpy()
+    year, month = values // 100, values % 100
+    months = np.full(len(values), np.datetime64("NaT"), dtype="datetime64[M]")
+    ok = (year > 0) & (month >= 1) & (month <= 12)
+    months[ok] = ((year[ok] - 1970) * 12 + month[ok] - 1).astype("datetime64[M]")
+    return months
+
+
+def ntee_records(batch):
+    """
+        Returns the rows of a batch of a business file as NTEE index records (unsorted).
+    """
+
+    # Each distinct NTEE code is mapped to its group once (there are a few hundred of them)
+    encoded = pa.compute.dictionary_encode(pa.compute.utf8_trim_whitespace(batch.column("NTEE_CD")))
+    codes = encoded.dictionary.to_pylist()
+    positions = encoded.indices.to_numpy(zero_copy_only=False)
+    subsection = pa.compute.utf8_trim_whitespace(batch.column("SUBSECTION"))
+    subsection = pa.compute.if_else(pa.compute.and_(pa.compute.utf8_is_digit(subsection), pa.compute.less_equal(pa.compute.utf8_length(subsection), 2)), subsection, "-1")
+
+    records = np.empty(batch.num_rows, dtype=ntee_dtype(max([len(c) for c in codes] + [1])))
+    records["ein"] = ein_numbers(batch.column("EIN"))
+    records["ntee_cd"] = np.array([c.encode("latin-1", "replace") for c in codes] or [b""], dtype="S")[positions]
+    records["ntee_maj"] = np.array([ntee_major(c) for c in codes] or [0], dtype=np.int8)[positions]
+    records["subsection"] = subsection.cast(pa.int8()).to_numpy()
+    records["ruling"] = ruling_months(batch.column("RULING"))
+    return records
+
+
+def ntee_dtype(width):
+    return [("ein", np.int64), ("ntee_cd", "S" + str(width)), ("ntee_maj", np.int8), ("subsection", np.int8), ("ruling", "datetime64[M]")]
+
+
+def ntee_index(files, outfile=None):
+    """
+        Builds the NTEE index of the exempt organisations business files (irs_businessfile_<n>.csv
+        or the master file), reading only the EIN, SUBSECTION, RULING and NTEE_CD columns a block
+        at a time. Rows without a numeric EIN are left out, and an EIN that appears more than once
+        keeps its first row, as the do-file's EIN-NTEE lookup does. If `outfile` is given, the
+        index is written to it as a .npy file.
+
+        Returns the index: an array of (ein, ntee_cd, ntee_maj, subsection, ruling) records sorted
+        by EIN, where ntee_maj is 0 and ruling is missing if unknown.
+    """
+
+    if pa is None:
+        raise ImportError("pyarrow is required to build the NTEE index")
+
+    read_options = pa.csv.ReadOptions(block_size=chunksize)
+    convert_options = pa.csv.ConvertOptions(include_columns=business_columns, column_types={c: pa.string() for c in business_columns},
+        strings_can_be_null=False)
+
+    parts = []
+    for file in files:
+        with pa.csv.open_csv(file, read_options=read_options, convert_options=convert_options) as reader:
+            for batch in reader:
+                parts.append(ntee_records(batch))
+    width = max([p.dtype["ntee_cd"].itemsize for p in parts] + [1])
+    records = np.concatenate([p.astype(ntee_dtype(width)) for p in parts]) if parts else np.empty(0, dtype=ntee_dtype(width))
+
+    records = records[np.argsort(records["ein"], kind="stable")]
+    keep = records["ein"] >= 0
+    keep[1:] &= records["ein"][1:] != records["ein"][:-1]
+    index = records[keep]
+
+    if outfile:
+        write_index(outfile, index)
+    return index
+
+
+def ntee(index, eins):
+    """
+        Looks up the NTEE code, major group, subsection and ruling date of each EIN in an NTEE
+        index. Returns a dataframe with one row per EIN, in the same order; EINs that are not in
+        the index have an empty NTEE code and major group 0.
+    """
+
+    pos = lookup(index, eins)
+    found = pos >= 0
+    records = np.zeros(len(pos), dtype=index.dtype)
+    records["ruling"] = np.datetime64("NaT")
+    records["subsection"] = -1
+    records[found] = index[pos[found]]
+    return pd.DataFrame({
+        "ein": np.asarray(eins),
+        "ntee_cd": np.char.decode(records["ntee_cd"], "latin-1"),
+        "ntee_maj": records["ntee_maj"],
+        "subsection": records["subsection"],
+        "ruling": records["ruling"].astype("datetime64[s]"),
+    })
+
+
+def ntee_path(folder, ddate):
+    return folder + "/usa/irs_ein_ntee_index_" + ddate + ".npy"
+
+
+class BlankLines:
+    """
+        Wraps a file opened for reading, noting whether it has a blank line (found) as it is read.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.found = False
+        self.tail = b"\n" # a blank first line counts too
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        if data and not self.found:
+            self.found = re.search(b"\n\r?\n", self.tail + data) is not None
+            self.tail = (self.tail + data)[-2:]
+        return data
+
+    @property
+    def closed(self):
+        return self.f.closed
+
+
+def csv_lines(batch):
+    """
+        Returns the rows of a batch as the bytes of a csv file, written as csv.writer writes them
+        (lines ending in \\r\\n), without creating a Python object for each value: only the few rows
+        with a value that needs quoting (a comma, a quote or a line break) go through csv.writer.
+    """
+
+    lines = pa.compute.binary_join_element_wise(*batch.columns, ",")
+    plain = pa.compute.and_(pa.compute.equal(pa.compute.count_substring(lines, ","), batch.num_columns - 1),
+        pa.compute.invert(pa.compute.match_substring_regex(lines, '["\r\n]')))
+    if len(lines) and not pa.compute.all(plain).as_py():
+        quoted = pa.compute.invert(plain)
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="")
+        fixed = []
+        for row in zip(*(c.to_pylist() for c in batch.filter(quoted).columns)):
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerow(row)
+            fixed.append(buffer.getvalue())
+        lines = pa.compute.replace_with_mask(lines, quoted, pa.array(fixed, pa.string()))
+    lines = pa.compute.binary_join_element_wise(lines, "\r\n", "")
+
+    # The values of a string array are stored one after the other, so the lines are already a csv file
+    offsets = np.frombuffer(lines.buffers()[1], dtype=np.int32)[lines.offset:lines.offset + len(lines) + 1]
+    return memoryview(lines.buffers()[2])[offsets[0]:offsets[-1]] if len(lines) else b""
+
+
+def revocations_to_columnar(zip_file, outfile, csvfile=None, member=None):
+    """
+        Converts the IRS list of revoked organisations (data-download-revocation.zip) to a typed
+        Parquet file, reading the pipe-delimited file straight from the zip file a block at a time.
+        Dates are parsed once and stored as timestamps; the other columns are kept as strings.
+        Rows with too few fields are padded with empty values, and the extra fields of rows with
+        too many are kept, separated by "|", in the last column; these rows are added at the end
+        of the file. Blank lines are left out.
+
+        If `csvfile` is given, the same rows are also written to it as a csv file with a header
+        (irs_revoked_exemp_orgs_<date>.csv, as imported by the do-files). If the file has blank
+        lines or rows with the wrong number of fields, the csv file is written again by
+        revocations_to_csv(), so that it holds every line as it is in the zip file. An EIN index
+        of the Parquet file is written to <outfile without .parquet>-ein-index.npy.
+
+        Returns the number of rows written.
+    """
+
+    if pa is None:
+        raise ImportError("pyarrow is required to write parquet files")
+
+    fields = [pa.field(c, pa.timestamp("s") if c in revoked_dates else pa.string()) for c in revoked_columns]
+    schema = pa.schema(fields)
+    skipped = []
+    read_options = pa.csv.ReadOptions(column_names=revoked_columns, block_size=chunksize)
+    parse_options = pa.csv.ParseOptions(delimiter="|", invalid_row_handler=lambda row: skipped.append(row.text) or "skip")
+    convert_options = pa.csv.ConvertOptions(column_types={c: pa.string() for c in revoked_columns}, strings_can_be_null=False)
+
+    eins = []
+    rows = 0
+    with zipfile.ZipFile(zip_file) as z:
+        member = member or [m for m in z.namelist() if m.lower().endswith(".txt")][0]
+        with z.open(member) as zf, pa.parquet.ParquetWriter(outfile + ".part", schema, compression="zstd") as writer:
+            f = BlankLines(zf) # Arrow leaves blank lines out, but csv.reader (and the csv file) keeps them
+            out = open(csvfile, "wb") if csvfile else None
+            try:
+                if out:
+                    out.write((",".join(revoked_columns) + "\r\n").encode())
+                reader = pa.csv.open_csv(f, read_options=read_options, parse_options=parse_options, convert_options=convert_options)
+                for batch in reader:
+                    if out:
+                        out.write(csv_lines(batch))
+                    columns = [parse_dates(batch.column(c)) if c in revoked_dates else batch.column(c) for c in revoked_columns]
+                    writer.write_batch(pa.RecordBatch.from_arrays(columns, schema=schema))
+                    eins.append(batch.column("EIN"))
+                    rows += batch.num_rows
+
+                # Rows with the wrong number of fields, as csv.reader reads them
+                ragged = [row for row in csv.reader(skipped, delimiter="|") if row]
+                if ragged:
+                    n = len(revoked_columns)
+                    ragged = [row + [""] * (n - len(row)) if len(row) < n else row[:n - 1] + ["|".join(row[n - 1:])] for row in ragged]
+                    batch = pa.RecordBatch.from_arrays([pa.array(list(c), pa.string()) for c in zip(*ragged)], names=revoked_columns)
+                    columns = [parse_dates(batch.column(c)) if c in revoked_dates else batch.column(c) for c in revoked_columns]
+                    writer.write_batch(pa.RecordBatch.from_arrays(columns, schema=schema))
+                    eins.append(batch.column("EIN"))
+                    rows += batch.num_rows
+            finally:
+                if out:
+                    out.close()
+    os.replace(outfile + ".part", outfile)
+
+    index = ein_index(pa.chunked_array(eins, pa.string()))
+    write_index(index_path(outfile), index)
+
+    if (skipped or f.found) and csvfile:
+        revocations_to_csv(zip_file, csvfile, member)
+    return rows
+
+
+def revocations_to_csv(zip_file, csvfile, member=None):
+    """
+        Writes the IRS list of revoked organisations to a csv file with a header, reading the
+        pipe-delimited file straight from the zip file. Used when pyarrow is not installed.
+
+        Returns the number of rows written.
+    """
+
+    rows = 0
+    with zipfile.ZipFile(zip_file) as z:
+        member = member or [m for m in z.namelist() if m.lower().endswith(".txt")][0]
+        with z.open(member) as f, open(csvfile, "w", newline="") as out:
+            writer = csv.writer(out)
+            writer.writerow(revoked_columns)
+            for row in csv.reader(io.TextIOWrapper(f, encoding="utf-8", newline=""), delimiter="|"):
+                writer.writerow(row)
+                rows += 1
+    return rows
+
+
+def index_path(parquetfile):
+    return parquetfile[:-len(".parquet")] + "-ein-index.npy" if parquetfile.endswith(".parquet") else parquetfile + "-ein-index.npy"
+
+
+def revocations(parquetfile, eins=None, columns=None):
+    """
+        Reads the revocation list converted by revocations_to_columnar(). If `eins` is given, only
+        the rows of those EINs are read, found with the EIN index rather than by scanning the file.
+    """
+
+    if eins is None:
+        return pa.parquet.read_table(parquetfile, columns=columns).to_pandas()
+
+    index = open_index(index_path(parquetfile))
+    keys = np.unique(ein_numbers(eins))
+    start = np.searchsorted(index["ein"], keys, side="left")
+    end = np.searchsorted(index["ein"], keys, side="right")
+    rows = np.sort(np.concatenate([index["row"][s:e] for s, e in zip(start, end) if e > s] or [np.array([], dtype=np.int64)]))
+
+    # Read only the row groups that hold those rows
+    pf = pa.parquet.ParquetFile(parquetfile)
+    offsets = np.cumsum([0] + [pf.metadata.row_group(i).num_rows for i in range(pf.num_row_groups)])
+    group = np.searchsorted(offsets, rows, side="right") - 1
+    groups = np.unique(group)
+    table = pf.read_row_groups(groups.tolist(), columns=columns)
+    starts = np.cumsum(np.concatenate([[0], np.diff(offsets)[groups]]))[:-1] # of each group read, in `table`
+    positions = starts[np.searchsorted(groups, group)] + rows - offsets[group]
+    return table.take(positions).to_pandas()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Convert the IRS list of revoked organisations to a typed Parquet file with an EIN index.")
+    parser.add_argument("zipfile", help="e.g. data/2021-01-28/usa/data-download-revocation.zip")
+    parser.add_argument("outfile", help="e.g. data/2021-01-28/usa/irs_revoked_exemp_orgs_2021-01-28.parquet")
+    parser.add_argument("--csv", default=None, help="also write the rows to this csv file")
+    args = parser.parse_args()
+
+    rows = revocations_to_columnar(args.zipfile, args.outfile, args.csv)
+    print("{:,} rows: '{}'".format(rows, args.outfile))
+
+
+if __name__ == "__main__":
+    main()
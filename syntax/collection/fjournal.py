@@ -0,0 +1,85 @@
+import threading
+import hashlib
+import json
+import time
+import os
+
+#######Program#######
+
+# Journal of the steps completed in a run (a jurisdiction, a table of the CCEW extract, an NI web
+# page), so that a run that stops partway can be resumed: steps that finished, and whose files are
+# unchanged, are skipped and everything else is done again.
+#
+# The journal is a JSON lines file (log/run-journal-<date>.jsonl) that is only ever appended to; the
+# latest entry for a step is the one that counts.
+
+
+def file_sha256(path):
+    checksum = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+def range_sha256(path, offset, length):
+    with open(path, "rb") as f:
+        f.seek(offset)
+        data = f.read(length)
+    return hashlib.sha256(data).hexdigest() if len(data) == length else None
+
+
+class Journal:
+    """
+        Record of the steps of a run. Safe to use from several threads.
+
+        record(step, "done", paths=[...]) stores the size and checksum of each file produced by
+        the step, and ranges=[(path, offset, length), ...] the checksum of each part of a file it
+        appended to (e.g., a page in a page archive); done(step) is True only if the step finished
+        and those files and parts of files are still there with the same checksums.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.steps = {}
+        if os.path.isfile(path):
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError: # incomplete last line if the run was killed while writing
+                        continue
+                    self.steps[entry["step"]] = entry
+
+    def record(self, step, status, paths=None, ranges=None, **info):
+        entry = {"step": step, "status": status, "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+        if paths:
+            entry["files"] = {p: [os.path.getsize(p), file_sha256(p)] for p in paths if os.path.isfile(p)}
+        if ranges:
+            entry["ranges"] = [[p, offset, length, range_sha256(p, offset, length)] for p, offset, length in ranges]
+        entry.update(info)
+        line = json.dumps(entry)
+        with self.lock:
+            self.steps[step] = entry
+            with open(self.path, "a") as f:
+                f.write(line + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def done(self, step):
+        with self.lock:
+            entry = self.steps.get(step)
+        if entry is None or entry["status"] != "done":
+            return False
+        for p, (size, sha256) in entry.get("files", {}).items():
+            if not os.path.isfile(p) or os.path.getsize(p) != size or file_sha256(p) != sha256:
+                return False
+        for p, offset, length, sha256 in entry.get("ranges", []):
+            if not os.path.isfile(p) or range_sha256(p, offset, length) != sha256:
+                return False
+        return True
+
+    def failed(self, prefix=""):
+        with self.lock:
+            return sorted(step for step, entry in self.steps.items() if entry["status"] == "failed" and step.startswith(prefix))
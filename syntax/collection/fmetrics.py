@@ -0,0 +1,159 @@
+from contextlib import contextmanager
+import threading
+import argparse
+import json
+import time
+import sys
+import os
+
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+#######Program#######
+
+# Metrics for each stage of a run (a download, a conversion, a parse): wall time, bytes, rows,
+# retries and memory, written as one JSON object per line to the file in `path`. If `path` is None
+# (the default) metrics are measured but not written.
+#
+# Memory is measured for the process, not the stage: process_peak_rss_mb is the high-water mark of
+# the whole process when the stage finished, and rss_change_mb the change in resident memory over
+# the stage. While jurisdictions are downloaded at the same time the change includes the memory
+# used by the stages running alongside.
+
+path = None
+lock = threading.Lock()
+
+
+def peak_rss():
+    """
+        Returns the peak resident memory (MB) of this process or any of its finished child processes
+        so far (the high-water mark of the whole run, not of one stage), or None where this cannot be
+        measured.
+    """
+
+    if resource is None:
+        return None
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024 # ru_maxrss is in bytes on macOS, kilobytes on Linux
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return round(peak / scale, 1)
+
+
+def current_rss():
+    """
+        Returns the resident memory (MB) of this process now, or None where this cannot be measured
+        (it is read from /proc, so only on Linux).
+    """
+
+    try:
+        with open("/proc/self/statm", "r") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+
+def start(metricsfile):
+    """
+        Sets the file that metrics are appended to for the rest of the run.
+    """
+
+    global path
+    path = metricsfile
+
+
+def record(entry):
+    if path is None:
+        return
+    line = json.dumps(entry)
+    with lock:
+        with open(path, "a") as f:
+            f.write(line + "\n")
+
+
+@contextmanager
+def stage(name, **labels):
+    """
+        Measures a stage of the run. Yields a dict to which the stage adds what it knows about its
+        work (e.g., m["bytes"] += nbytes, m["rows"] = rows, m["retries"] += 1); the wall time, the
+        memory of the process and whether the stage raised an exception are added when it finishes.
+
+            with fmetrics.stage("ni_removed") as m:
+                ...
+                m["rows"] = len(rows)
+    """
+
+    m = {"stage": name}
+    m.update(labels)
+    m.update({"bytes": 0, "rows": 0, "retries": 0})
+    started = time.strftime("%Y-%m-%dT%H:%M:%S")
+    t = time.perf_counter()
+    rss = current_rss()
+    try:
+        yield m
+        m.setdefault("success", True)
+    except BaseException as e:
+        m["success"] = False
+        m["error"] = "{}: {}".format(type(e).__name__, e)
+        raise
+    finally:
+        m["started"] = started
+        m["seconds"] = round(time.perf_counter() - t, 3)
+        m["process_peak_rss_mb"] = peak_rss()
+        end = current_rss()
+        m["rss_change_mb"] = None if rss is None or end is None else round(end - rss, 1)
+        record(m)
+
+
+def summary(metricsfile):
+    """
+        Returns the metrics in a file totalled by stage (and jurisdiction, where there is one).
+    """
+
+    totals = {}
+    with open(metricsfile, "r") as f:
+        for line in f:
+            try:
+                m = json.loads(line)
+            except ValueError:
+                continue
+            key = (m["stage"], m.get("jurisdiction", ""))
+            t = totals.setdefault(key, {"stage": key[0], "jurisdiction": key[1], "count": 0, "failed": 0,
+                "seconds": 0.0, "bytes": 0, "rows": 0, "retries": 0, "process_peak_rss_mb": None, "rss_change_mb": None})
+            t["count"] += 1
+            t["failed"] += 0 if m.get("success", True) else 1
+            for k in ("seconds", "bytes", "rows", "retries"):
+                t[k] += m.get(k) or 0
+            peak = m.get("process_peak_rss_mb", m.get("peak_rss_mb")) # peak_rss_mb in files written before it was renamed
+            if peak is not None:
+                t["process_peak_rss_mb"] = max(t["process_peak_rss_mb"] or 0, peak)
+            if m.get("rss_change_mb") is not None:
+                t["rss_change_mb"] = max(t["rss_change_mb"] if t["rss_change_mb"] is not None else m["rss_change_mb"], m["rss_change_mb"])
+    return sorted(totals.values(), key=lambda t: -t["seconds"])
+
+
+def print_summary(metricsfile):
+    print("{:<16} {:<12} {:>7} {:>7} {:>10} {:>16} {:>12} {:>8} {:>15} {:>11}".format(
+        "stage", "jurisdiction", "count", "failed", "seconds", "bytes", "rows", "retries", "process peak MB", "max RSS +MB"))
+    for t in summary(metricsfile):
+        print("{:<16} {:<12} {:>7} {:>7} {:>10.1f} {:>16,} {:>12,} {:>8} {:>15} {:>11}".format(t["stage"], t["jurisdiction"],
+            t["count"], t["failed"], t["seconds"], t["bytes"], t["rows"], t["retries"],
+            "n/a" if t["process_peak_rss_mb"] is None else "{:.0f}".format(t["process_peak_rss_mb"]),
+            "n/a" if t["rss_change_mb"] is None else "{:.0f}".format(t["rss_change_mb"])))
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Summarise the metrics file of a run.")
+    parser.add_argument("files", nargs="+", help="e.g. data/2021-01-28/log/metrics-2021-01-28.jsonl")
+    args = parser.parse_args()
+
+    for metricsfile in args.files:
+        print(metricsfile)
+        print_summary(metricsfile)
+        print("\r")
+
+
+if __name__ == "__main__":
+    main()
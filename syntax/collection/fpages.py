@@ -0,0 +1,224 @@
+from bs4 import BeautifulSoup as soup
+import threading
+import hashlib
+import html
+import json
+import zlib
+import csv
+import os
+import pandas as pd
+import re
+
+try:
+    import lxml
+except ImportError: # BeautifulSoup falls back to the standard library's parser
+    lxml = None
+
+#######Program#######
+
+# The removal sentence on a removed charity's web page, e.g. "Removed on 01 Sep 2020". The regex is
+# tried first; BeautifulSoup is used if it does not match or the div contains nested divs.
+
+removed_class = "pcg-charity-details__purpose pcg-charity-details__purpose--removed pcg-contrast__color-main"
+removed_div = re.compile(r'<div[^>]*class="' + re.escape(removed_class) + r'"[^>]*>(.*?)</div>', re.S)
+html_tag = re.compile(r"<[^>]+>")
+
+# Fallbacks for removal sentences that do not end with a date like 01Sep2020
+date_words = re.compile(r"(?P<day>\d{1,2})(?:st|nd|rd|th)?\s+(?P<month>[A-Za-z]{3,9})\.?,?\s+(?P<year>\d{4})")
+date_numbers = re.compile(r"(?P<day>\d{1,2})[/.-](?P<month>\d{1,2})[/.-](?P<year>\d{4})")
+
+bs_parser = "lxml" if lxml is not None else "html.parser"
+
+# Index of the web pages saved by the crawler: one row per page, appended as each page is saved
+page_name = re.compile(r"^ni-charity-(\d+)-(\d{4}-\d{2}-\d{2})\.txt$")
+index_name = "ni-webpages-index.csv"
+index_fields = ["regid", "file", "date", "size", "sha256", "offset", "length"]
+index_lock = threading.Lock()
+
+
+def ni_removed_sentence(data):
+    """
+        Returns the text of the removal sentence on a charity's CCNI web page, or None if the page
+        does not contain one.
+    """
+
+    match = removed_div.search(data)
+    if match is not None and "<div" not in match.group(1):
+        return html.unescape(html_tag.sub("", match.group(1)))
+
+    soup_org = soup(data, bs_parser) # Parse the text as a BS object.
+    div = soup_org.find("div", class_=removed_class)
+    return div.text if div is not None else None
+
+
+def ni_removed_text(page):
+    """
+        Reads a charity's web page and returns the text of its removal sentence, or None if the page
+        does not contain one. `page` is the path of a .txt file or a row of the page index (see
+        page_index), which may point into a page archive.
+    """
+
+    if isinstance(page, dict):
+        data = read_page(page)
+    else:
+        with open(page, "r", encoding = "ISO-8859-1") as f:
+            data = f.read()
+
+    return ni_removed_sentence(data)
+
+
+def parse_removed_dates(sentences):
+    """
+        Parses the removal sentences of many web pages at once and returns a Series of dates (NaT
+        where no date could be found).
+
+        The last 10 characters of the sentence without spaces are parsed as e.g. 01Sep2020 first, as
+        the sentences usually end with the date. Sentences that do not parse are then searched for a
+        date such as "1 Sept 2020", "1st September 2020" or "01/09/2020".
+    """
+
+    sentences = pd.Series(sentences, dtype=object).fillna("").astype(str)
+    compact = sentences.str.replace(" ", "", regex=False).str[-10:].str.strip()
+    dates = pd.to_datetime(compact, format="%d%b%Y", errors="coerce")
+
+    todo = dates.isna() & (sentences != "")
+    if todo.any():
+        words = sentences[todo].str.extract(date_words)
+        text = words["day"] + " " + words["month"].str[:3].str.title() + " " + words["year"]
+        dates[todo] = pd.to_datetime(text, format="%d %b %Y", errors="coerce")
+
+    todo = dates.isna() & (sentences != "")
+    if todo.any():
+        numbers = sentences[todo].str.extract(date_numbers)
+        text = numbers["day"] + "/" + numbers["month"] + "/" + numbers["year"]
+        dates[todo] = pd.to_datetime(text, format="%d/%m/%Y", errors="coerce")
+
+    return dates
+
+
+def ni_removed_page(path):
+    """
+        Reads a charity's web page (.txt file) and returns its removal date, or "" if the date
+        could not be found.
+    """
+
+    removed_date_sentence = ni_removed_text(path)
+    if removed_date_sentence is None:
+        return ""
+
+    date = parse_removed_dates([removed_date_sentence])[0]
+    return "" if pd.isna(date) else date.date()
+
+
+def index_page(webpagefolder, regid, file, ddate, data=None, offset="", length=""):
+    """
+        Adds a saved web page (file name within `webpagefolder`) to the folder's page index, with its
+        size and sha256 checksum. For a page in a page archive, `data` is the page and `offset` and
+        `length` give the position of its frame in the archive. Safe to call from several threads.
+    """
+
+    if data is None:
+        with open(os.path.join(webpagefolder, file), "rb") as f:
+            data = f.read()
+    row = [str(int(regid)), file, ddate, len(data), hashlib.sha256(data).hexdigest(), offset, length]
+
+    indexfile = os.path.join(webpagefolder, index_name)
+    with index_lock:
+        new = not os.path.isfile(indexfile)
+        with open(indexfile, "a", newline="") as f:
+            writer = csv.writer(f)
+            if new:
+                writer.writerow(index_fields)
+            writer.writerow(row)
+
+
+def build_page_index(webpagefolder):
+    """
+        Creates the page index of a folder of web pages saved before the crawler kept one, by
+        matching the file names (ni-charity-<regid>-<date>.txt) of the pages in the folder.
+    """
+
+    indexfile = os.path.join(webpagefolder, index_name)
+    if os.path.isfile(indexfile):
+        os.remove(indexfile)
+    for file in sorted(os.listdir(webpagefolder)):
+        match = page_name.match(file)
+        if match is not None:
+            index_page(webpagefolder, match.group(1), file, match.group(2))
+
+
+def page_index(webpagefolder):
+    """
+        Returns the page index of a folder of web pages as a dict of {regid (int): row}, where each
+        row has the page's path, date, size and checksum. The index is created if it does not exist.
+        If a page was saved more than once, the latest entry is used.
+    """
+
+    indexfile = os.path.join(webpagefolder, index_name)
+    if not os.path.isfile(indexfile):
+        build_page_index(webpagefolder)
+
+    index = {}
+    if not os.path.isfile(indexfile): # no web pages in the folder
+        return index
+    with open(indexfile, "r", newline="") as f:
+        for row in csv.DictReader(f):
+            row["path"] = os.path.join(webpagefolder, row["file"])
+            index[int(row["regid"])] = row
+    return index
+
+
+class PageArchive:
+    """
+        Append-only archive of the web pages downloaded for a snapshot, in place of one .txt file
+        and one metadata file per charity. Each page is a separate gzip member holding a line of
+        JSON (the response headers and request details) followed by the page, so the archive is
+        also a valid .gz file. Pages are added to the folder's page index with their offset and
+        length, so any page can be read without reading the rest of the archive.
+    """
+
+    def __init__(self, webpagefolder, ddate):
+        self.webpagefolder = webpagefolder
+        self.ddate = ddate
+        self.file = "ni-webpages-" + ddate + ".pages.gz"
+        self.path = os.path.join(webpagefolder, self.file)
+        self.lock = threading.Lock()
+
+    def append(self, regid, headers, text):
+        data = text.encode("utf-8")
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31) # 31: gzip container
+        frame = compressor.compress(json.dumps(headers).encode("utf-8") + b"\n" + data) + compressor.flush()
+        with self.lock:
+            with open(self.path, "ab") as f:
+                offset = f.tell()
+                f.write(frame)
+        index_page(self.webpagefolder, regid, self.file, self.ddate, data=data, offset=offset, length=len(frame))
+        return offset, len(frame)
+
+
+def read_frame(row):
+    with open(row["path"], "rb") as f:
+        f.seek(int(row["offset"]))
+        frame = f.read(int(row["length"]))
+    headers, data = zlib.decompress(frame, 31).split(b"\n", 1)
+    return json.loads(headers), data
+
+
+def read_page(row):
+    """
+        Returns the text of a web page from a row of the page index, reading it from the page archive
+        or from its .txt file.
+    """
+
+    if row.get("offset"):
+        return read_frame(row)[1].decode("utf-8")
+    with open(row["path"], "r", encoding = "ISO-8859-1") as f:
+        return f.read()
+
+
+def read_headers(row):
+    """
+        Returns the response headers and request details stored with a page in a page archive.
+    """
+
+    return read_frame(row)[0]
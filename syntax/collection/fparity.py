@@ -0,0 +1,212 @@
+import argparse
+import tempfile
+import os
+import numpy as np
+import pandas as pd
+import fstats
+
+#######Program#######
+
+# Checks fstats.py against monthly statistics files exported by Stata (data/*-monthly-statistics-<date>.csv).
+#
+# The registers behind the published files are not kept, so the monthly counts are rebuilt from the
+# files themselves: the counts from 2020m1 are in the files, and for each calendar month a set of
+# 2015-2019 counts is found whose baseline rounds up to the published avg, sd and bounds (see
+# baseline_counts()). The counts are then run through fstats.statistics() and fstats.to_csv() and
+# the output is compared byte for byte with the published file.
+#
+# This checks the statistics and the export (the excess and cumulative columns, the merges of
+# registrations and removals, the column order and the number formats) and that the published
+# baselines can be reached with the rounding used by fstats.monthly(). It does not check the loaders,
+# which need the registers themselves, and it cannot tell apart roundings that agree on the counts it
+# finds.
+
+years = 5 # calendar years in the baseline (2015-2019)
+
+# Shapes of the baseline counts tried by baseline_counts(), as the number of years with each value:
+# two values first, then three for the baselines that two values cannot reach
+patterns = [(n1, n - n1) for n in range(years, 1, -1) for n1 in range(1, n)]
+patterns += [(n1, n2, n - n1 - n2) for n in range(years, 2, -1) for n1 in range(1, n - 1) for n2 in range(1, n - n1)]
+
+
+def candidates(counts, m, mu):
+    """
+        Completes sets of baseline counts with m counts of one more value, chosen so that the
+        event-weighted mean (as in fstats.monthly()) is close to mu. `counts` is a list of arrays,
+        one per count already in the sets. Returns the counts and their mean and sd.
+    """
+
+    s1 = sum(c for c in counts)
+    s2 = sum(c ** 2 for c in counts)
+    disc = (mu * m) ** 2 - 4 * m * (s2 - mu * s1)
+    root = np.sqrt(np.where(disc > 0, disc, np.nan))
+    values = [np.floor((mu * m + sign * root) / (2 * m)) + k for sign in (-1, 1) for k in (-1, 0, 1, 2)]
+    counts = [np.tile(c, len(values)) for c in counts]
+    c = np.concatenate(values)
+    keep = np.isfinite(c) & (c >= 1)
+    counts = [x[keep] for x in counts] + [c[keep]] * m
+    total = sum(counts)
+    mean = sum(x ** 2 for x in counts) / total
+    var = sum(x * (x - mean) ** 2 for x in counts) / (total - 1)
+    return counts, mean, np.sqrt(var)
+
+
+def rounded(mean, sd):
+    """
+        Returns the baseline columns as fstats.monthly() rounds them: stored as floats, then rounded up.
+    """
+
+    avg = mean.astype(np.float32).astype(float)
+    sd = sd.astype(np.float32).astype(float)
+    return {
+        "avg": np.ceil(avg), "sd": np.ceil(sd),
+        "lb": np.ceil((avg - sd).astype(np.float32)), "ub": np.ceil((avg + sd).astype(np.float32)),
+        "lb_2": np.ceil((avg - 2 * sd).astype(np.float32)), "ub_2": np.ceil((avg + 2 * sd).astype(np.float32)),
+    }
+
+
+def baseline_counts(target):
+    """
+        Finds counts for the years of a calendar month's baseline whose event-weighted avg, sd and
+        bounds round up to the values in `target` (a dict of avg, sd, lb, ub and optionally lb_2 and
+        ub_2), trying the shapes in `patterns`. Returns a list of counts, or None if there is none of
+        those shapes.
+    """
+
+    avg, sd = int(target["avg"]), int(target["sd"])
+    if sd == 0:
+        r = rounded(np.array([avg], dtype=float), np.array([0.0]))
+        return [avg] * years if all(r[k][0] == v for k, v in target.items()) else None
+
+    for shape in patterns:
+        if len(shape) == 2:
+            grids = [np.arange(1, avg + 1, dtype=float)]
+        else:
+            a, b = np.meshgrid(np.arange(1, avg + 1, dtype=float), np.arange(1, avg + 4 * sd + 1, dtype=float))
+            grids = [a[a < b], b[a < b]]
+        fixed = [g for g, k in zip(grids, shape[:-1]) for _ in range(k)]
+        for mu in np.linspace(avg - 0.95, avg - 0.05, 10):
+            counts, mean, dev = candidates(fixed, shape[-1], mu)
+            r = rounded(mean, dev)
+            ok = np.ones(len(mean), dtype=bool)
+            for k, v in target.items():
+                ok &= r[k] == v
+            if ok.any():
+                i = np.flatnonzero(ok)[0]
+                return [int(c[i]) for c in counts]
+    return None
+
+
+def hidden(df, prefix, periods):
+    """
+        Returns the months that count towards the cumulative columns of a published file but are
+        not in it (e.g., months with registrations but no removals, which the inner merge of the two
+        drops), as a list of (month, count, avg). The counts and baselines of these months are only
+        known in total, so they are spread evenly over the months.
+    """
+
+    months = []
+    previous = pd.Period("2019-12", freq="M")
+    count_cumu = avg_cumu = 0
+    for period, (_, row) in zip(periods, df.iterrows()):
+        count = int(row[prefix + "_count_cumu"]) - count_cumu - int(row[prefix + "_count"])
+        avg = int(row[prefix + "_avg_cumu"]) - avg_cumu - int(row[prefix + "_avg"])
+        gap = pd.period_range(previous + 1, period - 1, freq="M")[:count]
+        for i, month in enumerate(gap):
+            months.append((month, count // len(gap) + (i < count % len(gap)), avg // len(gap) + (i < avg % len(gap))))
+        previous, count_cumu, avg_cumu = period, int(row[prefix + "_count_cumu"]), int(row[prefix + "_avg_cumu"])
+    return months
+
+
+def rebuild(df, prefix, bounds):
+    """
+        Rebuilds the monthly counts of one type of event (see fstats.aggregate()) from a published
+        statistics file. Returns the counts, or None and the calendar months for which no baseline
+        counts could be found.
+    """
+
+    df = df.loc[df[prefix + "_count"].notna()]
+    periods = pd.PeriodIndex([pd.Period(p.replace("m", "-"), freq="M") for p in df["period"]], name="period")
+    if prefix + "d" in df.columns:
+        first = pd.to_datetime(df[prefix + "d"].values, format="%d%b%Y")
+    else:
+        first = periods.to_timestamp()
+    current = pd.DataFrame({"count": df[prefix + "_count"].astype(int).values, "first": first}, index=periods)
+
+    rows, missing = [], []
+    for month, group in df.groupby(periods.month):
+        row = group.iloc[0]
+        target = {k: float(row[prefix + "_" + k]) for k in ["avg", "sd", "lb", "ub"] + (bounds if bounds else [])}
+        counts = baseline_counts(target)
+        if counts is None:
+            missing.append(month)
+            continue
+        rows += [(pd.Period(year=2019 - i, month=month, freq="M"), c) for i, c in enumerate(counts)]
+
+    # Months left out of the file get a baseline of the same count in each year
+    for period, count, avg in hidden(df, prefix, periods):
+        if period.month in periods.month:
+            missing.append(period.month)
+            continue
+        rows.append((period, count))
+        rows += [(pd.Period(year=2019 - i, month=period.month, freq="M"), avg) for i in range(years)]
+    if missing:
+        return None, missing
+
+    other = pd.PeriodIndex([r[0] for r in rows], name="period")
+    other = pd.DataFrame({"count": [r[1] for r in rows], "first": other.to_timestamp()}, index=other)
+    return pd.concat([other, current]).sort_index(), []
+
+
+def check(path):
+    """
+        Recomputes a published statistics file and returns the lines of the file that fstats.py does
+        not reproduce (an empty list if the output is byte-identical).
+    """
+
+    name = os.path.basename(path).split("-monthly-statistics-")[0]
+    country = [c for c, config in fstats.countries.items() if config["file"] == name][0]
+    bounds = fstats.bounds2 if fstats.countries[country].get("bounds2") else None
+    df = pd.read_csv(path, dtype=str, keep_default_na=False).replace("", np.nan)
+
+    reg, missing = rebuild(df, "reg", bounds)
+    rem = None
+    if "rem_count" in df.columns:
+        rem, rem_missing = rebuild(df, "rem", bounds)
+        missing += ["rem " + str(m) for m in rem_missing]
+    if missing:
+        return ["no baseline counts found for months {}".format(missing)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        out = os.path.join(tmp, os.path.basename(path))
+        fstats.to_csv(fstats.statistics(country, reg, rem), out)
+        with open(out, "r") as f:
+            ours = f.read().splitlines()
+    with open(path, "r") as f:
+        theirs = f.read().splitlines()
+
+    diffs = ["line {}: expected {} got {}".format(i + 1, t, o) for i, (t, o) in enumerate(zip(theirs, ours)) if t != o]
+    if len(theirs) != len(ours):
+        diffs.append("expected {} lines, got {}".format(len(theirs), len(ours)))
+    return diffs
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Check fstats.py against monthly statistics files exported by Stata.")
+    parser.add_argument("files", nargs="+", help="statistics files, e.g. data/*-monthly-statistics-2021-01-28.csv")
+    args = parser.parse_args()
+
+    failed = 0
+    for path in args.files:
+        diffs = check(path)
+        print("{}: {}".format(os.path.basename(path), "identical" if not diffs else "differs"))
+        for d in diffs:
+            print("    " + d)
+        failed += bool(diffs)
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,671 @@
+import argparse
+import hashlib
+import csv
+import json
+import zipfile
+import glob
+import re
+import os
+import numpy as np
+import pandas as pd
+import fxlsx
+import firs
+
+#######Program#######
+
+# Monthly excess-events statistics, computed as in char-excess-events-cleaning-2020-06-19.do:
+#
+#   - events before 2015m1 are ignored;
+#   - the baseline for a calendar month is the mean and standard deviation of that month's counts in
+#     2015-2019, taken over events (as egen does) rather than over years;
+#   - generated variables are stored as single precision floats and rounded up, as Stata does;
+#   - statistics are reported for months from 2020m1 that have events and a baseline.
+
+baseline_start = pd.Period("2015-01", freq="M")
+baseline_end = pd.Period("2020-01", freq="M")
+
+stats = ["count", "avg", "sd", "lb", "ub"]
+bounds2 = ["lb_2", "ub_2"]
+excess = ["excess", "excess_per", "excess_cumu", "avg_cumu", "count_cumu", "excess_cumu_per"]
+
+date_formats = {
+    "DMY": ["%d/%m/%Y", "%d-%m-%Y", "%d %b %Y", "%d %B %Y", "%d-%b-%Y", "%d%b%Y"],
+    "YMD": ["%Y-%m-%d", "%Y/%m/%d", "%Y%m%d"],
+    "YM": ["%Y%m", "%Y-%m"],
+}
+
+countries = {
+    "aus": {"label": "Australia", "file": "aus"},
+    "can": {"label": "Canada", "file": "can", "how": "left"},
+    "ew": {"label": "England and Wales", "file": "ew", "bounds2": True},
+    "ni": {"label": "Northern Ireland", "file": "ni"},
+    "nz": {"label": "New Zealand", "file": "nz"},
+    "roi": {"label": "Rep. of Ireland", "file": "roi"},
+    "sco": {"label": "Scotland", "file": "scot"},
+    "usa": {"label": "USA", "file": "us", "how": "left", "dates": True},
+}
+
+
+def varnames(df):
+    """
+        Renames columns the way Stata's import delimited does (e.g., "Reg charity number" becomes
+        "regcharitynumber"), so the same names can be used as in the do-files.
+    """
+
+    df.columns = [re.sub(r"[^a-z0-9_]", "", str(c).lower()) for c in df.columns]
+    return df
+
+
+def read_csv(path, **kwargs):
+    kwargs.setdefault("encoding", "ISO-8859-1")
+    return varnames(pd.read_csv(path, dtype=str, keep_default_na=False, index_col=False, **kwargs))
+
+
+def parse_dates(values, order="DMY"):
+    """
+        Converts strings to dates, trying the formats for `order` ("DMY", "YMD" or "YM") in turn, as
+        Stata's date() does. Values that match none of them are parsed by pandas or left missing.
+    """
+
+    values = pd.Series(values).astype(str).str.strip()
+    dates = pd.Series(pd.NaT, index=values.index, dtype="datetime64[ns]")
+    for fmt in date_formats[order]:
+        todo = dates.isna()
+        if not todo.any():
+            break
+        dates[todo] = pd.to_datetime(values[todo], format=fmt, errors="coerce")
+
+    todo = dates.isna() & (values != "")
+    if todo.any() and order != "YM":
+        dates[todo] = pd.to_datetime(values[todo], errors="coerce", dayfirst=(order == "DMY"), format="mixed")
+    return dates
+
+
+def aggregate(dates):
+    """
+        Counts events by month, keeping the earliest date in each month. Returns a dataframe with
+        columns count and first, indexed by month.
+    """
+
+    dates = pd.Series(dates).dropna()
+    df = dates.groupby(dates.dt.to_period("M")).agg(["count", "min"])
+    df.columns = ["count", "first"]
+    df.index.name = "period"
+    return df.sort_index()
+
+
+def monthly(months, prefix, lb_2=False):
+    """
+        Computes the monthly statistics for one type of event (prefix "reg" or "rem") from the counts
+        returned by aggregate(). Returns one row per month from 2020m1, indexed by month.
+    """
+
+    counts = months["count"]
+    counts = counts[(counts.index >= baseline_start) & (counts > 0)]
+
+
+    # Baseline for each calendar month (2015-2019), weighted by events
+
+    base = counts[counts.index < baseline_end]
+    base = pd.DataFrame({"month": base.index.month, "c": base.values.astype(float)})
+    base["c2"] = base["c"] ** 2
+    sums = base.groupby("month")[["c", "c2"]].sum()
+    mean = sums["c2"] / sums["c"]
+    base["dev"] = base["c"] * (base["c"] - base["month"].map(mean)) ** 2
+    var = base.groupby("month")["dev"].sum() / (sums["c"] - 1)
+    sd = np.sqrt(var.where(sums["c"] > 1))
+
+    avg = mean.astype(np.float32)
+    sd = sd.astype(np.float32)
+    baseline = pd.DataFrame({"avg": avg, "sd": sd})
+    baseline["lb"] = (avg.astype(float) - sd.astype(float)).astype(np.float32)
+    baseline["ub"] = (avg.astype(float) + sd.astype(float)).astype(np.float32)
+    if lb_2:
+        baseline["lb_2"] = (avg.astype(float) - 2 * sd.astype(float)).astype(np.float32)
+        baseline["ub_2"] = (avg.astype(float) + 2 * sd.astype(float)).astype(np.float32)
+    baseline = np.ceil(baseline.astype(float))
+
+
+    # Months from 2020m1 that have a baseline
+
+    current = counts[counts.index >= baseline_end]
+    df = pd.DataFrame({"count": current.values.astype(float)}, index=current.index)
+    df = df.join(baseline.reindex(df.index.month).set_index(df.index))
+    df = df.dropna(subset=["avg"])
+
+    df["excess"] = np.ceil(df["count"] - df["avg"])
+    df["excess_per"] = np.ceil((df["excess"] / df["avg"]) * 100)
+    df["excess_cumu"] = df["excess"].cumsum()
+    df["avg_cumu"] = df["avg"].cumsum()
+    df["count_cumu"] = df["count"].cumsum()
+    df["excess_cumu_per"] = np.ceil((df["excess_cumu"] / df["avg_cumu"]) * 100)
+
+    df.columns = [prefix + "_" + c for c in df.columns]
+    df.index.name = "period"
+    return df
+
+
+def date_columns(months, prefix):
+    """
+        Returns the date variables that the US do-file keeps for each month (e.g., regd, regy, regq,
+        regm, month_reg, reg), using the earliest event in the month.
+    """
+
+    first = pd.to_datetime(months.loc[months["count"] > 0, "first"])
+    df = pd.DataFrame(index=first.index)
+    df[prefix + "d"] = first.dt.strftime("%d%b%Y").str.lower().values
+    df[prefix + "y"] = first.dt.year.values
+    df[prefix + "q"] = [str(p.year) + "q" + str(p.quarter) for p in first.index]
+    df[prefix + "m"] = [str(p.year) + "m" + str(p.month) for p in first.index]
+    df["month_" + prefix] = first.index.month
+    df[prefix] = 1
+    df.index.name = "period"
+    return df
+
+
+def statistics(country, reg, rem=None):
+    """
+        Builds the monthly statistics table for a country from the monthly counts of its registrations
+        and removals (see aggregate()), with the columns in the same order as the do-file's export.
+    """
+
+    config = countries[country]
+    reg_stats = monthly(reg, "reg", config.get("bounds2", False))
+    rem_stats = monthly(rem, "rem", config.get("bounds2", False)) if rem is not None else None
+
+    if config.get("dates"):
+        reg_stats = date_columns(reg, "reg").join(reg_stats, how="inner")
+        if rem_stats is not None:
+            rem_stats = date_columns(rem, "rem").join(rem_stats, how="inner")
+
+    if rem_stats is None:
+        df = reg_stats.reset_index()
+        columns = list(reg_stats.columns) + ["period"]
+    elif config.get("bounds2"): # England and Wales keeps the counts and baselines together
+        df = reg_stats.join(rem_stats, how="inner").reset_index()
+        columns = (["reg_count", "rem_count"] + ["reg_" + c for c in stats[1:] + bounds2] +
+            ["rem_" + c for c in stats[1:] + bounds2] + ["reg_" + c for c in excess] + ["rem_" + c for c in excess] + ["period"])
+    else:
+        df = reg_stats.join(rem_stats, how=config.get("how", "inner")).reset_index()
+        columns = list(reg_stats.columns) + ["period"] + list(rem_stats.columns)
+
+    df = df.sort_values("period")
+    df["country"] = config["label"]
+    return df[columns + ["country"]]
+
+
+def to_csv(df, path):
+    """
+        Writes a statistics table as Stata's export delimited does: whole numbers without decimals,
+        missing values as empty fields and months as e.g. 2020m1.
+    """
+
+    out = pd.DataFrame(index=df.index)
+    for c in df.columns:
+        if c == "period":
+            out[c] = [str(p.year) + "m" + str(p.month) for p in df[c]]
+        elif pd.api.types.is_numeric_dtype(df[c]):
+            out[c] = [("" if pd.isna(v) else str(int(v))) for v in df[c]]
+        else:
+            out[c] = df[c].fillna("").astype(str)
+    out.to_csv(path, index=False, lineterminator="\n")
+
+
+# Loaders: each returns the registrations and removals in a snapshot folder (data/<date>) as
+# dataframes of organisation id and event date
+
+def events(ids, dates, **attributes):
+    """
+        Returns a dataframe of events with columns org_id and date, plus a column for each keyword
+        argument (e.g., status=...) that is kept as an attribute of the event (see fevents.py).
+    """
+
+    df = pd.DataFrame({"org_id": pd.Series(ids).astype(str).str.strip().values, "date": pd.Series(dates).values})
+    for name, values in attributes.items():
+        df[name] = pd.Series(values).astype(str).str.strip().values
+    return df
+
+
+def load_nz(folder, ddate):
+    df = read_csv(folder + "/nz/nz-roc-" + ddate + ".csv")
+    reg = events(df["organisationid"], parse_dates(df["dateregistered"], "DMY"))
+    removed = df.loc[df["deregistrationdate"] != ""]
+    rem = events(removed["organisationid"], parse_dates(removed["deregistrationdate"], "DMY"))
+    return reg, rem
+
+
+def load_ni(folder, ddate):
+    df = read_csv(folder + "/ni/ni-roc-" + ddate + ".csv")
+    df = df.loc[df["status"] != "Removed"]
+    reg = events(df["regcharitynumber"], parse_dates(df["dateregistered"], "DMY"))
+    removals = read_csv(folder + "/ni/ni-removals-" + ddate + ".csv")
+    removals = removals.loc[removals["removed"] == "1"]
+    rem = events(removals["regid"], parse_dates(removals["removed_date"], "YMD"))
+    return reg, rem
+
+
+def sco_read(folder, ddate, name, zname):
+    """
+        Reads a Scottish register, either the extracted csv or the csv inside the downloaded zip file.
+    """
+
+    path = folder + "/sco/" + name + "-" + ddate + ".csv"
+    if os.path.isfile(path):
+        return read_csv(path)
+    with zipfile.ZipFile(folder + "/sco/" + zname + "-" + ddate + ".zip") as zf:
+        member = [m for m in zf.namelist() if m.lower().endswith(".csv")][0]
+        with zf.open(member) as f:
+            return read_csv(f)
+
+
+def load_sco(folder, ddate):
+    roc = sco_read(folder, ddate, "CharityExport", "sco-roc")
+    removed = sco_read(folder, ddate, "CharityExport-Removed", "sco-rem")
+    alldata = pd.concat([removed, roc], ignore_index=True, sort=False).fillna("")
+    reg = events(alldata["charitynumber"], parse_dates(alldata["registereddate"].str[:10], "DMY"))
+    rem = events(removed["charitynumber"], parse_dates(removed["ceaseddate"].str[:10], "DMY"))
+    return reg, rem
+
+
+def load_aus(folder, ddate):
+    path = folder + "/aus/aus-roc-" + ddate
+    if os.path.isfile(path + ".parquet"): # written by the collector (see fxlsx.py)
+        df = varnames(pd.read_parquet(path + ".parquet", columns=["ABN", "Registration_Date"]))
+    else:
+        df = varnames(fxlsx.read_frame(path + ".xlsx", ["ABN", "Registration_Date"], {"Registration_Date": "date"}))
+    if pd.api.types.is_datetime64_any_dtype(df["registration_date"]):
+        reg = events(df["abn"], df["registration_date"])
+    else:
+        reg = events(df["abn"], parse_dates(df["registration_date"], "DMY"))
+
+    rem = None
+    path = folder + "/aus/aus-removals-" + ddate + ".csv"
+    if os.path.isfile(path):
+        removals = read_csv(path)
+        removals = removals.loc[~removals["status"].isin(["NULL", "Registered"])].drop_duplicates("abn")
+        rem = events(removals["abn"], parse_dates(removals["status_date"], "DMY"), status=removals["status"])
+    return reg, rem
+
+
+def load_can(folder, ddate):
+    df = read_csv(folder + "/can/Charities_results_" + ddate + ".txt", sep=None, engine="python")
+    registered = df["charitystatus"] == "Registered"
+    reg = events(df.loc[registered, "bnregistrationnumber"], parse_dates(df.loc[registered, "effectivedateofstatus"], "YMD"))
+    rem = events(df.loc[~registered, "bnregistrationnumber"], parse_dates(df.loc[~registered, "effectivedateofstatus"], "YMD"),
+        status=df.loc[~registered, "charitystatus"])
+    return reg, rem
+
+
+def load_usa(folder, ddate):
+    df = read_csv(folder + "/usa/irs_businessfile_master_" + ddate + ".csv", usecols=lambda c: c.upper() in ("EIN", "SUBSECTION", "RULING"))
+    df = df.loc[pd.to_numeric(df["subsection"], errors="coerce") == 3]
+    reg = events(df["ein"], parse_dates(df["ruling"], "YM"))
+    return reg, usa_revocations(folder, ddate)
+
+
+def usa_revocations(folder, ddate):
+    path = folder + "/usa/irs_revoked_exemp_orgs_" + ddate
+    if os.path.isfile(path + ".parquet"): # dates already parsed by the collector (see firs.py)
+        revoked = varnames(pd.read_parquet(path + ".parquet", columns=["EIN", "Exemption_Type", "Revocation_Date", "Exemption_Reinstatement_Date"]))
+        revoked = revoked.loc[revoked["exemption_reinstatement_date"].isna() & (pd.to_numeric(revoked["exemption_type"], errors="coerce") == 3)]
+        return events(revoked["ein"], revoked["revocation_date"])
+    revoked = read_csv(path + ".csv")
+    revoked = revoked.loc[(revoked["exemption_reinstatement_date"] == "") & (pd.to_numeric(revoked["exemption_type"], errors="coerce") == 3)]
+    return events(revoked["ein"], parse_dates(revoked["revocation_date"], "DMY"))
+
+
+def load_ew(folder, ddate):
+    """
+        Reads the registration and removal dates of main charities (not linked charities) from the
+        public extract that the collector downloads (publicextract.charity.txt), or from the
+        earlier register extract (extract_registration.csv and extract_charity.csv) used by the
+        do-file if that is what the snapshot holds.
+    """
+
+    path = folder + "/ew/publicextract.charity.txt"
+    if os.path.isfile(path):
+        df = read_csv(path, sep="\t", encoding="utf-8-sig", quoting=csv.QUOTE_NONE,
+            usecols=["registered_charity_number", "linked_charity_number", "date_of_registration", "date_of_removal"])
+        df = df.loc[df["linked_charity_number"] == "0"].drop_duplicates("registered_charity_number")
+        reg = events(df["registered_charity_number"], parse_dates(df["date_of_registration"].str[:10], "YMD"))
+        removed = df.loc[df["date_of_removal"] != ""]
+        rem = events(removed["registered_charity_number"], parse_dates(removed["date_of_removal"].str[:10], "YMD"))
+        return reg, rem
+
+    registration = read_csv(folder + "/ew/extract_registration.csv", encoding="utf-8", escapechar="\\")
+    registration = registration.sort_values(["regno", "subno"]).drop_duplicates("regno")
+    charity = read_csv(folder + "/ew/extract_charity.csv", encoding="utf-8", escapechar="\\", usecols=lambda c: c == "regno")
+    charity["regno"] = pd.to_numeric(charity["regno"], errors="coerce")
+    charity = charity.drop_duplicates("regno")
+    registration["regno"] = pd.to_numeric(registration["regno"], errors="coerce")
+    df = charity.merge(registration, on="regno", how="left").fillna("")
+    reg = events(df["regno"], parse_dates(df["regdate"].str[:10], "YMD"))
+    rem = events(df["regno"], parse_dates(df["remdate"].str[:10], "YMD"))
+    return reg, rem
+
+
+def load_roi(folder, ddate):
+    """
+        Reads the Register of Charities of the Republic of Ireland. Every charity on the register
+        has a registration; removals are taken from a deregistration date column (e.g., "Date
+        Deregistered"), if the register has one.
+    """
+
+    path = folder + "/roi/roi-roc-" + ddate
+    if os.path.isfile(path + ".parquet"): # written by the collector (see fxlsx.py)
+        df = varnames(pd.read_parquet(path + ".parquet"))
+    else:
+        df = varnames(fxlsx.read_frame(path + ".xlsx", types=lambda c: "date" if "date" in c.lower() else None))
+    df = df.loc[df["registeredcharitynumber"].astype(str).str.strip() != ""]
+
+    def dates(values):
+        if pd.api.types.is_datetime64_any_dtype(values):
+            return values
+        return parse_dates(values.astype(str), "DMY")
+
+    reg = events(df["registeredcharitynumber"], dates(df["dateregistered"]))
+
+    rem = None
+    removal = [c for c in df.columns if "deregist" in c and "date" in c]
+    if removal:
+        removed = df.loc[dates(df[removal[0]]).notna()]
+        rem = events(removed["registeredcharitynumber"], dates(removed[removal[0]]), status=removed["status"].fillna(""))
+    return reg, rem
+
+
+loaders = {"aus": load_aus, "can": load_can, "ew": load_ew, "ni": load_ni, "nz": load_nz, "roi": load_roi, "sco": load_sco, "usa": load_usa}
+
+
+# Store of monthly counts: keeps the events of each country between snapshots, so that a new snapshot
+# only adds and subtracts the events that have changed since the last one.
+#
+# The regulators publish full registers rather than lists of changes, so a snapshot whose files have
+# changed is still loaded in full. The stored events, though, are split by organisation id into
+# partitions, each with a digest of its events: only the partitions whose digest has changed are
+# read, compared and rewritten, so the work on the store grows with the number of changes rather
+# than the size of the register.
+
+partitions = 64
+
+
+def signature(folder, country):
+    """
+        Returns the size and sha256 checksum of each input file of a country, used to tell whether
+        a snapshot differs from the one already in the store.
+    """
+
+    files = {}
+    for path in sorted(glob.glob(folder + "/" + country + "/*")):
+        if os.path.isfile(path):
+            checksum = hashlib.sha256()
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1024 * 1024), b""):
+                    checksum.update(block)
+            files[os.path.basename(path)] = [os.path.getsize(path), checksum.hexdigest()]
+    return list(files.values())
+
+
+def store_read(store, country):
+    """
+        Returns the metadata and monthly counts of a country in the store (None if the store has
+        no record of the country).
+    """
+
+    mfile = store + "/" + country + "-store.json"
+    if not os.path.isfile(mfile):
+        return None, None
+    with open(mfile, "r") as f:
+        mdata = json.load(f)
+    counts = pd.read_csv(store + "/" + country + "-counts.csv", dtype={"event": str, "month": str, "first": str})
+    return mdata, counts
+
+
+def partition_path(store, country, part):
+    return store + "/" + country + "-events/part-" + str(part).zfill(2) + ".csv.gz"
+
+
+def stored_events(store, country, part, legacy=None):
+    """
+        Returns the stored events of one partition (from `legacy`, the events of a store written
+        before it was partitioned, if given).
+    """
+
+    if legacy is not None:
+        return legacy.loc[legacy["part"] == part, ["event", "org_id", "seq", "date"]]
+    path = partition_path(store, country, part)
+    if not os.path.isfile(path):
+        return pd.DataFrame({c: pd.Series(dtype=str) for c in ["event", "org_id", "seq", "date"]})
+    return pd.read_csv(path, dtype=str, keep_default_na=False)
+
+
+def keyed(df, event):
+    """
+        Returns the events of one type as strings keyed by event, org_id and seq, where seq numbers
+        the events of an organisation so that organisations appearing twice are counted twice.
+    """
+
+    df = df.copy()
+    df["date"] = pd.to_datetime(df["date"]).dt.strftime("%Y-%m-%d").fillna("")
+    df["event"] = event
+    df["seq"] = df.groupby("org_id").cumcount().astype(str)
+    return df[["event", "org_id", "seq", "date"]]
+
+
+def partition_of(org_ids):
+    return (pd.util.hash_pandas_object(pd.Series(org_ids, dtype=str), index=False).values % np.uint64(partitions)).astype(int)
+
+
+def digests(df):
+    """
+        Returns a digest of the events in each partition: the number of events and the sum of a
+        hash of each, which does not depend on the order of the events.
+    """
+
+    hashes = pd.util.hash_pandas_object(df[["event", "org_id", "seq", "date"]], index=False)
+    sums = hashes.groupby(df["part"].values).agg(["count", "sum"])
+    return {str(part): "{}:{}".format(n, total) for part, (n, total) in zip(sums.index, sums.values.tolist())}
+
+
+def store_update(store, country, folder, ddate):
+    """
+        Brings the store for a country up to date with the snapshot in `folder` and returns its
+        monthly counts of registrations and removals.
+
+        If the input files have not changed since the snapshot in the store, the stored counts are
+        used as they are and the register is not read. Otherwise the register is loaded in full
+        and, in each partition of the store whose digest has changed, the events in the snapshot
+        are compared with the stored events by key: events that are new are added to the count
+        for their month, events that are no longer present (e.g., removals of charities that have
+        been reinstated) are subtracted, and events whose date has changed are moved from one
+        month to another. Partitions that have not changed are neither read nor rewritten. The
+        baselines are computed from the counts, so they are updated at the same time.
+    """
+
+    if not os.path.isdir(store + "/" + country + "-events"):
+        os.makedirs(store + "/" + country + "-events")
+
+    mdata, counts = store_read(store, country)
+    sig = signature(folder, country)
+    if mdata is not None and mdata["signature"] == sig:
+        print("{}: input files unchanged since {}".format(countries[country]["label"], mdata["snapshot"]))
+        mdata["snapshot"] = ddate
+        with open(store + "/" + country + "-store.json", "w") as f:
+            json.dump(mdata, f, indent=4)
+    else:
+        reg, rem = loaders[country](folder, ddate)
+        current = pd.concat([keyed(reg, "reg")] + ([keyed(rem, "rem")] if rem is not None else []), ignore_index=True)
+        current["part"] = partition_of(current["org_id"])
+        if mdata is None:
+            counts = pd.DataFrame({"event": pd.Series(dtype=str), "month": pd.Series(dtype=str), "count": pd.Series(dtype=int), "first": pd.Series(dtype=str)})
+
+        # A store written before the events were partitioned keeps them in one file
+        legacy = None
+        legacyfile = store + "/" + country + "-events.csv.gz"
+        if mdata is not None and "partitions" not in mdata and os.path.isfile(legacyfile):
+            legacy = pd.read_csv(legacyfile, dtype=str, keep_default_na=False)
+            legacy["part"] = partition_of(legacy["org_id"])
+
+        old_digests = (mdata or {}).get("partitions", {})
+        new_digests = digests(current)
+        changed_parts = sorted(int(p) for p in set(old_digests) | set(new_digests)
+            if legacy is not None or old_digests.get(p) != new_digests.get(p))
+
+        minus, plus = [], []
+        added = removed = changed = 0
+        for part in changed_parts:
+            new = current.loc[current["part"] == part, ["event", "org_id", "seq", "date"]]
+            df = stored_events(store, country, part, legacy).merge(new, on=["event", "org_id", "seq"], how="outer",
+                suffixes=("_old", "_new"), indicator=True)
+            moved = (df["_merge"] == "both") & (df["date_old"] != df["date_new"])
+            minus.append(df.loc[(df["_merge"] == "left_only") | moved, ["event", "date_old"]].rename(columns={"date_old": "date"}))
+            plus.append(df.loc[(df["_merge"] == "right_only") | moved, ["event", "date_new"]].rename(columns={"date_new": "date"}))
+            added += int((df["_merge"] == "right_only").sum())
+            removed += int((df["_merge"] == "left_only").sum())
+            changed += int(moved.sum())
+
+            path = partition_path(store, country, part)
+            if len(new):
+                new.to_csv(path, index=False)
+            elif os.path.isfile(path):
+                os.remove(path)
+
+
+        # Apply the changes to the monthly counts
+
+        empty = pd.DataFrame({"event": pd.Series(dtype=str), "date": pd.Series(dtype=str)})
+        delta = pd.concat([pd.concat(minus or [empty]).assign(n=-1), pd.concat(plus or [empty]).assign(n=1)], ignore_index=True)
+        delta = delta.loc[delta["date"].notna() & (delta["date"] != "")]
+        delta["month"] = delta["date"].str[:7]
+        delta = delta.groupby(["event", "month"])["n"].sum()
+
+        counts = counts.set_index(["event", "month"])
+        total = counts["count"].add(delta, fill_value=0).astype(int)
+        counts = counts.reindex(total.index)
+        counts["count"] = total
+
+
+        # Earliest date in each month that has changed
+
+        touched = delta.index
+        if len(touched):
+            dated = current.loc[current["date"] != ""].copy()
+            dated["month"] = dated["date"].str[:7]
+            dated = dated.set_index(["event", "month"])
+            dated = dated.loc[dated.index.isin(touched)]
+            first = dated.groupby(level=["event", "month"])["date"].min()
+            counts.loc[touched, "first"] = first.reindex(touched).values
+        counts = counts.loc[counts["count"] > 0].reset_index().sort_values(["event", "month"])
+
+        history = (mdata or {}).get("history", [])
+        history.append({"snapshot": ddate, "added": added, "removed": removed, "changed": changed, "partitions": len(changed_parts)})
+        print("{}: {} events added, {} removed and {} changed since the last snapshot ({} of {} partitions rewritten)".format(
+            countries[country]["label"], added, removed, changed, len(changed_parts), partitions))
+
+        mdata = {"snapshot": ddate, "signature": sig, "events": sorted(current["event"].unique().tolist()),
+            "partitions": new_digests, "history": history}
+        counts.to_csv(store + "/" + country + "-counts.csv", index=False)
+        with open(store + "/" + country + "-store.json", "w") as f:
+            json.dump(mdata, f, indent=4)
+        if legacy is not None:
+            os.remove(legacyfile)
+
+    months = {}
+    for event in ("reg", "rem"):
+        if event in mdata["events"]:
+            df = counts.loc[counts["event"] == event]
+            months[event] = pd.DataFrame({"count": df["count"].values, "first": pd.to_datetime(df["first"]).values},
+                index=pd.PeriodIndex(df["month"], freq="M", name="period"))
+        else:
+            months[event] = None
+    return months["reg"], months["rem"]
+
+
+def country_statistics(country, folder, ddate, outfolder, store=None):
+    """
+        Computes the monthly statistics for a country from the snapshot in `folder` (data/<date>) and
+        writes them to `<outfolder>/<country>-monthly-statistics-<date>.csv`. If `store` is given,
+        the counts are kept up to date in the store rather than recomputed from the full registers.
+    """
+
+    if store is not None:
+        reg, rem = store_update(store, country, folder, ddate)
+    else:
+        reg, rem = loaders[country](folder, ddate)
+        reg = aggregate(reg.set_index("org_id")["date"])
+        rem = aggregate(rem.set_index("org_id")["date"]) if rem is not None else None
+
+    df = statistics(country, reg, rem)
+    outfile = outfolder + "/" + countries[country]["file"] + "-monthly-statistics-" + ddate + ".csv"
+    to_csv(df, outfile)
+    print("Monthly statistics: '{}'".format(outfile))
+    return outfile
+
+
+def ntee_statistics(folder, ddate, outfolder):
+    """
+        Computes the monthly statistics for the USA by NTEE major group from the snapshot in `folder`
+        and writes them to `<outfolder>/us-monthly-statistics-by-ntee-<date>.csv`. Registrations and
+        the major group of each revoked EIN come from the NTEE index written by the collector (see
+        firs.py), which is built from the master file if the snapshot does not have one.
+    """
+
+    path = firs.ntee_path(folder, ddate)
+    if os.path.isfile(path):
+        index = firs.open_index(path)
+    else:
+        index = firs.ntee_index([folder + "/usa/irs_businessfile_master_" + ddate + ".csv"], path)
+    index = index[index["subsection"] == 3] # still sorted by EIN
+
+    rem = usa_revocations(folder, ddate)
+    rem_groups = firs.ntee(index, rem["org_id"].values)["ntee_maj"].values
+    reg_dates = pd.Series(index["ruling"].astype("datetime64[ns]"))
+
+    frames = []
+    for group in sorted(firs.ntee_labels):
+        reg = aggregate(reg_dates[index["ntee_maj"] == group])
+        if not len(reg):
+            continue
+        df = statistics("usa", reg, aggregate(rem["date"].values[rem_groups == group]))
+        df["ntee_maj"] = group
+        frames.append(df)
+
+    df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    outfile = outfolder + "/us-monthly-statistics-by-ntee-" + ddate + ".csv"
+    to_csv(df, outfile)
+    print("Monthly statistics by NTEE major group: '{}'".format(outfile))
+    return outfile
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Compute monthly excess-events statistics from a data/<date> snapshot.")
+    parser.add_argument("folder", help="snapshot folder created by the collection script, e.g. data/2021-01-28")
+    parser.add_argument("--countries", nargs="+", choices=list(countries), default=list(countries))
+    parser.add_argument("--out", default=None, help="folder for the statistics files (default: the snapshot folder)")
+    parser.add_argument("--store", default=None, help="folder of the monthly-count store to update incrementally, e.g. data/monthly-store")
+    parser.add_argument("--ntee", action="store_true", help="also compute the USA statistics by NTEE major group")
+    args = parser.parse_args()
+
+    folder = args.folder.rstrip("/\\")
+    ddate = os.path.basename(folder)
+    outfolder = args.out or folder
+
+    skipped = []
+    for country in args.countries:
+        try:
+            country_statistics(country, folder, ddate, outfolder, args.store)
+        except (OSError, KeyError, ValueError, ImportError) as e: # e.g., a register missing from the snapshot
+            print("Could not compute statistics for {}: {}".format(countries[country]["label"], e))
+            skipped.append(countries[country]["label"])
+    if skipped:
+        print("Skipped {} of {} jurisdictions: {}".format(len(skipped), len(args.countries), ", ".join(skipped)))
+
+    if args.ntee:
+        try:
+            ntee_statistics(folder, ddate, outfolder)
+        except (OSError, KeyError, ValueError, ImportError) as e:
+            print("Could not compute statistics by NTEE major group: {}".format(e))
+
+
+if __name__ == "__main__":
+    main()
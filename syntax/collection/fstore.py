@@ -0,0 +1,221 @@
+import tempfile
+import argparse
+import hashlib
+import shutil
+import gzip
+import json
+import stat
+import os
+import re
+
+try:
+    import zstandard
+except ImportError: # only needed for zstd compression
+    zstandard = None
+
+#######Program#######
+
+# Content-addressed store for the data/<date> snapshots. Each unique file is kept once, as a blob
+# named by its sha256 checksum, and each snapshot is a manifest mapping its file names to blobs:
+#
+#   <store>/blobs/ab/abcdef....gz       compressed contents of a file
+#   <store>/manifests/<date>.json       {"ew/extract_charity.csv": {"sha256": ..., "size": ..., "codec": ...}, ...}
+#
+# export() recreates data/<date> with the same paths the do-files expect.
+
+chunksize = 1024 * 1024
+compressed = (".zip", ".xlsx", ".gz", ".zst", ".parquet", ".arrow", ".pdf", ".png", ".jpg") # stored as they are
+
+
+def file_sha256(path):
+    checksum = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunksize), b""):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+def blob_path(store, sha256, codec):
+    return store + "/blobs/" + sha256[:2] + "/" + sha256 + "." + codec
+
+
+def open_blob(path, codec, mode):
+    if codec == "gz":
+        return gzip.open(path, mode, compresslevel=6)
+    if codec == "zst":
+        if mode == "rb":
+            return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+        return zstandard.ZstdCompressor(level=10).stream_writer(open(path, "wb"), closefd=True)
+    return open(path, mode)
+
+
+def put(store, path, codec=None):
+    """
+        Adds a file to the store, unless a blob with the same checksum is already there. Files that
+        are already compressed (e.g., zip and xlsx files) are stored as they are; other files are
+        compressed with `codec` ("zst" if zstandard is installed, otherwise "gz").
+
+        Returns the manifest entry for the file and the number of bytes added to the store.
+    """
+
+    sha256 = file_sha256(path)
+    size = os.path.getsize(path)
+    if path.lower().endswith(compressed):
+        codec = "raw"
+    else:
+        codec = codec or ("zst" if zstandard is not None else "gz")
+
+    for existing in ("raw", "gz", "zst"):
+        if os.path.isfile(blob_path(store, sha256, existing)):
+            return {"sha256": sha256, "size": size, "codec": existing}, 0
+
+    target = blob_path(store, sha256, codec)
+    folder = os.path.dirname(target)
+    os.makedirs(folder, exist_ok=True)
+    fd, tmpfile = tempfile.mkstemp(dir=folder, suffix=".part")
+    os.close(fd)
+    try:
+        with open(path, "rb") as f, open_blob(tmpfile, codec, "wb") as out:
+            shutil.copyfileobj(f, out, chunksize)
+        os.chmod(tmpfile, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH) # blobs may be hard linked into snapshots
+        os.replace(tmpfile, target)
+    except BaseException:
+        if os.path.isfile(tmpfile):
+            os.remove(tmpfile)
+        raise
+
+    return {"sha256": sha256, "size": size, "codec": codec}, os.path.getsize(target)
+
+
+def add(store, folder, ddate=None, remove=False, codec=None, exclude=None):
+    """
+        Adds a snapshot folder (e.g., data/2021-01-28) to the store and writes its manifest. If
+        remove=True the folder is deleted once every file is in the store; export() recreates it.
+        Subfolders named in `exclude` (e.g., ["ni"]) are left out of the manifest and are not
+        deleted.
+
+        Returns a summary of the number of files, their total size and the bytes added to the store.
+    """
+
+    folder = folder.rstrip("/\\")
+    ddate = ddate or os.path.basename(folder)
+    manifest = {}
+    summary = {"snapshot": ddate, "files": 0, "bytes": 0, "new_bytes": 0}
+
+    exclude = set(exclude or [])
+    for root, dirs, files in os.walk(folder):
+        if root == folder:
+            dirs[:] = [d for d in dirs if d not in exclude]
+        dirs.sort()
+        for file in sorted(files):
+            path = os.path.join(root, file)
+            name = os.path.relpath(path, folder).replace(os.sep, "/")
+            manifest[name], added = put(store, path, codec)
+            summary["files"] += 1
+            summary["bytes"] += manifest[name]["size"]
+            summary["new_bytes"] += added
+
+    os.makedirs(store + "/manifests", exist_ok=True)
+    with open(store + "/manifests/" + ddate + ".json", "w") as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+
+    if remove:
+        for entry in os.listdir(folder):
+            if entry not in exclude:
+                path = os.path.join(folder, entry)
+                shutil.rmtree(path) if os.path.isdir(path) else os.remove(path)
+        if not os.listdir(folder):
+            os.rmdir(folder)
+
+    return summary
+
+
+def manifest(store, ddate):
+    with open(store + "/manifests/" + ddate + ".json", "r") as f:
+        return json.load(f)
+
+
+def export(store, ddate, basefolder="data", link=True, verify=False):
+    """
+        Recreates a snapshot as <basefolder>/<date>, with the same file names as when it was added.
+        Blobs stored as they are are hard linked (copied if the file system does not support hard
+        links); compressed blobs are decompressed. Files that already exist with the right size are
+        left alone. With verify=True the checksum of every file is checked.
+    """
+
+    folder = basefolder + "/" + ddate
+    files = manifest(store, ddate)
+    for name, entry in sorted(files.items()):
+        target = folder + "/" + name
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        source = blob_path(store, entry["sha256"], entry["codec"])
+
+        if not (os.path.isfile(target) and os.path.getsize(target) == entry["size"]):
+            if os.path.isfile(target):
+                os.remove(target)
+            if entry["codec"] == "raw" and link:
+                try:
+                    os.link(source, target)
+                except OSError:
+                    shutil.copyfile(source, target)
+            else:
+                with open_blob(source, entry["codec"], "rb") as f, open(target + ".part", "wb") as out:
+                    shutil.copyfileobj(f, out, chunksize)
+                os.replace(target + ".part", target)
+
+        if verify and file_sha256(target) != entry["sha256"]:
+            raise ValueError("Checksum of {} does not match the store".format(target))
+
+    return folder
+
+
+def stats(store):
+    """
+        Returns the total size of the snapshots in the store and the size of the store itself.
+    """
+
+    dates = sorted(re.sub(r"\.json$", "", m) for m in os.listdir(store + "/manifests") if m.endswith(".json"))
+    logical = sum(e["size"] for d in dates for e in manifest(store, d).values())
+    stored = 0
+    blobs = 0
+    for root, dirs, files in os.walk(store + "/blobs"):
+        for file in files:
+            stored += os.path.getsize(os.path.join(root, file))
+            blobs += 1
+    return {"snapshots": len(dates), "blobs": blobs, "snapshot_bytes": logical, "stored_bytes": stored}
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Keep data/<date> snapshots in a deduplicated, compressed store.")
+    parser.add_argument("--store", default="data/store", help="folder of the store")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("add", help="add snapshot folders to the store")
+    p.add_argument("folders", nargs="+", help="e.g. data/2021-01-28")
+    p.add_argument("--remove", action="store_true", help="delete each folder once it is in the store")
+    p.add_argument("--codec", choices=["gz", "zst"], default=None)
+
+    p = commands.add_parser("export", help="recreate snapshot folders from the store")
+    p.add_argument("dates", nargs="+", help="e.g. 2021-01-28")
+    p.add_argument("--to", default="data", help="folder in which to recreate the snapshots")
+    p.add_argument("--copy", action="store_true", help="copy files rather than hard linking them")
+    p.add_argument("--verify", action="store_true", help="check the checksum of every file")
+
+    commands.add_parser("stats", help="report the size of the store")
+    args = parser.parse_args()
+
+    if args.command == "add":
+        for folder in args.folders:
+            s = add(args.store, folder, remove=args.remove, codec=args.codec)
+            print("{snapshot}: {files} files, {bytes:,} bytes, {new_bytes:,} bytes added to the store".format(**s))
+    elif args.command == "export":
+        for ddate in args.dates:
+            print("Exported: '{}'".format(export(args.store, ddate, args.to, link=not args.copy, verify=args.verify)))
+    else:
+        s = stats(args.store)
+        print("{snapshots} snapshots, {blobs} blobs: {snapshot_bytes:,} bytes of snapshots kept in {stored_bytes:,} bytes".format(**s))
+
+
+if __name__ == "__main__":
+    main()
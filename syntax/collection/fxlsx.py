@@ -0,0 +1,390 @@
+from datetime import datetime, timedelta
+import xml.etree.ElementTree as ET
+import posixpath
+import argparse
+import codecs
+import html
+import zipfile
+import re
+import os
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError: # only needed for Parquet and Arrow output
+    pa = None
+
+#######Program#######
+
+# Streaming reader for the xlsx registers (Australia, Republic of Ireland). An xlsx file is a zip of
+# XML files; the worksheet is read a block at a time and its rows and cells are matched with regular
+# expressions, so memory does not grow with the size of the register and neither openpyxl nor
+# Excel is needed. to_columnar() writes the
+# columns that are needed to a typed Parquet (or Arrow) file, which loads in a fraction of the time
+# of the xlsx file.
+
+main_ns = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+rel_ns = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+pkg_ns = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+
+batchsize = 50000
+date_formats = ["%d/%m/%Y", "%d-%m-%Y", "%Y-%m-%d", "%Y-%m-%d %H:%M:%S", "%d %b %Y", "%d %B %Y"] # text in date columns
+
+builtin_dates = set(range(14, 23)) | set(range(27, 37)) | set(range(45, 48)) | set(range(50, 59)) # date and time numFmtIds
+
+
+def is_date_format(code):
+    """
+        Returns True if a number format (e.g., "dd/mm/yyyy") displays a date or time.
+    """
+
+    code = re.sub(r'"[^"]*"|\[[^\]]*\]|\\.', "", code) # quoted text, colours and conditions, escaped characters
+    return re.search(r"[dmyhs]", code, re.I) is not None
+
+
+def shared_strings(zf):
+    if "xl/sharedStrings.xml" not in zf.namelist():
+        return []
+    strings = []
+    with zf.open("xl/sharedStrings.xml") as f:
+        for event, elem in ET.iterparse(f):
+            if elem.tag == main_ns + "si":
+                # plain text, or runs of rich text; phonetic guides (rPh) are left out
+                texts = elem.findall(main_ns + "t") + elem.findall(main_ns + "r/" + main_ns + "t")
+                strings.append("".join(t.text or "" for t in texts))
+                elem.clear()
+    return strings
+
+
+def date_styles(zf):
+    """
+        Returns the indexes of the cell styles that display numbers as dates.
+    """
+
+    if "xl/styles.xml" not in zf.namelist():
+        return set()
+    styles = ET.fromstring(zf.read("xl/styles.xml"))
+    custom = {int(n.get("numFmtId")): n.get("formatCode", "") for n in styles.iter(main_ns + "numFmt")}
+    xfs = styles.find(main_ns + "cellXfs")
+    dates = set()
+    for i, xf in enumerate(xfs if xfs is not None else []):
+        fmt = int(xf.get("numFmtId", 0))
+        if fmt in builtin_dates or (fmt in custom and is_date_format(custom[fmt])):
+            dates.add(i)
+    return dates
+
+
+def sheet_path(zf, sheet=None):
+    """
+        Returns the path in the zip file of a worksheet, given its name (default: the first sheet).
+    """
+
+    workbook = ET.fromstring(zf.read("xl/workbook.xml"))
+    sheets = workbook.find(main_ns + "sheets")
+    chosen = None
+    for s in sheets:
+        if sheet is None or s.get("name") == sheet:
+            chosen = s
+            break
+    if chosen is None:
+        raise KeyError("Sheet '{}' not found".format(sheet))
+
+    rels = ET.fromstring(zf.read("xl/_rels/workbook.xml.rels"))
+    for rel in rels.iter(pkg_ns + "Relationship"):
+        if rel.get("Id") == chosen.get(rel_ns + "id"):
+            target = rel.get("Target")
+            return target.lstrip("/") if target.startswith("/") else posixpath.normpath("xl/" + target)
+    raise KeyError("Worksheet of sheet '{}' not found".format(chosen.get("name")))
+
+
+def column_index(ref):
+    """
+        Returns the (zero-based) column of a cell reference, e.g. 2 for "C5".
+    """
+
+    n = 0
+    for ch in ref:
+        if ch.isdigit():
+            break
+        n = n * 26 + ord(ch.upper()) - 64
+    return n - 1
+
+
+def patterns(prefix=""):
+    """
+        Returns the regular expressions for the cells of a worksheet whose elements have the given
+        namespace prefix (e.g., "x:" in files written by some libraries; usually none).
+    """
+
+    p = re.escape(prefix)
+    cell = re.compile(r'<{p}c(?=[\s/>])(?:\s+r="([A-Z]+)\d*")?([^>/]*)(?:/>|>(.*?)</{p}c>)'.format(p=p), re.S)
+    value = re.compile(r"<{p}v>(.*?)</{p}v>".format(p=p), re.S)
+    text = re.compile(r"<{p}t(?:\s[^>]*)?>(.*?)</{p}t>".format(p=p), re.S)
+    return cell, value, text
+
+
+attr_re = re.compile(r'(\w+)="([^"]*)"')
+
+
+def rows(path, sheet=None, columns=None):
+    """
+        Reads a worksheet a row at a time. Yields a list of values for each row that has cells:
+        text as strings, cells formatted as dates as datetimes and other numbers as strings (whole
+        numbers without a decimal point, so that identifiers such as ABNs keep their digits).
+
+        The first row is the header. If `columns` is given, only those columns are returned, in
+        that order, and the cells after the last of them in each row are not read at all.
+
+        Rows and cells are matched with regular expressions, a block of the file at a time, rather
+        than parsed into XML elements: building an element (or calling a parser callback) for
+        every cell is most of the time it takes to read a large register.
+    """
+
+    with zipfile.ZipFile(path) as zf:
+        strings = shared_strings(zf)
+        dates = date_styles(zf)
+        workbook = ET.fromstring(zf.read("xl/workbook.xml"))
+        pr = workbook.find(main_ns + "workbookPr")
+        epoch = datetime(1904, 1, 1) if pr is not None and pr.get("date1904") in ("1", "true") else datetime(1899, 12, 30)
+
+        selection = {}
+        with zf.open(sheet_path(zf, sheet)) as f:
+            decoder = codecs.getincrementaldecoder("utf-8")() # blocks may end partway through a character
+            rest = ""
+            regex = None
+            for block in iter(lambda: f.read(4 * 1024 * 1024), b""):
+                xml = rest + decoder.decode(block)
+                if regex is None:
+                    m = re.search(r"<(\w+:)?sheetData\b", xml)
+                    if m is None:
+                        rest = xml
+                        continue
+                    prefix = m.group(1) or ""
+                    regex = patterns(prefix) + ("</" + prefix + "row>", {}, {})
+                    xml = xml[m.start():]
+                *complete, rest = xml.split(regex[3]) # the last row may continue in the next block
+                yield from select_rows(parse_rows(complete, regex, strings, dates, epoch, selection), columns, path, selection)
+            if regex is not None:
+                rest = rest.split("</" + prefix + "sheetData>")[0] # e.g., conditional formatting after the data
+                yield from select_rows(parse_rows([rest], regex, strings, dates, epoch, selection), columns, path, selection)
+
+
+def select_rows(reader, columns, path, selection):
+    """
+        Yields the header (the first row of the worksheet) and then the values of `columns` in each
+        row. Once the header has been read, `selection` tells parse_rows() which cells are needed.
+    """
+
+    for values in reader:
+        if "positions" not in selection:
+            header = [str(h).strip() for h in values]
+            if columns is None:
+                selection["positions"] = None
+                yield header
+                continue
+            missing = [c for c in columns if c not in header]
+            if missing:
+                raise KeyError("Columns {} not found in {}".format(missing, path))
+            selection["positions"] = [header.index(c) for c in columns]
+            selection["keep"] = set(selection["positions"])
+            selection["last"] = max(selection["positions"])
+            yield list(columns)
+        elif selection["positions"] is None:
+            yield values
+        else:
+            yield [values[i] if i < len(values) else "" for i in selection["positions"]]
+
+
+def parse_rows(complete, regex, strings, dates, epoch, selection):
+    cell_re, value_re, text_re, _, styles, columns = regex
+    for row in complete:
+        keep = selection.get("keep")
+        last = selection.get("last")
+        values = []
+        cells = cell_re.findall(row) if last is None else map(re.Match.groups, cell_re.finditer(row)) # lazily, to stop at `last`
+        for ref, attrs, inner in cells:
+            if not ref and 'r="' in attrs: # the cell reference is not the first attribute
+                a = dict(attr_re.findall(attrs))
+                ref = a.pop("r", "").rstrip("0123456789")
+                attrs = " ".join('{}="{}"'.format(k, v) for k, v in a.items()) # as the key of `styles`
+            if ref:
+                i = columns.get(ref)
+                if i is None:
+                    i = columns[ref] = column_index(ref)
+                if i > len(values):
+                    values.extend([""] * (i - len(values)))
+            else:
+                i = len(values)
+            if last is not None and i > last:
+                break # cells are in column order
+            if keep is not None and i not in keep:
+                values.append("")
+                continue
+
+            st = styles.get(attrs)
+            if st is None:
+                a = dict(attr_re.findall(attrs))
+                st = styles[attrs] = (a.get("t", "n"), a.get("s"))
+            t, s = st
+
+            inner = inner or ""
+            if t == "inlineStr":
+                text = "".join(text_re.findall(inner))
+            elif inner[:3] == "<v>" and inner[-4:] == "</v>":
+                text = inner[3:-4]
+            else:
+                m = value_re.search(inner)
+                text = m.group(1) if m else ""
+            if "&" in text:
+                text = html.unescape(text)
+            values.append(cell_value(t, s, text, strings, dates, epoch))
+        if values:
+            yield values
+
+
+def cell_value(t, s, text, strings, dates, epoch):
+    if t == "inlineStr" or t == "str" or t == "b":
+        return text
+    if text == "" or t == "e": # empty, or an error such as #N/A
+        return ""
+    if t == "s":
+        return strings[int(text)]
+    if t == "d": # ISO 8601 date
+        return pd.Timestamp(text).to_pydatetime()
+
+    number = float(text)
+    if s is not None and int(s) in dates:
+        return epoch + timedelta(days=number)
+    return str(int(number)) if number.is_integer() and abs(number) < 1e15 else text
+
+
+def parse_dates(values):
+    """
+        Converts a column of datetimes and text to datetimes. Text is tried against date_formats in
+        turn; values that match none of them are left missing.
+    """
+
+    values = pd.Series(values, dtype=object)
+    text = values.map(lambda v: isinstance(v, str))
+    out = pd.Series(pd.NaT, index=values.index, dtype="datetime64[s]")
+    out[~text] = pd.to_datetime(values[~text], errors="coerce")
+    todo = text & (values.astype(str).str.strip() != "")
+    for fmt in date_formats:
+        if not todo.any():
+            break
+        parsed = pd.to_datetime(values[todo].str.strip(), format=fmt, errors="coerce")
+        out[parsed.dropna().index] = parsed.dropna()
+        todo = todo & out.isna()
+    return out, int(todo.sum())
+
+
+def column_type(types, column):
+    """
+        Returns the type of a column: `types` is a dict of {column: type} or a function of the
+        column name (e.g., lambda c: "date" if "Date" in c else None).
+    """
+
+    if types is None:
+        return None
+    return types(column) if callable(types) else types.get(column)
+
+
+def typed_frame(records, header, types):
+    """
+        Returns a dataframe of rows read from a worksheet: columns whose type is "date" in `types`
+        are converted to datetimes, everything else to strings. Also returns the number of date
+        values that could not be parsed.
+    """
+
+    df = pd.DataFrame.from_records(records, columns=header)
+    unparsed = 0
+    for c in header:
+        if column_type(types, c) == "date":
+            df[c], n = parse_dates(df[c])
+            unparsed += n
+        else:
+            df[c] = df[c].map(lambda v: v.strftime("%Y-%m-%d") if isinstance(v, datetime) else ("" if v is None else v)).astype(str)
+    return df, unparsed
+
+
+def read_frame(path, columns=None, types=None, sheet=None):
+    """
+        Reads a worksheet into a dataframe, keeping only `columns` (default: all), with the first
+        row as the header. See typed_frame() for `types`.
+    """
+
+    reader = rows(path, sheet, columns)
+    header = next(reader)
+    df, unparsed = typed_frame(list(reader), header, types)
+    return df
+
+
+def arrow_schema(header, types):
+    return pa.schema([pa.field(c, pa.timestamp("s") if column_type(types, c) == "date" else pa.string()) for c in header])
+
+
+def to_columnar(path, outfile, columns=None, types=None, sheet=None, output="parquet"):
+    """
+        Converts a worksheet to a typed, compressed Parquet or Arrow IPC file, `batchsize` rows at a
+        time, keeping only `columns` (default: all). Columns whose type is "date" in `types` are
+        stored as timestamps, everything else as strings.
+
+        Returns the number of rows written.
+    """
+
+    if pa is None:
+        raise ImportError("pyarrow is required to write %s files" % output)
+
+    reader = rows(path, sheet, columns)
+    header = next(reader)
+    schema = arrow_schema(header, types)
+    if output == "parquet":
+        writer = pa.parquet.ParquetWriter(outfile + ".part", schema, compression="zstd")
+    else:
+        writer = pa.ipc.new_file(outfile + ".part", schema, options=pa.ipc.IpcWriteOptions(compression="zstd"))
+
+    n = 0
+    unparsed = 0
+    batch = []
+    with writer:
+        for values in reader:
+            batch.append(values)
+            if len(batch) == batchsize:
+                n, unparsed = write_batch(writer, batch, header, types, schema, n, unparsed)
+                batch = []
+        if batch or n == 0:
+            n, unparsed = write_batch(writer, batch, header, types, schema, n, unparsed)
+
+    os.replace(outfile + ".part", outfile)
+    if unparsed:
+        print("WARNING: {} dates in {} could not be parsed and were left missing".format(unparsed, path))
+    return n
+
+
+def write_batch(writer, batch, header, types, schema, n, unparsed):
+    df, u = typed_frame(batch, header, types)
+    table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+    writer.write_table(table)
+    return n + table.num_rows, unparsed + u
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Convert an xlsx register to a typed Parquet or Arrow file.")
+    parser.add_argument("file", help="e.g. data/2021-01-28/aus/aus-roc-2021-01-28.xlsx")
+    parser.add_argument("--out", default=None, help="output file (default: the xlsx file with a .parquet or .arrow extension)")
+    parser.add_argument("--columns", nargs="+", default=None, help="columns to keep (default: all)")
+    parser.add_argument("--dates", nargs="+", default=[], help="columns to store as dates")
+    parser.add_argument("--sheet", default=None, help="name of the worksheet (default: the first)")
+    parser.add_argument("--output", choices=["parquet", "arrow"], default="parquet")
+    args = parser.parse_args()
+
+    outfile = args.out or re.sub(r"\.xlsx$", "", args.file) + "." + args.output
+    n = to_columnar(args.file, outfile, args.columns, {c: "date" for c in args.dates}, args.sheet, args.output)
+    print("{:,} rows: '{}'".format(n, outfile))
+
+
+if __name__ == "__main__":
+    main()
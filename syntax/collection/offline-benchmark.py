@@ -0,0 +1,471 @@
+# -*- coding: latin-1 -*-
+"""
+    Project: The impact of COVID-19 on the foundation and dissolution of charitable organisations
+
+    Website: https://diarmuidm.github.io/charity-covid-19/
+
+    Creator: Diarmuid McDonnell
+
+    Collaborators: Alasdair Rutherford
+
+    File: offline-benchmark.py
+
+    Description: This file benchmarks the download, conversion and parsing functions of the data
+                 collection script without contacting any regulator. Synthetic registers are served
+                 from a local web server, requests to the regulators' websites are redirected to it,
+                 and the time, throughput and peak memory of each stage are reported.
+"""
+
+# Import packages #
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from xml.sax.saxutils import escape
+import importlib.util
+import multiprocessing as mp
+import urllib.parse
+import threading
+import datetime
+import argparse
+import hashlib
+import zipfile
+import shutil
+import random
+import time
+import json
+import csv
+import io
+import os
+
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+collection = os.path.dirname(os.path.abspath(__file__)) + "/char-excess-events-collection-2020-06-30.py"
+ddate = "2021-01-28"
+
+# Hosts of the regulators' websites; requests to these are sent to the local server instead
+hosts = ["data.gov.au", "www.odata.charities.govt.nz", "www.irs.gov", "apps.irs.gov", "ccewuksprdoneregsadata1.blob.core.windows.net",
+    "www.charitycommissionni.org.uk", "www.charitiesregulator.ie", "www.oscr.org.uk", "apps.cra-arc.gc.ca"]
+
+ew_tables = ["charity", "charity_annual_return_history", "charity_annual_return_parta", "charity_annual_return_partb",
+    "charity_area_of_operation", "charity_classification", "charity_event_history", "charity_governing_document", "charity_other_names",
+    "charity_other_regulators", "charity_policy", "charity_published_report", "charity_trustee"]
+
+stages = ["aus", "nz", "usa", "can", "ew", "roi", "sco", "ni_roc", "ni_webpages", "ni_removed", "import_zip"]
+
+
+# Define functions #
+
+def write_xlsx(path, header, rows):
+    """
+        Writes a minimal single-sheet xlsx file as Excel lays it out, so that fixtures can be created
+        without an Excel writer being installed: text in a shared string table, dates (datetime.date
+        values) as serial numbers in cells with a date style, and other numbers as numbers.
+    """
+
+    strings = {}
+
+    def column(i):
+        name = ""
+        while i >= 0:
+            name = chr(65 + i % 26) + name
+            i = i // 26 - 1
+        return name
+
+    def cell(value, ref):
+        if isinstance(value, datetime.date):
+            serial = (value - datetime.date(1899, 12, 30)).days
+            return '<c r="{}" s="1"><v>{}</v></c>'.format(ref, serial)
+        if isinstance(value, (int, float)):
+            return '<c r="{}"><v>{}</v></c>'.format(ref, value)
+        index = strings.setdefault(str(value), len(strings))
+        return '<c r="{}" t="s"><v>{}</v></c>'.format(ref, index)
+
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("[Content_Types].xml", '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+            '<Override PartName="/xl/sharedStrings.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sharedStrings+xml"/>'
+            '<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+            '</Types>')
+        zf.writestr("_rels/.rels", '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+            '</Relationships>')
+        zf.writestr("xl/workbook.xml", '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            '<sheets><sheet name="Sheet1" sheetId="1" r:id="rId1"/></sheets></workbook>')
+        zf.writestr("xl/_rels/workbook.xml.rels", '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+            '<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/sharedStrings" Target="sharedStrings.xml"/>'
+            '<Relationship Id="rId3" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>'
+            '</Relationships>')
+
+        # Style 1 shows numbers as dates with a custom format, as the ACNC's and ROI's files do
+        zf.writestr("xl/styles.xml", '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+            '<numFmts count="1"><numFmt numFmtId="164" formatCode="dd/mm/yyyy"/></numFmts>'
+            '<cellXfs count="2"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+            '<xf numFmtId="164" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/></cellXfs>'
+            '</styleSheet>')
+
+        with zf.open("xl/worksheets/sheet1.xml", "w", force_zip64=True) as f:
+            f.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>')
+            for r, row in enumerate([header] + rows, start=1):
+                cells = "".join(cell(v, column(i) + str(r)) for i, v in enumerate(row) if v != "")
+                f.write(('<row r="{}">'.format(r) + cells + "</row>").encode("utf-8"))
+            f.write(b"</sheetData></worksheet>")
+
+        with zf.open("xl/sharedStrings.xml", "w", force_zip64=True) as f:
+            f.write('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<sst xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" count="{0}" uniqueCount="{0}">'.format(len(strings)).encode("utf-8"))
+            for text in strings: # in order of their index
+                f.write(("<si><t>" + escape(text) + "</t></si>").encode("utf-8"))
+            f.write(b"</sst>")
+
+
+def random_day(rng):
+    return datetime.date(2010, 1, 1) + datetime.timedelta(days=rng.randint(0, 4017)) # 2010-2020
+
+
+def random_date(rng, fmt):
+    return time.strftime(fmt, time.gmtime(rng.randint(1262304000, 1609459199))) # 2010-2020
+
+
+def ni_page(regid, removed_date=None):
+    """
+        Returns a synthetic CCNI web page, with the removal sentence if the charity has been removed.
+    """
+
+    body = '<div class="pcg-charity-details__purpose">Charitable purposes of charity {}</div>'.format(regid)
+    if removed_date is not None:
+        body += ('<div class="pcg-charity-details__purpose pcg-charity-details__purpose--removed pcg-contrast__color-main">'
+            'Removed on {}\n</div>'.format(removed_date))
+    return "<html><head><title>Charity {}</title></head><body>{}{}</body></html>".format(regid, body, " " * 20000)
+
+
+def make_fixtures(folder, rows, pages):
+    """
+        Creates synthetic registers with (roughly) `rows` organisations each, and web pages for the
+        first `pages` Northern Irish charities, in `folder`. Returns the routes served by the local
+        server: a dict of {url without scheme: file}.
+    """
+
+    rng = random.Random(2020)
+    routes = {}
+
+    def add(url, name):
+        routes[urllib.parse.unquote(url)] = folder + "/" + name
+        return folder + "/" + name
+
+    # Australia and Republic of Ireland (xlsx)
+
+    write_xlsx(add("data.gov.au/data/dataset/b050b242-4487-4306-abf5-07ca073e5594/resource/eb1e6be4-5b13-4feb-b28e-388bf7c26f93/download/datadotgov_main.xlsx", "aus.xlsx"),
+        ["ABN", "Charity_Legal_Name", "Registration_Date", "Date_Organisation_Established", "Charity_Size"],
+        [[11000000000 + i, "Charity " + str(i), random_day(rng), random_day(rng) if rng.random() < 0.9 else random_date(rng, "%d/%m/%Y"),
+            rng.choice(["Small", "Medium", "Large"])] for i in range(rows)]) # a few establishment dates are text
+    with open(add("www.charitiesregulator.ie/en/information-for-the-public/search-the-register-of-charities", "roi.html"), "w") as f:
+        f.write('<html><body><a href="/media/public-register-28012021.xlsx">Download the register</a></body></html>')
+    write_xlsx(add("www.charitiesregulator.ie/media/public-register-28012021.xlsx", "roi.xlsx"),
+        ["Registered Charity Number", "Registered Charity Name", "Status", "Date Registered", "Date Deregistered"],
+        [[20000000 + i, "Charity " + str(i)] + (["Deregistered", random_day(rng), random_day(rng)] if rng.random() < 0.1 else
+            ["Registered", random_day(rng), ""]) for i in range(rows)])
+
+    # New Zealand
+
+    with open(add("www.odata.charities.govt.nz/vOrganisations?$returnall=true&$format=csv", "nz.csv"), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["OrganisationId", "Name", "CharityRegistrationNumber", "DateRegistered", "DeregistrationDate"])
+        for i in range(rows):
+            writer.writerow([i, "Charity " + str(i), "CC" + str(10000 + i), random_date(rng, "%d/%m/%Y"),
+                random_date(rng, "%d/%m/%Y") if rng.random() < 0.2 else ""])
+
+    # USA: four business files and the revocation list
+
+    for n in range(1, 5):
+        with open(add("www.irs.gov/pub/irs-soi/eo" + str(n) + ".csv", "eo" + str(n) + ".csv"), "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["EIN", "NAME", "ICO", "STREET", "CITY", "STATE", "ZIP", "GROUP", "SUBSECTION", "AFFILIATION", "CLASSIFICATION",
+                "RULING", "DEDUCTIBILITY", "FOUNDATION", "ACTIVITY", "ORGANIZATION", "STATUS", "TAX_PERIOD", "ASSET_CD", "INCOME_CD",
+                "FILING_REQ_CD", "PF_FILING_REQ_CD", "ACCT_PD", "ASSET_AMT", "INCOME_AMT", "REVENUE_AMT", "NTEE_CD", "SORT_NAME"])
+            for i in range(rows // 4):
+                ein = str(n * 100000000 + i).zfill(9)
+                writer.writerow([ein, "ORGANIZATION " + ein, "", "1 MAIN ST", "TOWN", "NY", "10001-0000", "0000", rng.choice(["03", "04", "05"]),
+                    "3", "1000", random_date(rng, "%Y%m"), "1", "15", "000000000", "1", "01", "201912", "0", "0", "01", "0", "12", "0", "0", "0",
+                    rng.choice(["A20", "B11", "P20", "X20"]), ""])
+    revocation = io.StringIO()
+    for i in range(rows // 2):
+        revocation.write("|".join([str(500000000 + i), "ORGANIZATION " + str(i), "", "1 MAIN ST", "TOWN", "NY", "10001", "US",
+            rng.choice(["3", "4"]), random_date(rng, "%d-%b-%Y"), random_date(rng, "%d-%b-%Y"), ""]) + "\n")
+    with zipfile.ZipFile(add("apps.irs.gov/pub/epostcard/data-download-revocation.zip", "revocation.zip"), "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("data-download-revocation.txt", revocation.getvalue())
+
+    # Canada: tab-delimited list of charities
+
+    c = load_module("collection")
+    with open(add(c.can_url.split("://", 1)[1], "can.txt"), "w", newline="") as f:
+        writer = csv.writer(f, delimiter="\t")
+        writer.writerow(["BN/Registration number", "Charity name", "Charity status", "Effective date of status", "Sanction",
+            "Designation code", "Category code", "Address", "City", "Province", "Country", "Postal code"])
+        for i in range(rows):
+            writer.writerow(["{} {} RR0001".format(10000 + i // 10000, str(i % 10000).zfill(4)), "Charity " + str(i),
+                rng.choice(["Registered", "Registered", "Revoked", "Annulled"]), random_date(rng, rng.choice(["%Y-%m-%d", "%Y/%m/%d"])),
+                "", "C", "0" + str(rng.randint(1, 9)) + "0", "1 Main St", "Town", "ON", "CA", "K1A 0A1"])
+
+    # England and Wales: one zip per table of the public extract
+
+    for table in ew_tables:
+        with zipfile.ZipFile(add("ccewuksprdoneregsadata1.blob.core.windows.net/data/txt/publicextract." + table + ".zip", "ew-" + table + ".zip"),
+            "w", zipfile.ZIP_DEFLATED) as zf:
+            if table == "charity": # the register itself, with main and linked charities
+                lines = ["date_of_extract\torganisation_number\tregistered_charity_number\tlinked_charity_number\tcharity_name"
+                    "\tcharity_registration_status\tdate_of_registration\tdate_of_removal"]
+                for i in range(rows):
+                    removed = rng.random() < 0.2
+                    lines.append("2021-01-28 00:00:00.0000000\t{}\t{}\t{}\tCharity {}\t{}\t{}\t{}".format(i, 200000 + i // 2, i % 2, i,
+                        "Removed" if removed else "Registered", random_date(rng, "%Y-%m-%d 00:00:00"),
+                        random_date(rng, "%Y-%m-%d 00:00:00") if removed else ""))
+            else:
+                lines = ["date_of_extract\torganisation_number\tregistered_charity_number\tlinked_charity_number\tdetail"]
+                for i in range(rows):
+                    lines.append("2021-01-28 00:00:00.0000000\t{}\t{}\t0\t{}".format(i, 200000 + i, "text " * rng.randint(1, 20)))
+            zf.writestr("publicextract." + table + ".txt", "\r\n".join(lines))
+
+    # Scotland: zip files containing the register and removed organisations
+
+    for name, url in [("CharityExport", "CharityRegDownload"), ("CharityExport-Removed", "CharityFormerRegDownload")]:
+        data = io.StringIO()
+        writer = csv.writer(data)
+        writer.writerow(["Charity Number", "Charity Name", "Registered Date", "Ceased Date"])
+        for i in range(rows):
+            writer.writerow(["SC" + str(i).zfill(6), "Charity " + str(i), random_date(rng, "%d/%m/%Y %H:%M"),
+                random_date(rng, "%d/%m/%Y %H:%M") if name.endswith("Removed") else ""])
+        with zipfile.ZipFile(add("www.oscr.org.uk/umbraco/Surface/FormsSurface/" + url, "sco-" + url + ".zip"), "w", zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr(name + ".csv", data.getvalue())
+
+    # Northern Ireland: register and web pages
+
+    with open(add("www.charitycommissionni.org.uk/umbraco/api/charityApi/ExportSearchResultsToCsv/?include=Removed", "ni.csv"), "w", newline="", encoding="ISO-8859-1") as f:
+        writer = csv.writer(f)
+        writer.writerow(["Reg charity number", "Sub charity number", "Charity name", "Date registered", "Status"])
+        for i in range(rows):
+            regid = 100000 + i
+            removed = rng.random() < 0.2
+            writer.writerow([regid, 0, "Charity " + str(i), random_date(rng, "%d/%m/%Y"), "Removed" if removed else "Registered"])
+            if i < pages:
+                with open(add("www.charitycommissionni.org.uk/charity-details/?regId=" + str(regid) + "&subId=0", "ni-page-" + str(regid) + ".html"), "w") as p:
+                    p.write(ni_page(regid, random_date(rng, "%d %b %Y") if removed else None))
+
+    # England and Wales .bcp extract for fimport.import_zip
+
+    fimport = load_module("fimport")
+    with zipfile.ZipFile(folder + "/ew-extract-bcp.zip", "w", zipfile.ZIP_DEFLATED) as zf:
+        for table, columns in fimport.cc_files.items():
+            lines = ["@**@".join([str(i)] + ["value " + str(rng.randint(0, 10 ** 6)) for c in columns[1:]]) for i in range(rows)]
+            zf.writestr(table + ".bcp", "*@@*".join(lines) + "*@@*")
+
+    with open(folder + "/routes.json", "w") as f:
+        json.dump({"rows": rows, "pages": pages, "routes": routes}, f)
+    return routes
+
+
+def load_module(name):
+    """
+        Loads the collection script (whose name is not a valid module name) or one of its helper modules.
+    """
+
+    if name == "collection":
+        spec = importlib.util.spec_from_file_location("collection", collection)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    return importlib.import_module(name)
+
+
+def serve(routes):
+    """
+        Starts a local web server, in a background thread, that serves the fixture for each route.
+        Returns the server; its address is server.server_address.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            path = routes.get(urllib.parse.unquote(self.path.lstrip("/")))
+            if path is None:
+                self.send_error(404)
+                return
+            size = os.path.getsize(path)
+            self.send_response(200)
+            self.send_header("Content-Length", str(size))
+            self.send_header("ETag", '"' + hashlib.sha256((path + str(size)).encode()).hexdigest()[:16] + '"')
+            self.end_headers()
+            with open(path, "rb") as f:
+                shutil.copyfileobj(f, self.wfile, 1024 * 1024)
+
+        def log_message(self, format, *args): # do not print a line per request
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def redirect(base):
+    """
+        Sends every request to a regulator's website to the local server at `base` instead, by
+        rewriting the url in requests.Session.request (which requests.get also uses).
+    """
+
+    import requests
+
+    original = requests.Session.request
+
+    def request(self, method, url, *args, **kwargs):
+        parts = urllib.parse.urlsplit(url)
+        if parts.hostname in hosts:
+            url = base + "/" + parts.netloc + parts.path + ("?" + parts.query if parts.query else "")
+        return original(self, method, url, *args, **kwargs)
+
+    requests.Session.request = request
+
+
+def folder_size(folder):
+    return sum(os.path.getsize(os.path.join(root, f)) for root, dirs, files in os.walk(folder) for f in files)
+
+
+def run_stage(stage, work, base, options, queue):
+    """
+        Runs one stage against the local server in a fresh process, so that peak memory is not
+        shared between stages, and reports its time, peak memory and the bytes it read and wrote.
+    """
+
+    import contextlib
+    redirect(base)
+    c = load_module("collection")
+    c.fdownload.conditional = False # every stage downloads its files in full
+
+    basefolder = work + "/data/" + ddate
+    logfolder = basefolder + "/log"
+    os.makedirs(logfolder, exist_ok=True)
+    nidir = basefolder + "/ni"
+    register = nidir + "/ni-roc-" + ddate + ".csv"
+    fixtures = work + "/fixtures"
+
+    functions = {"aus": c.aus_download, "nz": c.nz_download, "usa": c.usa_download, "can": c.can_download, "ew": c.ew_download, "roi": c.roi_download, "sco": c.sco_download}
+    log = io.StringIO()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(log):
+        if stage in functions:
+            before = folder_size(basefolder)
+            functions[stage](basefolder, logfolder, ddate)
+            nbytes = folder_size(basefolder) - before
+        elif stage == "ni_roc":
+            c.ni_roc(basefolder, logfolder, ddate)
+            nbytes = os.path.getsize(register)
+        elif stage == "ni_webpages":
+            regids = set(range(100000, 100000 + options["pages"]))
+            folder = c.ni_webpage_from_file(register, nidir, logfolder, ddate, concurrency=options["concurrency"], rate=1e6, regids=regids)
+            nbytes = folder_size(folder)
+        elif stage == "ni_removed":
+            c.ni_removed(register, nidir, nidir + "/webpages", ddate, processes=options["processes"])
+            nbytes = folder_size(nidir + "/webpages")
+        else:
+            dfolder = work + "/import_zip"
+            os.makedirs(dfolder, exist_ok=True)
+            c_fimport = load_module("fimport")
+            c_fimport.import_zip(fixtures + "/ew-extract-bcp.zip", dfolder, processes=options["processes"])
+            with zipfile.ZipFile(fixtures + "/ew-extract-bcp.zip") as zf:
+                nbytes = sum(info.file_size for info in zf.infolist())
+    duration = time.perf_counter() - start
+
+    peak = None
+    if resource is not None:
+        peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+    queue.put({"stage": stage, "seconds": duration, "bytes": nbytes, "peak_mb": peak})
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark the collection script against a local stand-in for each regulator.")
+    parser.add_argument("--rows", type=int, default=100000, help="number of organisations in each synthetic register")
+    parser.add_argument("--pages", type=int, default=2000, help="number of CCNI web pages to serve")
+    parser.add_argument("--folder", default="offline-benchmark", help="folder for the fixtures and output")
+    parser.add_argument("--stages", nargs="+", choices=stages, default=stages)
+    parser.add_argument("--processes", type=int, default=1, help="processes used by import_zip and ni_removed")
+    parser.add_argument("--concurrency", type=int, default=8, help="web pages downloaded at the same time")
+    parser.add_argument("--output", default=None, help="append the results to this JSON lines file")
+    args = parser.parse_args()
+
+
+    # Create fixtures (reused if they exist for the same scale)
+
+    fixtures = args.folder + "/fixtures"
+    routesfile = fixtures + "/routes.json"
+    routes = None
+    if os.path.isfile(routesfile):
+        with open(routesfile, "r") as f:
+            saved = json.load(f)
+        if saved["rows"] == args.rows and saved["pages"] == args.pages:
+            routes = saved["routes"]
+            print("Using existing fixtures: {}".format(fixtures))
+    if routes is None:
+        if os.path.isdir(fixtures):
+            shutil.rmtree(fixtures)
+        os.makedirs(fixtures)
+        print("Creating fixtures: {:,} rows, {:,} web pages".format(args.rows, args.pages))
+        routes = make_fixtures(os.path.abspath(fixtures), args.rows, args.pages)
+
+    work = os.path.abspath(args.folder + "/run")
+    if os.path.isdir(work):
+        shutil.rmtree(work)
+    os.makedirs(work)
+    os.symlink(os.path.abspath(fixtures), work + "/fixtures")
+
+
+    # Run each stage in a fresh process, in order (the NI stages use the output of the previous one)
+
+    server = serve(routes)
+    base = "http://127.0.0.1:" + str(server.server_address[1])
+    options = {"pages": args.pages, "processes": args.processes, "concurrency": args.concurrency}
+
+    ctx = mp.get_context("spawn")
+    results = []
+    for stage in args.stages:
+        queue = ctx.Queue()
+        p = ctx.Process(target=run_stage, args=(stage, work, base, options, queue))
+        p.start()
+        p.join()
+        if p.exitcode != 0:
+            print("{} failed (exit code {})".format(stage, p.exitcode))
+            continue
+        results.append(queue.get())
+
+    server.shutdown()
+
+    print("\r")
+    print("{:<12} {:>10} {:>14} {:>10} {:>14}".format("stage", "seconds", "MB", "MB/s", "peak RSS (MB)"))
+    for r in results:
+        mb = r["bytes"] / 1024 / 1024
+        peak = "{:.0f}".format(r["peak_mb"]) if r["peak_mb"] is not None else "n/a"
+        print("{:<12} {:>10.2f} {:>14.1f} {:>10.1f} {:>14}".format(r["stage"], r["seconds"], mb, mb / max(r["seconds"], 1e-9), peak))
+
+    if args.output:
+        with open(args.output, "a") as f:
+            for r in results:
+                f.write(json.dumps(dict(r, rows=args.rows, pages=args.pages, time=time.strftime("%Y-%m-%dT%H:%M:%S"))) + "\n")
+
+
+# Main program #
+
+if __name__ == "__main__":
+    main()